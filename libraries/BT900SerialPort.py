@@ -36,6 +36,10 @@ class BT900SerialPort(CmdSerialPort):
     BT900_ENABLE_CYSPP_NOT = "gattc write 1 18 0100"
     BT900_CYSPP_WRITE_DATA_STRING = "gattc writecmd$ 1 17 "
 
+    LINE_RX_DELIMITER = b'\r'
+    BT900_RESPONSE_SUCCESS = "00"
+    BT900_RESPONSE_ERROR_PREFIX = "01\t"
+
     BT900_DEFAULT_BAUD = 115200
     DEFAULT_WAIT_TIME_SEC = 1
     ERROR_DEVICE_TYPE = "Error!  Unknown Device Type."
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import select
+import threading
+import time
+import tty
+from BT900SerialPort import BT900SerialPort
+from lc_util import logger_setup
+
+
+class BT900Simulator():
+    """Simulated BT900 smartBASIC command application attached to a pseudo terminal
+    (Linux/macOS only).
+
+    Every command line (ended by \\r) is answered by a result line: \\n00\\r for success
+    or \\n01\\t<error code>\\r. In command mode each result is followed by the \\r\\n> prompt.
+    SPP and CYSPP write commands pass their hex text to the peer, an EzSerialSimulator
+    in data mode, as bytes received over the air.
+    Open port_name with BT900SerialPort to talk to the simulator.
+    """
+
+    READ_TIMEOUT_SECS = 0.1
+    RESULT_SUCCESS = b'\n00\r'
+    PROMPT = b'\r\n>'
+    # smartBASIC error of a write while the transmit buffer is full
+    ERROR_TX_BUFFER_FULL = '5A06'
+    WRITE_PREFIXES = [BT900SerialPort.BT900_SPP_WRITE_PREFIX,
+                      BT900SerialPort.BT900_CYSPP_WRITE_DATA_STRING]
+
+    def __init__(self, peer=None, latency: float = 0.0):
+        """
+        Args:
+            peer (EzSerialSimulator, optional): Receiver of written data. Defaults to None.
+            latency (float, optional): Processing time of each command in seconds.
+              Defaults to 0.0.
+        """
+        self.peer = peer
+        self.latency = latency
+        self.command_mode = False
+        # Fault injection: every busy_every-th write is rejected (0 = never)
+        self.busy_every = 0
+        self.writes = 0
+        self.rejected_writes = 0
+        self.commands = []
+        self._master = None
+        self._slave = None
+        self._port_name = None
+        self._stop_threads = False
+        self._rx_thread = None
+
+    @property
+    def port_name(self):
+        """Device name of the simulated serial port"""
+        return self._port_name
+
+    def start(self) -> str:
+        """Create the pseudo terminal and start answering commands
+
+        Returns:
+            str: Port name to open with BT900SerialPort
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self._port_name = os.ttyname(self._slave)
+        self._stop_threads = False
+        self._rx_thread = threading.Thread(target=self.__rx_thread, daemon=True)
+        self._rx_thread.start()
+        logging.debug(f'BT900 simulator on {self._port_name}')
+        return self._port_name
+
+    def stop(self):
+        """Stop the simulator and close the pseudo terminal
+        """
+        self._stop_threads = True
+        if self._rx_thread:
+            self._rx_thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __rx_thread(self):
+        buf = bytearray()
+        while not self._stop_threads:
+            ready, _, _ = select.select([self._master], [], [], self.READ_TIMEOUT_SECS)
+            if not ready:
+                continue
+            try:
+                buf.extend(os.read(self._master, 4096))
+            except OSError:
+                continue
+            while b'\r' in buf:
+                (line, _, rest) = bytes(buf).partition(b'\r')
+                buf = bytearray(rest)
+                self.__process(line.decode('utf-8', 'ignore').strip())
+
+    def __process(self, line: str):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.commands.append(line)
+        result = self.RESULT_SUCCESS
+        if line == BT900SerialPort.BT900_CMD_MODE:
+            self.command_mode = True
+        elif line == BT900SerialPort.BT900_EXIT:
+            self.command_mode = False
+        else:
+            prefix = next((p for p in self.WRITE_PREFIXES if line.startswith(p)), None)
+            if prefix is not None:
+                self.writes += 1
+                if self.busy_every and self.writes % self.busy_every == 0:
+                    self.rejected_writes += 1
+                    result = f'\n01\t{self.ERROR_TX_BUFFER_FULL}\r'.encode()
+                elif self.peer is not None:
+                    self.peer.receive_data(line[len(prefix):].encode('ascii'))
+        os.write(self._master, result + (self.PROMPT if self.command_mode else b''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Simulate the BT900 smartBASIC command application on a pseudo terminal')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Command processing time in seconds")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    sim = BT900Simulator(latency=args.latency)
+    logger.info(f'BT900 simulator port: {sim.start()}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,148 @@
+import logging
+import time
+from collections import deque
+from BT900SerialPort import BT900SerialPort
+from EzSerialPort import EzSerialPort
+from EzThroughput import StreamVerifier
+
+
+class BT900Throughput():
+    """Stream sequenced data from a BT900 to an IF820 over SPP or CYSPP.
+
+    The BT900 command application only takes text, so each payload is sent hex encoded
+    in one write command. The IF820 must be in data mode; it receives the hex text as
+    raw bytes and the payloads are decoded and verified on the host.
+
+    Several write commands are kept outstanding. Each one is answered by a success or an
+    error line. A write the smartBASIC application rejects (i.e. its transmit buffer is
+    full) is sent again after a short backoff.
+    """
+
+    WRITE_BUSY_BACKOFF_SECS = 0.01
+    WRITE_MAX_RETRIES = 100
+    PROMPT_CHARS = '>\r\n\t '
+
+    def __init__(self, bt900: BT900SerialPort, peer: EzSerialPort):
+        """
+        Args:
+            bt900 (BT900SerialPort): Port of the BT900 (sender), in command mode and connected
+            peer (EzSerialPort): Port of the IF820 (receiver), in data mode
+        """
+        self.bt900 = bt900
+        self.peer = peer
+
+    def spp(self, count: int, payload_size: int = 64, window: int = 4,
+            timeout: float = 2) -> dict:
+        """Stream data over a BR/EDR SPP connection (spp write)
+
+        Args:
+            count (int): Number of payloads
+            payload_size (int, optional): Bytes per payload before hex encoding. Defaults to 64.
+            window (int, optional): Maximum outstanding write commands. Defaults to 4.
+            timeout (float, optional): Time to wait for a response or data in seconds. Defaults to 2.
+
+        Returns:
+            dict: Throughput results, see EzThroughput
+        """
+        return self.__stream(BT900SerialPort.BT900_SPP_WRITE_PREFIX, count, payload_size,
+                             window, timeout)
+
+    def cyspp(self, count: int, payload_size: int = 64, window: int = 4,
+              timeout: float = 2) -> dict:
+        """Stream data over a CYSPP connection (gattc writecmd$).
+        The hex encoded payload must fit in one write (MTU - 3 >= 2 * payload_size).
+
+        Args:
+            count (int): Number of payloads
+            payload_size (int, optional): Bytes per payload before hex encoding. Defaults to 64.
+            window (int, optional): Maximum outstanding write commands. Defaults to 4.
+            timeout (float, optional): Time to wait for a response or data in seconds. Defaults to 2.
+
+        Returns:
+            dict: Throughput results, see EzThroughput
+        """
+        return self.__stream(BT900SerialPort.BT900_CYSPP_WRITE_DATA_STRING, count,
+                             payload_size, window, timeout)
+
+    def __wait_write_result(self, timeout: float) -> str | None:
+        """Wait for the response line of the oldest outstanding write
+
+        Returns:
+            str | None: Success or error line, None if nothing was received
+        """
+        while True:
+            resp = self.bt900.wait_for_response(timeout, oldest=True)
+            if resp is None:
+                return None
+            # In command mode the prompt that follows a result starts the next line
+            resp = resp.lstrip(self.PROMPT_CHARS)
+            if len(resp) == 0:
+                continue
+            if (resp == BT900SerialPort.BT900_RESPONSE_SUCCESS or
+                    resp.startswith(BT900SerialPort.BT900_RESPONSE_ERROR_PREFIX)):
+                return resp
+            # Unsolicited message (i.e. an event), not a write result
+            logging.debug(f'BT900 message during stream: {resp}')
+
+    def __stream(self, prefix: str, count: int, payload_size: int, window: int,
+                 timeout: float) -> dict:
+        verifier = StreamVerifier(payload_size)
+        record_size = payload_size * 2
+        rx_buffer = bytearray()
+
+        def on_data(data):
+            rx_time = time.perf_counter()
+            rx_buffer.extend(data)
+            while len(rx_buffer) >= record_size:
+                record = bytes(rx_buffer[:record_size])
+                del rx_buffer[:record_size]
+                try:
+                    payload = bytes.fromhex(record.decode('ascii'))
+                except ValueError:
+                    # Counted as corrupt
+                    payload = b''
+                verifier.receive(payload, rx_time)
+
+        outstanding = deque()
+        retries = 0
+        failed = 0
+
+        def send(seq):
+            outstanding.append(seq)
+            self.bt900.send_no_wait(prefix + verifier.make_payload(seq).hex())
+
+        def complete_oldest():
+            nonlocal retries, failed
+            seq = outstanding.popleft()
+            resp = self.__wait_write_result(timeout)
+            if resp == BT900SerialPort.BT900_RESPONSE_SUCCESS:
+                return
+            if resp is None or retries >= self.WRITE_MAX_RETRIES:
+                logging.warning(f'BT900 write {seq} failed: {resp}')
+                failed += 1
+                return
+            retries += 1
+            time.sleep(self.WRITE_BUSY_BACKOFF_SECS)
+            send(seq)
+
+        # Every write is answered by one line, so split responses per line while streaming
+        rx_delimiter = self.bt900.get_rx_delimiter()
+        self.bt900.set_rx_delimiter(BT900SerialPort.LINE_RX_DELIMITER)
+        self.bt900.clear_cmd_rx_queue()
+        self.peer.set_raw_data_handler(on_data)
+        try:
+            start_time = time.perf_counter()
+            for seq in range(count):
+                while len(outstanding) >= window:
+                    complete_oldest()
+                send(seq)
+            while len(outstanding) > 0:
+                complete_oldest()
+            verifier.wait_received(count - failed, timeout)
+        finally:
+            self.peer.set_raw_data_handler(None)
+            self.bt900.set_rx_delimiter(rx_delimiter)
+        results = verifier.results(count, start_time)
+        results['retries'] = retries
+        results['failed'] = failed
+        return results
@@ -168,6 +168,17 @@ class CmdSerialPort(SerialPort):
             data = bytes(data, 'utf-8')
         return super().send(data)
 
+    def send_no_wait(self, msg: str):
+        """Send a command out the serial port without waiting for its response.
+        Responses can be collected later with wait_for_response(oldest=True).
+
+        Args:
+            msg (str): Command string
+        """
+        self.__pause_cmd_queue_monitor()
+        super().send(b''.join([bytes(msg, 'utf-8'), self._tx_delimiter]))
+        self.__resume_cmd_queue_monitor()
+
     def set_tx_delimiter(self, delimiter: bytes):
         """Set byte string that is used to delimit send commands
 
@@ -184,6 +195,14 @@ class CmdSerialPort(SerialPort):
         """
         self._rx_delimiter = delimiter
 
+    def get_rx_delimiter(self) -> bytes:
+        """Get byte string that is used to delimit received commands
+
+        Returns:
+            bytes: the delimiter
+        """
+        return self._rx_delimiter
+
     def clear_cmd_rx_queue(self):
         """Clear all received responses from the queue
         """
@@ -214,11 +233,13 @@ class CmdSerialPort(SerialPort):
 
         return rx
 
-    def wait_for_response(self, timeout: float = 1.0) -> str | None:
+    def wait_for_response(self, timeout: float = 1.0, oldest: bool = False) -> str | None:
         """Wait for a response to be received
 
         Args:
             timeout (float, optional): Time to wait for a response in seconds. Defaults to 1.0.
+            oldest (bool, optional): Take the oldest queued response instead of the newest.
+              Use when several commands are outstanding. Defaults to False.
 
         Returns:
             str: None if no response received, otherwise the response string
@@ -227,9 +248,9 @@ class CmdSerialPort(SerialPort):
         self._cmd_received_event.clear()
 
         if len(self._cmd_rx_queue) > 0:
-            resp = self._cmd_rx_queue.pop()
+            resp = self._cmd_rx_queue.pop(0 if oldest else -1)
         elif self._cmd_received_event.wait(timeout):
-            resp = self._cmd_rx_queue.pop()
+            resp = self._cmd_rx_queue.pop(0 if oldest else -1)
         else:
             resp = None
         self.__resume_cmd_queue_monitor()
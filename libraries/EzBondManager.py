@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from EzSerialPort import EzSerialPort
+from EzScanTable import ScanTable
+
+
+class BondManager():
+    """Track the bonds of a module and encrypt links with them.
+
+    The bond list is read once with smp_query_bonds and kept up to date from pairing results,
+    so tests that share a board don't query it again. A link to a bonded peer is encrypted
+    with the stored keys. Pairing is only run when there is no bond, or when the peer no
+    longer has its keys (the stale bond is deleted first).
+    """
+
+    EVENT_TIMEOUT_SECS = 10
+    ENCRYPTION_STATUS_OK = 0
+    PAIR_PARAMS = {'mode': 0, 'bonding': 1, 'keysize': 16, 'pairprop': 0}
+
+    def __init__(self, port: EzSerialPort):
+        """
+        Args:
+            port (EzSerialPort): Open port of the module
+        """
+        self.port = port
+        self.pair_params = dict(self.PAIR_PARAMS)
+        self._lock = threading.Lock()
+        self._bonds = None
+
+    def query_bonds(self) -> list:
+        """Read the bonds from the module
+
+        Returns:
+            list: Bond entries (handle, address and type)
+        """
+        self.port.clear_events(self.port.EVENT_SMP_BOND_ENTRY)
+        res = self.port.send_and_wait(self.port.CMD_SMP_QUERY_BONDS, clear_queue=False)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{self.port.CMD_SMP_QUERY_BONDS} Result: {res}')
+        bonds = []
+        for _ in range(res[1].payload['count']):
+            event = self.port.wait_event(self.port.EVENT_SMP_BOND_ENTRY)
+            if event[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{self.port.EVENT_SMP_BOND_ENTRY} not received')
+            bonds.append({'handle': event[1].payload['handle'],
+                          'address': list(event[1].payload['address']),
+                          'type': event[1].payload['type']})
+        with self._lock:
+            self._bonds = dict((ScanTable.address_key(b['address']), b) for b in bonds)
+        return bonds
+
+    @property
+    def bonds(self) -> list:
+        """Bond entries, read from the module on first use"""
+        with self._lock:
+            bonds = self._bonds
+        if bonds is None:
+            return self.query_bonds()
+        return list(bonds.values())
+
+    def is_bonded(self, address) -> bool:
+        """
+        Args:
+            address (str | list): Peer address
+
+        Returns:
+            bool: True if the module has a bond with the peer
+        """
+        key = ScanTable.address_key(address)
+        return any(ScanTable.address_key(b['address']) == key for b in self.bonds)
+
+    def forget(self):
+        """Read the bonds from the module again on next use (i.e. after a factory reset)
+        """
+        with self._lock:
+            self._bonds = None
+
+    def delete_bond(self, address=None, address_type: int = 0):
+        """Delete a bond from the module
+
+        Args:
+            address (list, optional): Peer address. Defaults to None (all bonds).
+            address_type (int, optional): Peer address type. Defaults to 0.
+        """
+        res = self.port.send_and_wait(self.port.CMD_SMP_DELETE_BOND, clear_queue=False,
+                                      address=list(address) if address else [0] * 6,
+                                      type=address_type)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{self.port.CMD_SMP_DELETE_BOND} Result: {res}')
+        with self._lock:
+            if self._bonds is not None:
+                if address is None:
+                    self._bonds = {}
+                else:
+                    self._bonds.pop(ScanTable.address_key(address), None)
+
+    def __wait(self, conn_handle: int, events: list, timeout: float):
+        """Wait for the first of several events of a connection. Events of other connections
+        stay queued for their own waiters.
+
+        Returns:
+            tuple: (event name, Packet)
+        """
+        (err, event, packet) = self.port.wait_event_matching(
+            events, lambda p: p.payload['conn_handle'] == conn_handle, timeout)
+        if err != EzSerialPort.SUCCESS:
+            raise Exception(f'{events} not received for connection {conn_handle}')
+        return (event, packet)
+
+    def __discard(self, conn_handle: int, events: list):
+        """Drop queued (stale) events of a connection"""
+        while self.port.wait_event_matching(
+                events, lambda p: p.payload['conn_handle'] == conn_handle, 0)[0] == \
+                EzSerialPort.SUCCESS:
+            pass
+
+    def __pair(self, conn_handle: int, timeout: float):
+        events = [self.port.EVENT_SMP_ENCRYPTION_STATUS, self.port.EVENT_SMP_PAIRING_RESULT]
+        self.__discard(conn_handle, events)
+        res = self.port.send_and_wait(self.port.CMD_SMP_PAIR, clear_queue=False,
+                                      conn_handle=conn_handle, **self.pair_params)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{self.port.CMD_SMP_PAIR} Result: {res}')
+        return self.__wait(conn_handle, events, timeout)
+
+    def secure(self, conn_handle: int, address, address_type: int = 0,
+               timeout: float = EVENT_TIMEOUT_SECS) -> dict:
+        """Encrypt a link, with the existing bond if there is one
+
+        Args:
+            conn_handle (int): Connection handle
+            address (list): Peer address
+            address_type (int, optional): Peer address type. Defaults to 0.
+            timeout (float, optional): Time to wait for pairing or encryption in seconds.
+              Defaults to 10.
+
+        Returns:
+            dict: bonded (a bond existed), paired (a pairing exchange was needed) and seconds
+        """
+        start = time.perf_counter()
+        bonded = self.is_bonded(address)
+        (event, packet) = self.__pair(conn_handle, timeout)
+        if event == self.port.EVENT_SMP_PAIRING_RESULT and packet.payload['result'] != 0:
+            if not bonded:
+                raise Exception(f'Pairing failed: 0x{packet.payload["result"]:04X}')
+            # The peer no longer has its keys
+            logging.info(f'Bond with {ScanTable.address_key(address)} rejected '
+                         f'(0x{packet.payload["result"]:04X}), pairing again')
+            self.delete_bond(address, address_type)
+            (event, packet) = self.__pair(conn_handle, timeout)
+        if event == self.port.EVENT_SMP_PAIRING_RESULT:
+            if packet.payload['result'] != 0:
+                raise Exception(f'Pairing failed: 0x{packet.payload["result"]:04X}')
+            (event, packet) = self.__wait(
+                conn_handle, [self.port.EVENT_SMP_ENCRYPTION_STATUS], timeout)
+            paired = True
+        else:
+            # A pairing result before the encryption status means the keys were new
+            paired = self.port.wait_event_matching(
+                [self.port.EVENT_SMP_PAIRING_RESULT],
+                lambda p: p.payload['conn_handle'] == conn_handle, 0)[0] == EzSerialPort.SUCCESS
+        if packet.payload['status'] != self.ENCRYPTION_STATUS_OK:
+            raise Exception(f'Encryption failed: 0x{packet.payload["status"]:02X}')
+        if paired and self.pair_params['bonding']:
+            with self._lock:
+                if self._bonds is not None:
+                    self._bonds[ScanTable.address_key(address)] = {
+                        'handle': None, 'address': list(address), 'type': address_type}
+        return {'bonded': bonded, 'paired': paired,
+                'seconds': round(time.perf_counter() - start, 4)}
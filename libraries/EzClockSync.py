@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from collections import deque
+from EzSerialPort import EzSerialPort
+
+
+class ClockSync():
+    """Correlate the module clock with the host clock (time.perf_counter) using system_ping.
+
+    Each ping gives the module runtime at some point between sending the command and
+    receiving the response. The ping is assumed to be answered in the middle of the round
+    trip, so pings with the shortest round trips are the most accurate. Only those are
+    used to fit the offset and drift of the module clock.
+
+    The module runtime restarts when the module boots, so the fit is reset when a
+    system_boot event was received since the last ping or the runtime went backwards.
+    """
+
+    PING_FRACTION_PER_SEC = 32768
+    WINDOW_DEFAULT = 32
+    RTT_FILTER_RATIO = 0.5
+    DRIFT_MIN_SPAN_SECS = 10.0
+
+    def __init__(self, port: EzSerialPort, window: int = WINDOW_DEFAULT):
+        """
+        Args:
+            port (EzSerialPort): Open port of the module
+            window (int, optional): Number of recent pings kept for the fit. Defaults to 32.
+        """
+        self.port = port
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._offset = None
+        self._slope = 1.0
+        self._module_ref = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_boot = self.__latest_boot()
+        self.reboots = 0
+
+    def __latest_boot(self):
+        boots = self.port.get_event_history(self.port.EVENT_SYSTEM_BOOT)
+        return boots[-1] if boots else None
+
+    def reset(self):
+        """Forget all pings (i.e. after the module rebooted)
+        """
+        with self._lock:
+            self.__reset()
+
+    def __reset(self):
+        """Lock must be held"""
+        self._samples.clear()
+        self._offset = None
+        self._slope = 1.0
+        self._module_ref = 0.0
+
+    def __check_reboot(self, module_time: float = None):
+        """Reset the fit if the module booted since the last ping. Lock must be held."""
+        boot = self.__latest_boot()
+        rebooted = boot is not self._last_boot
+        if module_time is not None and len(self._samples) > 0 and \
+                module_time < self._samples[-1][1]:
+            rebooted = True
+        if rebooted:
+            logging.info('Module rebooted, clock sync restarted')
+            self._last_boot = boot
+            self.reboots += 1
+            self.__reset()
+
+    def sample(self) -> tuple:
+        """Ping the module once and update the fit
+
+        Returns:
+            tuple: (host time, module time, round trip time) in seconds, None if the ping failed
+        """
+        start = time.perf_counter()
+        (err, packet) = self.port.send_and_wait(
+            self.port.CMD_PING, clear_queue=False)
+        if err != EzSerialPort.SUCCESS:
+            logging.warning(f'Clock sync ping failed: {err}')
+            return None
+        rtt = packet.rx_time - start
+        module_time = ClockSync.module_time(packet.payload)
+        sample = (start + rtt / 2, module_time, rtt)
+        with self._lock:
+            self.__check_reboot(module_time)
+            self._samples.append(sample)
+            self.__fit()
+        return sample
+
+    def __fit(self):
+        """Least squares fit of host time against module time using the fastest pings.
+        Lock must be held."""
+        fastest = sorted(self._samples, key=lambda s: s[2])
+        used = fastest[:max(1, int(len(fastest) * self.RTT_FILTER_RATIO))]
+        module_ref = sum(s[1] for s in used) / len(used)
+        host_ref = sum(s[0] for s in used) / len(used)
+        variance = sum((s[1] - module_ref) ** 2 for s in used)
+        span = max(s[1] for s in used) - min(s[1] for s in used)
+        # Pings close together can't tell drift apart from round trip jitter
+        if span >= self.DRIFT_MIN_SPAN_SECS and variance > 0:
+            self._slope = sum((s[1] - module_ref) * (s[0] - host_ref)
+                              for s in used) / variance
+        else:
+            self._slope = 1.0
+        self._module_ref = module_ref
+        self._offset = host_ref
+
+    def sync(self, count: int = 8, interval: float = 0.0) -> dict:
+        """Ping the module several times
+
+        Args:
+            count (int, optional): Number of pings. Defaults to 8.
+            interval (float, optional): Delay in seconds between pings. Defaults to 0.0.
+
+        Returns:
+            dict: See status()
+        """
+        for i in range(count):
+            self.sample()
+            if interval > 0 and i < count - 1:
+                time.sleep(interval)
+        return self.status()
+
+    def start(self, interval: float = 1.0):
+        """Keep pinging the module from a background thread so the drift estimate improves
+
+        Args:
+            interval (float, optional): Delay in seconds between pings. Defaults to 1.0.
+        """
+        self.stop()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.sample()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    @staticmethod
+    def module_time(payload: dict) -> float:
+        """Module time of a ping response or event that has runtime and fraction
+
+        Args:
+            payload (dict): Packet payload
+
+        Returns:
+            float: Module runtime in seconds
+        """
+        return payload['runtime'] + payload['fraction'] / ClockSync.PING_FRACTION_PER_SEC
+
+    def module_to_host(self, module_time: float) -> float:
+        """
+        Args:
+            module_time (float): Module runtime in seconds
+
+        Returns:
+            float: Matching time.perf_counter() value
+        """
+        with self._lock:
+            self.__check_reboot()
+            if self._offset is None:
+                raise Exception('Clock not synchronized')
+            return self._offset + (module_time - self._module_ref) * self._slope
+
+    def host_to_module(self, host_time: float) -> float:
+        """
+        Args:
+            host_time (float): time.perf_counter() value
+
+        Returns:
+            float: Matching module runtime in seconds
+        """
+        with self._lock:
+            self.__check_reboot()
+            if self._offset is None:
+                raise Exception('Clock not synchronized')
+            return self._module_ref + (host_time - self._offset) / self._slope
+
+    def event_host_time(self, packet) -> float:
+        """Host time at which the module generated an event with runtime and fraction
+        (i.e. gpio_interrupt)
+
+        Args:
+            packet (Packet): The event
+
+        Returns:
+            float: Matching time.perf_counter() value
+        """
+        return self.module_to_host(ClockSync.module_time(packet.payload))
+
+    def status(self) -> dict:
+        """
+        Returns:
+            dict: samples, offset (host minus module time now, in seconds), drift_ppm and
+              rtt_min/uncertainty (half the fastest round trip) in milliseconds and the
+              number of reboots detected
+        """
+        with self._lock:
+            self.__check_reboot()
+            if self._offset is None:
+                return {'samples': 0, 'reboots': self.reboots}
+            rtt_min = min(s[2] for s in self._samples)
+            now = time.perf_counter()
+            module_now = self._module_ref + (now - self._offset) / self._slope
+            return {'samples': len(self._samples),
+                    'offset': now - module_now,
+                    'drift_ppm': round((self._slope - 1) * 1e6, 3),
+                    'rtt_min': round(rtt_min * 1000, 3),
+                    'uncertainty': round(rtt_min * 500, 3),
+                    'reboots': self.reboots}
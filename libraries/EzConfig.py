@@ -0,0 +1,178 @@
+import logging
+import time
+import ezserial_host_api.ezslib as ez_serial
+from EzSerialPort import EzSerialPort
+
+
+class ConfigReconciler():
+    """Bring the settings of an EZ-Serial module to a desired state.
+
+    The desired state maps a setting to its values. A setting is a set command
+    (i.e. gap_set_adv_parameters) or one of the SETTINGS aliases (i.e. adv_parameters).
+    Values are a dict of set command arguments. Arguments that are left out keep their
+    current value. Settings with a single argument also take the bare value.
+
+    The current values are read with the matching get commands in one pipelined pass.
+    Only settings that differ are written, and the configuration is stored once.
+    """
+
+    SETTINGS = {'device_name': 'gap_set_device_name',
+                'device_appearance': 'gap_set_device_appearance',
+                'adv_data': 'gap_set_adv_data',
+                'sr_data': 'gap_set_sr_data',
+                'adv_parameters': 'gap_set_adv_parameters',
+                'scan_parameters': 'gap_set_scan_parameters',
+                'conn_parameters': 'gap_set_conn_parameters',
+                'uart_parameters': 'system_set_uart_parameters',
+                'tx_power': 'system_set_tx_power',
+                'sleep_parameters': 'system_set_sleep_parameters',
+                'transport': 'system_set_transport',
+                'security_parameters': 'smp_set_security_parameters',
+                'privacy_mode': 'smp_set_privacy_mode',
+                'gatts_parameters': 'gatts_set_parameters',
+                'gattc_parameters': 'gattc_set_parameters',
+                'cyspp_parameters': 'p_cyspp_set_parameters',
+                'cyspp_packetization': 'p_cyspp_set_packetization',
+                'bt_parameters': 'bt_set_parameters'}
+    # Get commands that take arguments
+    GET_ARGS = {'system_get_uart_parameters': {'uart_type': 0}}
+    UART_SETTING = 'system_set_uart_parameters'
+
+    def __init__(self, port: EzSerialPort):
+        """
+        Args:
+            port (EzSerialPort): Open port of the module
+        """
+        self.port = port
+
+    @staticmethod
+    def setter(setting: str) -> str:
+        """
+        Args:
+            setting (str): Set command or alias
+
+        Returns:
+            str: The set command
+        """
+        command = ConfigReconciler.SETTINGS.get(setting, setting)
+        getter = command.replace('_set_', '_get_')
+        try:
+            entry = ez_serial.Protocol.getCommandByName(command)
+            get_entry = ez_serial.Protocol.getCommandByName(getter)
+        except ez_serial.ProtocolException:
+            raise ValueError(f'{setting} is not a setting that can be read back')
+        if '_set_' not in command or \
+                [p['name'] for p in entry['parameters']] != [r['name'] for r in get_entry['returns']]:
+            raise ValueError(f'{setting} is not a setting that can be read back')
+        return command
+
+    @staticmethod
+    def __normalize(value):
+        """Compare strings, bytes and address lists by their bytes"""
+        if isinstance(value, str):
+            return list(value.encode('utf-8'))
+        if isinstance(value, (bytes, bytearray, tuple, list)):
+            return list(value)
+        return value
+
+    def __desired_values(self, setting: str, values) -> dict:
+        entry = ez_serial.Protocol.getCommandByName(setting)
+        names = [p['name'] for p in entry['parameters']]
+        if not isinstance(values, dict):
+            if len(names) != 1:
+                raise ValueError(f'{setting} takes the arguments {names}')
+            values = {names[0]: values}
+        unknown = set(values) - set(names)
+        if unknown:
+            raise ValueError(f'{setting} has no arguments {sorted(unknown)}')
+        return values
+
+    def read(self, settings: list) -> dict:
+        """Read the current values of settings in one pipelined pass
+
+        Args:
+            settings (list): Set commands or aliases
+
+        Returns:
+            dict: Current values (set command arguments) by set command
+        """
+        setters = [ConfigReconciler.setter(s) for s in settings]
+        commands = []
+        for setter in setters:
+            getter = setter.replace('_set_', '_get_')
+            commands.append((getter, self.GET_ARGS.get(getter, {})))
+        current = {}
+        for setter, res in zip(setters, self.port.send_pipelined(commands)):
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(
+                    f'{setter.replace("_set_", "_get_")} Result: {res}')
+            entry = ez_serial.Protocol.getCommandByName(setter)
+            current[setter] = dict((p['name'], res[1].payload[p['name']])
+                                   for p in entry['parameters'])
+        return current
+
+    def diff(self, desired: dict, current: dict = None) -> dict:
+        """Compare the desired state with the module
+
+        Args:
+            desired (dict): Values by setting
+            current (dict, optional): Result of read(). Defaults to None (read now).
+
+        Returns:
+            dict: Changes by set command, each a dict of argument: (current, desired)
+        """
+        desired = dict((ConfigReconciler.setter(s), self.__desired_values(
+            ConfigReconciler.setter(s), v)) for s, v in desired.items())
+        if current is None:
+            current = self.read(list(desired))
+        changes = {}
+        for setter, values in desired.items():
+            changed = dict((name, (current[setter][name], value)) for name, value in values.items()
+                           if ConfigReconciler.__normalize(current[setter][name]) !=
+                           ConfigReconciler.__normalize(value))
+            if changed:
+                changes[setter] = changed
+        return changes
+
+    def apply(self, desired: dict, store: bool = True) -> dict:
+        """Write the settings that differ from the desired state and store the configuration once.
+        A UART change is written last and the host port follows the new baud rate.
+
+        Args:
+            desired (dict): Values by setting
+            store (bool, optional): Store the configuration in flash if anything changed.
+              Defaults to True.
+
+        Returns:
+            dict: read (settings read), changes (see diff), stored and seconds
+        """
+        start = time.perf_counter()
+        current = self.read(list(desired))
+        changes = self.diff(desired, current)
+        commands = []
+        for setter in sorted(changes, key=lambda s: s == self.UART_SETTING):
+            values = dict(current[setter])
+            values.update((name, new) for name, (_, new) in changes[setter].items())
+            commands.append((setter, values))
+        uart = commands.pop() if commands and commands[-1][0] == self.UART_SETTING else None
+        for (setter, _), res in zip(commands, self.port.send_pipelined(commands)):
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{setter} Result: {res}')
+        if uart:
+            res = self.port.send_and_wait(uart[0], clear_queue=False, **uart[1])
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{uart[0]} Result: {res}')
+            # The module switches after sending the response
+            self.port.set_baudrate(uart[1]['baud'])
+            if not self.port.ping(EzSerialPort.UART_BAUD_PING_ATTEMPTS,
+                                  EzSerialPort.UART_BAUD_PING_TIMEOUT_SECS):
+                raise Exception(f'No response at {uart[1]["baud"]}')
+        stored = False
+        if store and changes:
+            res = self.port.send_and_wait(self.port.CMD_STORE_CONFIG, clear_queue=False)
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{self.port.CMD_STORE_CONFIG} Result: {res}')
+            stored = True
+        logging.info(f'Config: read {len(current)} settings, changed {list(changes)}')
+        return {'read': len(current), 'changes': changes, 'stored': stored,
+                'seconds': round(time.perf_counter() - start, 4)}
@@ -0,0 +1,450 @@
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from EzSerialPort import EzSerialPort
+from EzScanTable import ScanTable
+from EzDiscoveryCache import DiscoveryCache
+from lc_util import latency_stats
+
+
+class GattLink():
+    """One connection of a module and its GATT client procedures.
+
+    The module runs one GATT procedure per connection at a time, so procedures on a link
+    are serialized. Procedures on different links can run at the same time from
+    different threads.
+    """
+
+    GATTC_DATA_SOURCE_READ = 0
+    GATTC_WRITE_TYPE_REQUEST = 0
+    NOTIFICATION_QUEUE_DEPTH = 256
+    PROCEDURE_TIMEOUT_SECS = 5
+
+    def __init__(self, port: EzSerialPort, conn_handle: int, address: list):
+        """
+        Args:
+            port (EzSerialPort): Port of the module
+            conn_handle (int): Connection handle
+            address (list): Peer address
+        """
+        self.port = port
+        self.conn_handle = conn_handle
+        self.address = address
+        self.connected = True
+        self.disconnect_reason = None
+        self.connect_time = time.perf_counter()
+        self._procedure_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._procedure = None
+        self._results = []
+        self._complete = None
+        self._notifications = deque(maxlen=self.NOTIFICATION_QUEUE_DEPTH)
+        self._notification_handler = None
+        self._latencies = {}
+        self._rx_bytes = 0
+        self._rx_count = 0
+        self._tx_bytes = 0
+        self._first_rx_time = None
+        self._last_rx_time = None
+
+    def __repr__(self):
+        return f'GattLink({self.conn_handle}, {ScanTable.address_key(self.address)})'
+
+    def _on_event(self, name: str, packet):
+        """Route an event of this connection (called by ConnectionManager on the pump thread)"""
+        payload = packet.payload
+        with self._cond:
+            if name == 'gattc_data_received':
+                if self._procedure == 'read' and \
+                        payload['source'] == self.GATTC_DATA_SOURCE_READ:
+                    self._results.append(payload['data'])
+                    return
+                self._rx_count += 1
+                self._rx_bytes += len(payload['data'])
+                if self._first_rx_time is None:
+                    self._first_rx_time = packet.rx_time
+                self._last_rx_time = packet.rx_time
+                handler = self._notification_handler
+                if handler is None:
+                    self._notifications.append(packet)
+                    self._cond.notify_all()
+            elif name == 'gattc_discover_result':
+                if self._procedure is not None:
+                    self._results.append(payload)
+                return
+            elif name == 'gattc_remote_procedure_complete':
+                self._complete = payload
+                self._cond.notify_all()
+                return
+            elif name == 'gap_disconnected':
+                self.connected = False
+                self.disconnect_reason = payload['reason']
+                self._cond.notify_all()
+                return
+            else:
+                return
+        if handler is not None:
+            handler(packet)
+
+    def __procedure(self, kind: str, command: str, timeout: float, acknowledged: bool = True,
+                    **kwargs) -> list:
+        """Run a GATT procedure and wait for it to complete.
+        An unacknowledged procedure (write without response) is done once the command
+        response succeeds, the module doesn't send gattc_remote_procedure_complete for it.
+
+        Returns:
+            list: Discover results or read data received during the procedure
+        """
+        if timeout is None:
+            timeout = self.PROCEDURE_TIMEOUT_SECS
+        with self._procedure_lock:
+            with self._cond:
+                if not self.connected:
+                    raise Exception(f'{self} is disconnected')
+                self._procedure = kind
+                self._results = []
+                self._complete = None
+            try:
+                start = time.perf_counter()
+                res = self.port.send_and_wait(command, rxtimeout=timeout, clear_queue=False,
+                                              conn_handle=self.conn_handle, **kwargs)
+                if res[0] != EzSerialPort.SUCCESS:
+                    raise Exception(f'{self} {command} Result: {res}')
+                with self._cond:
+                    if not acknowledged:
+                        self._latencies.setdefault(kind, []).append(
+                            time.perf_counter() - start)
+                        return self._results
+                    if not self._cond.wait_for(
+                            lambda: self._complete is not None or not self.connected, timeout):
+                        raise Exception(f'{self} {command} did not complete')
+                    if self._complete is None:
+                        raise Exception(f'{self} disconnected during {command}')
+                    if self._complete['result'] != 0:
+                        raise Exception(
+                            f'{self} {command} failed: 0x{self._complete["result"]:04X}')
+                    self._latencies.setdefault(kind, []).append(
+                        time.perf_counter() - start)
+                    return self._results
+            finally:
+                with self._cond:
+                    self._procedure = None
+
+    def discover_services(self, begin: int = 1, end: int = 0xFFFF, timeout: float = None) -> list:
+        """
+        Returns:
+            list: gattc_discover_result payloads
+        """
+        return self.__procedure('discover', self.port.CMD_GATTC_DISCOVER_SERVICES, timeout,
+                                begin=begin, end=end)
+
+    def discover_characteristics(self, begin: int = 1, end: int = 0xFFFF, service: int = 0,
+                                 timeout: float = None) -> list:
+        """
+        Returns:
+            list: gattc_discover_result payloads
+        """
+        return self.__procedure('discover', self.port.CMD_GATTC_DISCOVER_CHARACTERISTICS,
+                                timeout, begin=begin, end=end, service=service)
+
+    def discover_descriptors(self, begin: int = 1, end: int = 0xFFFF, service: int = 0,
+                             characteristic: int = 0, timeout: float = None) -> list:
+        """
+        Returns:
+            list: gattc_discover_result payloads
+        """
+        return self.__procedure('discover', self.port.CMD_GATTC_DISCOVER_DESCRIPTORS, timeout,
+                                begin=begin, end=end, service=service,
+                                characteristic=characteristic)
+
+    def read(self, attr_handle: int, timeout: float = None) -> bytes:
+        """Read a remote attribute
+
+        Args:
+            attr_handle (int): Attribute handle
+            timeout (float, optional): Time to wait in seconds. Defaults to PROCEDURE_TIMEOUT_SECS.
+
+        Returns:
+            bytes: The value
+        """
+        data = self.__procedure('read', self.port.CMD_GATTC_READ_HANDLE, timeout,
+                                attr_handle=attr_handle)
+        return b''.join(bytes(d) for d in data)
+
+    def write(self, attr_handle: int, data: bytes, type: int = 0, timeout: float = None):
+        """Write a remote attribute
+
+        Args:
+            attr_handle (int): Attribute handle
+            data (bytes): The value
+            type (int, optional): Write type, 0 waits for the write response, other types
+              (i.e. 1 = write without response) return once the command is accepted.
+              Defaults to 0.
+            timeout (float, optional): Time to wait in seconds. Defaults to PROCEDURE_TIMEOUT_SECS.
+        """
+        self.__procedure('write' if type == self.GATTC_WRITE_TYPE_REQUEST else 'write_command',
+                         self.port.CMD_GATTC_WRITE_HANDLE, timeout,
+                         acknowledged=type == self.GATTC_WRITE_TYPE_REQUEST,
+                         attr_handle=attr_handle, type=type, data=data)
+        with self._cond:
+            self._tx_bytes += len(data)
+
+    def set_notification_handler(self, handler):
+        """Call a function for each notification or indication instead of queuing it.
+        The handler runs on the packet pump thread.
+
+        Args:
+            handler (function): Called with the gattc_data_received Packet. None to queue again.
+        """
+        with self._cond:
+            self._notification_handler = handler
+
+    def wait_notification(self, timeout: float = 1) -> object:
+        """
+        Args:
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+
+        Returns:
+            Packet: The oldest queued gattc_data_received event, None on timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._notifications) > 0, timeout):
+                return None
+            return self._notifications.popleft()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Latency statistics (ms) per procedure type, bytes written and
+              notification count, bytes and rate
+        """
+        with self._cond:
+            rx_seconds = (self._last_rx_time - self._first_rx_time
+                          if self._rx_count > 1 else 0)
+            return {'conn_handle': self.conn_handle,
+                    'address': ScanTable.address_key(self.address),
+                    'connected': self.connected,
+                    'procedures': dict((kind, latency_stats(s))
+                                       for kind, s in self._latencies.items()),
+                    'tx_bytes': self._tx_bytes,
+                    'rx_notifications': self._rx_count,
+                    'rx_bytes': self._rx_bytes,
+                    'rx_bytes_per_sec': round(self._rx_bytes / rx_seconds, 1)
+                    if rx_seconds > 0 else None}
+
+
+class ConnectionManager():
+    """Track the connections of a module and route GATT client events per connection.
+
+    The manager is opt-in: while started, gap_connected, gap_disconnected and gattc_* events
+    are consumed by the manager (they are not queued for wait_event), so stop it before using
+    keywords that wait for those events. Each connection is a GattLink.
+
+    Example:
+        with ConnectionManager(port) as manager:
+            link = manager.connect(address)
+    """
+
+    CONNECT_TIMEOUT_SECS = 10
+    ROUTED_EVENTS = ['gattc_data_received', 'gattc_discover_result',
+                     'gattc_remote_procedure_complete', 'gap_disconnected']
+    CONN_PARAMS = {'interval': 6, 'slave_latency': 0, 'supervision_timeout': 100,
+                   'scan_interval': 64, 'scan_window': 64, 'scan_timeout': 0}
+
+    def __init__(self, port: EzSerialPort, discovery_cache: DiscoveryCache = None):
+        """
+        Args:
+            port (EzSerialPort): Open port of the module
+            discovery_cache (DiscoveryCache, optional): Cache used by discover().
+              Defaults to None (a new in memory cache).
+        """
+        self.port = port
+        self.discovery_cache = discovery_cache if discovery_cache else DiscoveryCache()
+        self.conn_params = dict(self.CONN_PARAMS)
+        self._links = {}
+        self._cond = threading.Condition()
+        self._listeners = dict((event, functools.partial(self.__on_event, event))
+                               for event in self.ROUTED_EVENTS)
+        self._started = False
+
+    def __on_connected(self, packet):
+        link = GattLink(self.port, packet.payload['conn_handle'],
+                        list(packet.payload['address']))
+        with self._cond:
+            self._links[link.conn_handle] = link
+            self._cond.notify_all()
+
+    def __on_event(self, name: str, packet):
+        with self._cond:
+            link = self._links.get(packet.payload['conn_handle'])
+            if link is not None and name == 'gap_disconnected':
+                del self._links[link.conn_handle]
+                self._cond.notify_all()
+        if link is None:
+            logging.debug(f'{name} for unknown connection: {packet.payload}')
+            return
+        link._on_event(name, packet)
+
+    def start(self):
+        """Start tracking connections
+        """
+        if self._started:
+            return
+        self.port.add_event_listener(self.port.EVENT_GAP_CONNECTED, self.__on_connected)
+        for event, listener in self._listeners.items():
+            self.port.add_event_listener(event, listener)
+        self._started = True
+
+    def stop(self):
+        """Stop tracking connections. Events are queued for wait_event again.
+        """
+        if not self._started:
+            return
+        self.port.remove_event_listener(self.port.EVENT_GAP_CONNECTED, self.__on_connected)
+        for event, listener in self._listeners.items():
+            self.port.remove_event_listener(event, listener)
+        self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __check_started(self):
+        if not self._started:
+            raise Exception('ConnectionManager is not started')
+
+    @property
+    def links(self) -> list:
+        """Connected links"""
+        with self._cond:
+            return list(self._links.values())
+
+    def link(self, conn_handle: int) -> GattLink:
+        """
+        Args:
+            conn_handle (int): Connection handle
+
+        Returns:
+            GattLink: The link, None if not connected
+        """
+        with self._cond:
+            return self._links.get(conn_handle)
+
+    def wait_link(self, conn_handle: int = None, timeout: float = CONNECT_TIMEOUT_SECS) -> GattLink:
+        """Wait for a connection (i.e. from a central when advertising)
+
+        Args:
+            conn_handle (int, optional): Connection handle. Defaults to None (any new link).
+            timeout (float, optional): Time to wait in seconds. Defaults to 10.
+
+        Returns:
+            GattLink: The link, None on timeout
+        """
+        self.__check_started()
+        with self._cond:
+            known = set(self._links)
+
+            def found():
+                if conn_handle is not None:
+                    return self._links.get(conn_handle)
+                return next((l for h, l in self._links.items() if h not in known), None)
+
+            if not self._cond.wait_for(lambda: found() is not None, timeout):
+                return None
+            return found()
+
+    def connect(self, address: list, address_type: int = 0,
+                timeout: float = CONNECT_TIMEOUT_SECS) -> GattLink:
+        """Connect to a peripheral
+
+        Args:
+            address (list): Peer address
+            address_type (int, optional): Peer address type. Defaults to 0.
+            timeout (float, optional): Time to wait for the connection in seconds. Defaults to 10.
+
+        Returns:
+            GattLink: The new link
+        """
+        self.__check_started()
+        res = self.port.send_and_wait(self.port.CMD_GAP_CONNECT, clear_queue=False,
+                                      address=list(address), type=address_type,
+                                      **self.conn_params)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{self.port.CMD_GAP_CONNECT} Result: {res}')
+        link = self.wait_link(res[1].payload['conn_handle'], timeout)
+        if link is None:
+            raise Exception(f'No connection to {ScanTable.address_key(address)}')
+        return link
+
+    def disconnect(self, link: GattLink, timeout: float = CONNECT_TIMEOUT_SECS):
+        """Disconnect a link and wait for it to be closed
+
+        Args:
+            link (GattLink): The link
+            timeout (float, optional): Time to wait in seconds. Defaults to 10.
+        """
+        res = self.port.send_and_wait(self.port.CMD_GAP_DISCONNECT, clear_queue=False,
+                                      conn_handle=link.conn_handle)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{self.port.CMD_GAP_DISCONNECT} Result: {res}')
+        with link._cond:
+            if not link._cond.wait_for(lambda: not link.connected, timeout):
+                raise Exception(f'{link} not disconnected')
+
+    def discover(self, link: GattLink, use_cache: bool = True) -> dict:
+        """Discover the services, characteristics and descriptors of a peer.
+        An unchanged database is validated against the discovery cache instead.
+
+        Args:
+            link (GattLink): Connection to the peer
+            use_cache (bool, optional): False forgets the cached databases of the peer first.
+              Defaults to True.
+
+        Returns:
+            dict: See DiscoveryCache.discover()
+        """
+        if not use_cache:
+            self.discovery_cache.invalidate(link.address)
+        return self.discovery_cache.discover(link)
+
+    def run_concurrent(self, operation, links: list = None) -> dict:
+        """Run an operation on several links at the same time
+
+        Example:
+            manager.run_concurrent(lambda link: link.read(0x0003))
+
+        Args:
+            operation (function): Called with a GattLink
+            links (list, optional): GattLink objects. Defaults to all connected links.
+
+        Returns:
+            dict: Result (or the exception raised) by connection handle
+        """
+        if links is None:
+            links = self.links
+        if len(links) == 0:
+            return {}
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(links)) as executor:
+            futures = dict((link.conn_handle, executor.submit(operation, link))
+                           for link in links)
+        for conn_handle, future in futures.items():
+            try:
+                results[conn_handle] = future.result()
+            except Exception as e:
+                logging.warning(f'Connection {conn_handle}: {e}')
+                results[conn_handle] = e
+        return results
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: GattLink.stats() by connection handle
+        """
+        return dict((link.conn_handle, link.stats()) for link in self.links)
@@ -0,0 +1,164 @@
+import logging
+import time
+from EzSerialPort import EzSerialPort, GapAdvertType, GapAdvertChannels
+from lc_util import latency_stats
+
+
+class ConnectionProfiler():
+    """Time each phase of a BLE connection between a central and a peripheral module.
+
+    Phase times are measured from sending the command that starts the phase to the
+    packet pump receiving the event that ends it:
+        adv_start: gap_start_adv to gap_adv_state_changed (peripheral)
+        scan_report: gap_start_scan to the first gap_scan_result of the peripheral (central)
+        connect_response: gap_connect to its response (central)
+        connected: gap_connect to gap_connected (central)
+        peripheral_connected: gap_connect to gap_connected (peripheral)
+        discovery: gattc_discover_services to gattc_remote_procedure_complete (central)
+        first_data: gatts_notify_handle (peripheral) to gattc_data_received (central)
+        disconnect: gap_disconnect to gap_disconnected (central)
+        peripheral_disconnect: gap_disconnect to gap_disconnected (peripheral)
+    """
+
+    PHASES = ['adv_start', 'scan_report', 'connect_response', 'connected',
+              'peripheral_connected', 'discovery', 'first_data', 'disconnect',
+              'peripheral_disconnect']
+    EVENT_TIMEOUT_SECS = 10
+    ADV_PARAMS = {'mode': 0, 'type': GapAdvertType.UNDIRECTED_HIGH_DUTY_CYCLE.value,
+                  'channels': GapAdvertChannels.CHANNEL_ALL.value, 'high_interval': 32,
+                  'high_duration': 0, 'low_interval': 32, 'low_duration': 0, 'flags': 0,
+                  'directAddr': [0] * 6, 'directAddrType': 0}
+    SCAN_PARAMS = {'mode': 1, 'interval': 64, 'window': 64, 'active': 0, 'filter': 0,
+                   'nodupe': 0, 'timeout': 0}
+    CONN_PARAMS = {'interval': 6, 'slave_latency': 0, 'supervision_timeout': 100,
+                   'scan_interval': 64, 'scan_window': 64, 'scan_timeout': 0}
+
+    def __init__(self, central: EzSerialPort, peripheral: EzSerialPort, notify_handle: int = None):
+        """
+        Args:
+            central (EzSerialPort): Port of the module that scans and connects
+            peripheral (EzSerialPort): Port of the module that advertises
+            notify_handle (int, optional): Peripheral characteristic value handle used to time
+              first_data. Defaults to None (phase skipped).
+        """
+        self.central = central
+        self.peripheral = peripheral
+        self.notify_handle = notify_handle
+        self.adv_params = dict(self.ADV_PARAMS)
+        self.scan_params = dict(self.SCAN_PARAMS)
+        self.conn_params = dict(self.CONN_PARAMS)
+        self._address = None
+
+    @staticmethod
+    def __command(port: EzSerialPort, command: str, **kwargs) -> tuple:
+        """Send a command that must succeed
+
+        Returns:
+            tuple: (time sent, response packet)
+        """
+        start = time.perf_counter()
+        res = port.send_and_wait(command, clear_queue=False, **kwargs)
+        if res[0] != EzSerialPort.SUCCESS:
+            raise Exception(f'{command} Result: {res}')
+        return (start, res[1])
+
+    def __wait(self, port: EzSerialPort, event: str, predicate=None):
+        """Wait for an event that matches a condition"""
+        deadline = time.perf_counter() + self.EVENT_TIMEOUT_SECS
+        while True:
+            res = port.wait_event(event, max(0, deadline - time.perf_counter()))
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{event} not received')
+            if predicate is None or predicate(res[1].payload):
+                return res[1]
+
+    def run_cycle(self) -> dict:
+        """Advertise, scan, connect, discover, send data and disconnect once
+
+        Returns:
+            dict: Phase durations in seconds
+        """
+        c = self.central
+        p = self.peripheral
+        if self._address is None:
+            (_, packet) = ConnectionProfiler.__command(p, p.CMD_GET_BT_ADDR)
+            self._address = list(packet.payload['address'])
+        c.clear_events()
+        p.clear_events()
+        phases = {}
+        central_conn = None
+        try:
+            (start, _) = ConnectionProfiler.__command(
+                p, p.CMD_GAP_START_ADV, **self.adv_params)
+            phases['adv_start'] = self.__wait(
+                p, p.EVENT_GAP_ADV_STATE_CHANGED, lambda e: e['state'] != 0).rx_time - start
+
+            (start, _) = ConnectionProfiler.__command(
+                c, c.CMD_GAP_START_SCAN, **self.scan_params)
+            scan = self.__wait(c, c.EVENT_GAP_SCAN_RESULT,
+                               lambda e: list(e['address']) == self._address)
+            phases['scan_report'] = scan.rx_time - start
+            ConnectionProfiler.__command(c, c.CMD_GAP_STOP_SCAN)
+
+            (start, response) = ConnectionProfiler.__command(
+                c, c.CMD_GAP_CONNECT, address=self._address,
+                type=scan.payload['address_type'], **self.conn_params)
+            phases['connect_response'] = response.rx_time - start
+            event = self.__wait(c, c.EVENT_GAP_CONNECTED)
+            central_conn = event.payload['conn_handle']
+            phases['connected'] = event.rx_time - start
+            event = self.__wait(p, p.EVENT_GAP_CONNECTED)
+            peripheral_conn = event.payload['conn_handle']
+            phases['peripheral_connected'] = event.rx_time - start
+
+            (start, _) = ConnectionProfiler.__command(
+                c, c.CMD_GATTC_DISCOVER_SERVICES, conn_handle=central_conn, begin=1, end=0xFFFF)
+            phases['discovery'] = self.__wait(
+                c, c.EVENT_GATTC_REMOTE_PROCEDURE_COMPLETE,
+                lambda e: e['conn_handle'] == central_conn).rx_time - start
+
+            if self.notify_handle is not None:
+                (start, _) = ConnectionProfiler.__command(
+                    p, p.CMD_GATTS_NOTIFY_HANDLE, conn_handle=peripheral_conn,
+                    attr_handle=self.notify_handle, data=bytes(1))
+                phases['first_data'] = self.__wait(
+                    c, c.EVENT_GATTC_DATA_RECEIVED,
+                    lambda e: e['conn_handle'] == central_conn).rx_time - start
+
+            (start, _) = ConnectionProfiler.__command(
+                c, c.CMD_GAP_DISCONNECT, conn_handle=central_conn)
+            central_conn = None
+            phases['disconnect'] = self.__wait(
+                c, c.EVENT_GAP_DISCONNECTED).rx_time - start
+            phases['peripheral_disconnect'] = self.__wait(
+                p, p.EVENT_GAP_DISCONNECTED).rx_time - start
+        except Exception:
+            # Leave both modules idle for the next cycle
+            if central_conn is not None:
+                c.send_and_wait(c.CMD_GAP_DISCONNECT, conn_handle=central_conn)
+            c.send_and_wait(c.CMD_GAP_STOP_SCAN)
+            p.send_and_wait(p.CMD_GAP_STOP_ADV)
+            raise
+        return phases
+
+    def run(self, cycles: int) -> dict:
+        """Run connection cycles
+
+        Args:
+            cycles (int): Number of cycles
+
+        Returns:
+            dict: cycles, failed and the latency statistics (ms) of each phase
+        """
+        samples = dict((phase, []) for phase in self.PHASES)
+        failed = 0
+        for i in range(cycles):
+            try:
+                for phase, seconds in self.run_cycle().items():
+                    samples[phase].append(seconds)
+            except Exception as e:
+                logging.warning(f'Connection cycle {i} failed: {e}')
+                failed += 1
+        return {'cycles': cycles, 'failed': failed,
+                'phases': dict((phase, latency_stats(s)) for phase, s in samples.items()
+                               if len(s) > 0)}
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from EzScanTable import ScanTable
+
+UUID_DATABASE_HASH = 0x2B2A
+
+
+class DiscoveryCache():
+    """Cache GATT client discovery results by peer address and database fingerprint.
+
+    The fingerprint is the value of the peer's Database Hash characteristic (0x2B2A).
+    Peers without one are fingerprinted by their primary services. A cached peer is
+    validated by reading the hash (or discovering services only) instead of discovering
+    the whole database again.
+
+    Results are kept in memory and, if a path is given, in a JSON file so a rack keeps
+    them across runs.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path (str, optional): JSON file the cache is loaded from and saved to.
+              Defaults to None (memory only).
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    @staticmethod
+    def __key(address, fingerprint: str) -> str:
+        return f'{ScanTable.address_key(address)}/{fingerprint}'
+
+    @staticmethod
+    def __to_json(results: list) -> list:
+        # Connection handles change between connections
+        return [dict(((k, v) for k, v in r.items() if k != 'conn_handle'),
+                     uuid=bytes(r['uuid']).hex()) for r in results]
+
+    @staticmethod
+    def services_fingerprint(services: list) -> str:
+        """
+        Args:
+            services (list): gattc_discover_result payloads of a service discovery
+
+        Returns:
+            str: Hex digest of the service handles and UUIDs
+        """
+        h = hashlib.sha256()
+        for s in services:
+            h.update(f'{s["attr_handle"]}:{s["attr_handle_rel"]}:{bytes(s["uuid"]).hex()};'
+                     .encode())
+        return h.hexdigest()[:32]
+
+    @staticmethod
+    def hash_handle(characteristics: list) -> int:
+        """
+        Args:
+            characteristics (list): gattc_discover_result payloads of a characteristic discovery
+
+        Returns:
+            int: Value handle of the Database Hash characteristic, None if there is none
+        """
+        uuid = UUID_DATABASE_HASH.to_bytes(2, 'little')
+        for c in characteristics:
+            if bytes(c['uuid']) == uuid:
+                return c['attr_handle_rel'] if c['attr_handle_rel'] else c['attr_handle'] + 1
+        return None
+
+    def __fingerprint(self, link, hash_handle: int) -> str:
+        if hash_handle is not None:
+            return 'hash-' + link.read(hash_handle).hex()
+        return 'services-' + DiscoveryCache.services_fingerprint(link.discover_services())
+
+    def __peer_hash_handles(self, address) -> set:
+        prefix = ScanTable.address_key(address) + '/'
+        with self._lock:
+            return set(e['hash_handle'] for k, e in self._entries.items() if k.startswith(prefix))
+
+    def discover(self, link) -> dict:
+        """Discover the database of a connected peer, from the cache if it is unchanged
+
+        Args:
+            link (GattLink): Connection to the peer
+
+        Returns:
+            dict: services, characteristics and descriptors (gattc_discover_result payloads
+              with hex UUIDs), fingerprint and cached
+        """
+        # Reading a hash is cheaper than discovering services
+        for hash_handle in sorted(self.__peer_hash_handles(link.address),
+                                  key=lambda h: h is None):
+            try:
+                fingerprint = self.__fingerprint(link, hash_handle)
+            except Exception as e:
+                logging.debug(f'{link} fingerprint failed: {e}')
+                continue
+            with self._lock:
+                entry = self._entries.get(DiscoveryCache.__key(link.address, fingerprint))
+                if entry is not None:
+                    self.hits += 1
+                    return dict(entry['db'], fingerprint=fingerprint, cached=True)
+
+        with self._lock:
+            self.misses += 1
+        db = {'services': DiscoveryCache.__to_json(link.discover_services()),
+              'characteristics': DiscoveryCache.__to_json(link.discover_characteristics()),
+              'descriptors': DiscoveryCache.__to_json(link.discover_descriptors())}
+        hash_handle = DiscoveryCache.hash_handle(
+            [dict(c, uuid=bytes.fromhex(c['uuid'])) for c in db['characteristics']])
+        if hash_handle is not None:
+            fingerprint = 'hash-' + link.read(hash_handle).hex()
+        else:
+            fingerprint = 'services-' + DiscoveryCache.services_fingerprint(
+                [dict(s, uuid=bytes.fromhex(s['uuid'])) for s in db['services']])
+        with self._lock:
+            self._entries[DiscoveryCache.__key(link.address, fingerprint)] = {
+                'hash_handle': hash_handle, 'db': db}
+        self.save()
+        return dict(db, fingerprint=fingerprint, cached=False)
+
+    def invalidate(self, address=None, fingerprint: str = None):
+        """Forget cached databases. The next discovery of the peer is a full discovery.
+
+        Args:
+            address (optional): Peer address (str or list). Defaults to None (all peers).
+            fingerprint (str, optional): Only this database of the peer. Defaults to None.
+        """
+        with self._lock:
+            if address is None:
+                self._entries = {}
+            elif fingerprint is not None:
+                self._entries.pop(DiscoveryCache.__key(address, fingerprint), None)
+            else:
+                prefix = ScanTable.address_key(address) + '/'
+                self._entries = dict((k, e) for k, e in self._entries.items()
+                                     if not k.startswith(prefix))
+        self.save()
+
+    def entries(self) -> list:
+        """
+        Returns:
+            list: (address, fingerprint) of the cached databases
+        """
+        with self._lock:
+            return [tuple(k.split('/', 1)) for k in self._entries]
+
+    def save(self):
+        """Write the cache to its file (if it has one)
+        """
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path, 'w') as f:
+                json.dump(self._entries, f)
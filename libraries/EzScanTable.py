@@ -0,0 +1,211 @@
+import statistics
+import threading
+import time
+from collections import deque
+
+
+class ScanEntry():
+    """Aggregated scan results of one advertiser"""
+
+    def __init__(self, address: str, rssi_window: int):
+        self.address = address
+        self.address_type = None
+        self.result_type = None
+        self.count = 0
+        self.rssi = None
+        self.rssi_min = None
+        self.rssi_max = None
+        self.rssi_total = 0
+        self.recent_rssi = deque(maxlen=rssi_window)
+        self.data = b''
+        self.first_seen = None
+        self.last_seen = None
+
+    @property
+    def rssi_mean(self) -> float:
+        """Mean RSSI of all results"""
+        return self.rssi_total / self.count if self.count else None
+
+    @property
+    def rssi_spread(self) -> int:
+        """Difference between the highest and lowest of the recent RSSI values"""
+        if len(self.recent_rssi) == 0:
+            return None
+        return max(self.recent_rssi) - min(self.recent_rssi)
+
+    @property
+    def rssi_stdev(self) -> float:
+        """Standard deviation of the recent RSSI values"""
+        if len(self.recent_rssi) < 2:
+            return None
+        return statistics.stdev(self.recent_rssi)
+
+    def to_dict(self) -> dict:
+        return {'address': self.address, 'address_type': self.address_type,
+                'count': self.count, 'rssi': self.rssi, 'rssi_min': self.rssi_min,
+                'rssi_max': self.rssi_max, 'rssi_mean': self.rssi_mean,
+                'rssi_spread': self.rssi_spread, 'data': self.data.hex()}
+
+    def __repr__(self):
+        return f'ScanEntry({self.to_dict()})'
+
+
+class ScanTable():
+    """Table of scan results keyed by advertiser address.
+
+    update() is an EzSerialPort event listener for gap_scan_result, so results are
+    aggregated in the background while tests do other work.
+    Addresses are hex strings, most significant byte first (i.e. 'c0a1b2c3d4e5').
+    """
+
+    RSSI_WINDOW_DEFAULT = 10
+
+    def __init__(self, rssi_window: int = RSSI_WINDOW_DEFAULT):
+        """
+        Args:
+            rssi_window (int, optional): Number of recent RSSI values kept per advertiser.
+              Defaults to 10.
+        """
+        self.rssi_window = rssi_window
+        self.results = 0
+        self._entries = {}
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def address_key(address) -> str:
+        """Normalize an address
+
+        Args:
+            address (str | list | bytes): Hex string (':' separators allowed) or the
+              little endian bytes of a scan result packet
+
+        Returns:
+            str: Lower case hex string, most significant byte first
+        """
+        if isinstance(address, str):
+            return address.replace(':', '').lower()
+        return bytes(reversed(bytes(address))).hex()
+
+    def update(self, packet):
+        """Add a gap_scan_result event
+
+        Args:
+            packet (Packet): The event
+        """
+        payload = packet.payload
+        address = ScanTable.address_key(payload['address'])
+        rssi = payload['rssi']
+        rx_time = getattr(packet, 'rx_time', None) or time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None:
+                entry = ScanEntry(address, self.rssi_window)
+                entry.first_seen = rx_time
+                self._entries[address] = entry
+            entry.address_type = payload['address_type']
+            entry.result_type = payload['result_type']
+            entry.count += 1
+            entry.rssi = rssi
+            entry.rssi_total += rssi
+            entry.rssi_min = rssi if entry.rssi_min is None else min(
+                entry.rssi_min, rssi)
+            entry.rssi_max = rssi if entry.rssi_max is None else max(
+                entry.rssi_max, rssi)
+            entry.recent_rssi.append(rssi)
+            entry.data = bytes(payload['data'])
+            entry.last_seen = rx_time
+            self.results += 1
+            self._lock.notify_all()
+
+    def clear(self):
+        """Forget all advertisers
+        """
+        with self._lock:
+            self._entries.clear()
+            self.results = 0
+
+    def get(self, address) -> ScanEntry:
+        """
+        Args:
+            address (str | list | bytes): Advertiser address
+
+        Returns:
+            ScanEntry: The advertiser, None if it has not been seen
+        """
+        with self._lock:
+            return self._entries.get(ScanTable.address_key(address))
+
+    def entries(self) -> list:
+        """
+        Returns:
+            list: All ScanEntry objects, strongest (mean RSSI) first
+        """
+        with self._lock:
+            return sorted(self._entries.values(), key=lambda e: e.rssi_mean, reverse=True)
+
+    def wait_for(self, predicate, timeout: float = 1) -> ScanEntry:
+        """Wait until an advertiser matches a condition
+
+        Args:
+            predicate (function): Called with a ScanEntry, returns True when it matches
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+
+        Returns:
+            ScanEntry: The first matching advertiser, None on timeout
+        """
+        found = None
+
+        def match():
+            nonlocal found
+            for entry in self._entries.values():
+                if predicate(entry):
+                    found = entry
+                    return True
+            return False
+
+        with self._lock:
+            self._lock.wait_for(match, timeout)
+            return found
+
+    def wait_seen(self, address, count: int = 1, timeout: float = 1) -> ScanEntry:
+        """Wait until an advertiser has been seen a number of times
+
+        Args:
+            address (str | list | bytes): Advertiser address
+            count (int, optional): Number of scan results. Defaults to 1.
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+
+        Returns:
+            ScanEntry: The advertiser, None on timeout
+        """
+        key = ScanTable.address_key(address)
+        return self.wait_for(lambda e: e.address == key and e.count >= count, timeout)
+
+    def wait_rssi_stable(self, address, tolerance: int = 3, samples: int = None,
+                         timeout: float = 5) -> ScanEntry:
+        """Wait until the RSSI of an advertiser stays within a tolerance
+
+        Args:
+            address (str | list | bytes): Advertiser address
+            tolerance (int, optional): Maximum spread of the recent RSSI values in dB. Defaults to 3.
+            samples (int, optional): Number of recent values that must be within the tolerance.
+              Defaults to the RSSI window.
+            timeout (float, optional): Time to wait in seconds. Defaults to 5.
+
+        Returns:
+            ScanEntry: The advertiser, None on timeout
+        """
+        key = ScanTable.address_key(address)
+        if samples is None:
+            samples = self.rssi_window
+        if samples > self.rssi_window:
+            raise ValueError(
+                f'samples must not be larger than the RSSI window ({self.rssi_window})')
+
+        def stable(entry):
+            if entry.address != key or len(entry.recent_rssi) < samples:
+                return False
+            recent = list(entry.recent_rssi)[-samples:]
+            return max(recent) - min(recent) <= tolerance
+
+        return self.wait_for(stable, timeout)
@@ -1,5 +1,13 @@
+import logging
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
 from enum import Enum
 from SerialPort import SerialPort
+from EzScanTable import ScanTable
 import ezserial_host_api.ezslib as ez_serial
 
 
@@ -140,6 +148,15 @@ class CYSPPCommands:
 
 
 class SmpCommands:
+    @property
+    def CMD_SMP_QUERY_BONDS(self): return "smp_query_bonds"
+
+    @property
+    def CMD_SMP_DELETE_BOND(self): return "smp_delete_bond"
+
+    @property
+    def CMD_SMP_PAIR(self): return "smp_pair"
+
     @property
     def EVENT_SMP_BOND_ENTRY(self): return "smp_bond_entry"
     @property
@@ -178,6 +195,10 @@ class GapCommands:
     @property
     def EVENT_GAP_CONNECTED(self): return "gap_connected"
     @property
+    def CMD_GAP_DISCONNECT(self): return "gap_disconnect"
+    @property
+    def EVENT_GAP_DISCONNECTED(self): return "gap_disconnected"
+    @property
     def EVENT_GAP_CONNECTION_UPDATED(self): return "gap_connection_updated"
     @property
     def EVENT_GAP_ADV_STATE_CHANGED(self): return "gap_adv_state_changed"
@@ -189,6 +210,8 @@ class GattServerCommands:
     @property
     def CMD_GATTS_CREATE_ATTR(self): return "gatts_create_attr"
     @property
+    def CMD_GATTS_DELETE_ATTR(self): return "gatts_delete_attr"
+    @property
     def CMD_GATTS_WRITE_HANDLE(self): return "gatts_write_handle"
     @property
     def CMD_GATTS_NOTIFY_HANDLE(self): return "gatts_notify_handle"
@@ -197,6 +220,16 @@ class GattServerCommands:
 
 
 class GattClientCommands:
+    @property
+    def CMD_GATTC_DISCOVER_SERVICES(self): return "gattc_discover_services"
+    @property
+    def CMD_GATTC_DISCOVER_CHARACTERISTICS(
+        self): return "gattc_discover_characteristics"
+
+    @property
+    def CMD_GATTC_DISCOVER_DESCRIPTORS(
+        self): return "gattc_discover_descriptors"
+
     @property
     def CMD_GATTC_READ_HANDLE(self): return "gattc_read_handle"
     @property
@@ -299,7 +332,11 @@ class EzSerialApiMode(Enum):
 class EzSerialPort(SerialPort, SystemCommands, BluetoothCommands,
                    SmpCommands, GapCommands, GattServerCommands,
                    GattClientCommands, GpioCommands, CYSPPCommands):
-    """Serial port implementation to communicate with EZ-Serial devices
+    """Serial port implementation to communicate with EZ-Serial devices.
+
+    A packet pump thread decodes received bytes as soon as they arrive.
+    Responses are matched to outstanding commands by (group, method) in send order
+    and events are placed in bounded per-event queues that wait_event consumes.
     """
     ROBOT_LIBRARY_SCOPE = 'TEST SUITE'
 
@@ -307,46 +344,253 @@ class EzSerialPort(SerialPort, SystemCommands, BluetoothCommands,
     ERROR_NO_RESPONSE = -1
     ERROR_RESPONSE = -2
     IF820_DEFAULT_BAUD = 115200
+    EVENT_QUEUE_DEPTH = 256
+    EVENT_HISTORY_DEPTH = 64
+    PACKET_PUMP_IDLE_TIMEOUT_SECS = 0.1
+    COMMAND_WINDOW_DEFAULT = 4
+    UART_BAUD_PING_ATTEMPTS = 3
+    UART_BAUD_PING_TIMEOUT_SECS = 0.2
+    AUTOBAUD_PING_ATTEMPTS = 2
+    AUTOBAUD_PING_TIMEOUT_SECS = 0.05
+    BLOB_RETRY_BACKOFF_SECS = 0.005
+    BLOB_MAX_RETRIES = 100
+    BLOB_CHUNK_HEADER = struct.Struct('<I')
 
     def __init__(self):
         super().__init__()
         self.ez = None
+        self._pump_thread = None
+        self._packet_lock = threading.Condition()
+        self._event_queues = {}
+        self._event_history = {}
+        self._pending = deque()
+        self._command_window = EzSerialPort.COMMAND_WINDOW_DEFAULT
+        self._rx_time = 0
+        self._expected_echo = bytearray()
+        self._event_listeners = {}
+        self._raw_data_handler = None
+        self._scan_table = None
 
     def __write_bytes(self, bytes: bytes):
         res = self.send(bytes)
         return (bytes, res)
 
-    def __read_bytes(self, rxtimeout):
-        res = self.ez.EZS_INPUT_RESULT_NO_DATA
-        byte = None
-        block = True
-        if rxtimeout == None or rxtimeout == 0:
-            block = False
-        try:
-            bytes_available = len(self._rx_queue)
-            if block and bytes_available == 0:
-                if not self.wait_for_bytes_received(rxtimeout):
-                    return (byte, res)
-            byte = self._rx_queue.pop(0)
-            if len(self._rx_queue) == 0:
-                self.signal_bytes_received()
-            res = self.ez.EZS_INPUT_RESULT_BYTE_READ
-        except IndexError:
-            pass
-        return (byte, res)
+    def __packet_pump(self):
+        while not self._stop_threads:
+            if not self.wait_for_bytes_received(self.PACKET_PUMP_IDLE_TIMEOUT_SECS):
+                continue
+            self.signal_bytes_received()
+            num_bytes = len(self._rx_queue)
+            if num_bytes == 0:
+                continue
+            rx_bytes = self._rx_queue[:num_bytes]
+            del self._rx_queue[:num_bytes]
+            self._rx_time = time.perf_counter()
+            if self._raw_data_handler:
+                # CYSPP data mode, received bytes are not EZ-Serial packets
+                self._raw_data_handler(bytes(rx_bytes))
+                continue
+            if len(self._expected_echo) > 0 and not (self.ez.inTextPacket or self.ez.inBinaryPacket):
+                rx_bytes = self.__consume_echo(rx_bytes)
+            while len(rx_bytes) > 0:
+                try:
+                    self.ez.parseBytes(rx_bytes)
+                    break
+                except Exception as e:
+                    logging.warning(f'[{self._port.name}] RX parse error: {e}')
+                    rx_bytes = rx_bytes[self.ez.rxChunkIndex + 1:]
+                    self.ez.reset()
+
+    def __consume_echo(self, rx_bytes: list) -> list:
+        """Strip the echo of text mode commands from the start of received bytes.
+        The whole chunk is compared at once instead of byte by byte.
+        """
+        with self._packet_lock:
+            echo_len = min(len(self._expected_echo), len(rx_bytes))
+            if bytes(rx_bytes[:echo_len]) == self._expected_echo[:echo_len]:
+                del self._expected_echo[:echo_len]
+                return rx_bytes[echo_len:]
+            logging.debug(
+                f'[{self._port.name}] Echo not received: {bytes(self._expected_echo)}')
+            self._expected_echo.clear()
+        return rx_bytes
+
+    def __route_packet(self, packet: ez_serial.Packet):
+        packet.rx_time = self._rx_time
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'[{self._port.name}] RX: {packet}')
+        listeners = []
+        with self._packet_lock:
+            if packet.type == ez_serial.Packet.EZS_PACKET_TYPE_RESPONSE:
+                for pending in self._pending:
+                    if pending[0] is packet.entry:
+                        self._pending.remove(pending)
+                        pending[1].set_result(
+                            EzSerialPort.__result_from_packet(packet))
+                        break
+                else:
+                    logging.debug(
+                        f'[{self._port.name}] Unexpected response {packet}')
+            else:
+                # An error event is the module's answer to the oldest command it could not process
+                if packet.entry['name'] == 'error' and len(self._pending) > 0:
+                    self._pending.popleft()[1].set_result(
+                        (EzSerialPort.ERROR_RESPONSE, None))
+                key = (packet.group, packet.method)
+                if key not in self._event_queues:
+                    self._event_queues[key] = deque(
+                        maxlen=self.EVENT_QUEUE_DEPTH)
+                    self._event_history[key] = deque(
+                        maxlen=self.EVENT_HISTORY_DEPTH)
+                listeners = self._event_listeners.get(key, [])
+                if len(listeners) == 0:
+                    self._event_queues[key].append(packet)
+                self._event_history[key].append(packet)
+            self._packet_lock.notify_all()
+        for listener in listeners:
+            listener(packet)
+
+    @staticmethod
+    def __result_from_packet(packet: ez_serial.Packet) -> tuple:
+        error = packet.payload.get('error', None)
+        result = packet.payload.get('result', None)
+        if error:
+            return (EzSerialPort.ERROR_RESPONSE, None)
+        elif result:
+            return (result, packet)
+        else:
+            return (EzSerialPort.SUCCESS, packet)
+
+    def __expire_pending(self, future: Future):
+        """Stop waiting for the response of a command. Lock must be held."""
+        for pending in self._pending:
+            if pending[1] is future:
+                self._pending.remove(pending)
+                future.set_result((EzSerialPort.ERROR_NO_RESPONSE, None))
+                break
+
+    def __event_key(self, event: str) -> tuple:
+        entry = ez_serial.Protocol.getEventByName(event)
+        return (entry['group'], entry['method'])
 
     def open(self, portName: str, baud: int, ctsrts: bool = False):
-        """Open the serial port and init the EZ-Serial API
+        """Open the serial port, init the EZ-Serial API and start the packet pump
 
         Args:
             portName (str): COM port name or device
             baud (int): baud rate
             ctsrts (bool, optional): Use CTS/RTS flow control. Defaults to False.
         """
+        if self._port and self._port.is_open:
+            return
 
         self.ez = ez_serial.API(hardwareOutput=self.__write_bytes,
-                                hardwareInput=self.__read_bytes)
+                                rxPacketHandler=self.__route_packet)
+        self.clear_events()
         super().open(portName, baud, ctsrts)
+        # The packet pump decodes all received bytes and routes responses and events
+        self._pump_thread = threading.Thread(target=self.__packet_pump,
+                                             daemon=True)
+        self._pump_thread.start()
+
+    def close(self):
+        """Close the serial port and stop all threads
+        """
+        super().close()
+        if self._pump_thread:
+            self._pump_thread.join()
+
+    def set_baudrate(self, baud: int):
+        """Change the host baud rate without closing the port.
+        Use change_uart_baud to change the module baud rate as well.
+
+        Args:
+            baud (int): baud rate
+        """
+        super().set_baudrate(baud)
+        with self._packet_lock:
+            self._expected_echo.clear()
+        self.ez.reset()
+
+    def ping(self, attempts: int = 1, rxtimeout: float = 1) -> bool:
+        """Check that the module responds
+
+        Args:
+            attempts (int, optional): Number of pings to try. Defaults to 1.
+            rxtimeout (float, optional): Time to wait for each response (in seconds). Defaults to 1.
+
+        Returns:
+            bool: True if a ping was answered
+        """
+        for _ in range(attempts):
+            if self.send_and_wait(self.CMD_PING, rxtimeout=rxtimeout, clear_queue=False)[0] == \
+                    EzSerialPort.SUCCESS:
+                return True
+        return False
+
+    def change_uart_baud(self, baud: int) -> bool:
+        """Change the module and host baud rate without reopening the port.
+        The module setting is not stored (it boots at the previous rate).
+        The new rate is confirmed with a ping. If the module can't be reached at the new rate
+        the host goes back to the previous rate.
+
+        Args:
+            baud (int): baud rate
+
+        Returns:
+            bool: True if the module answers at the new rate
+        """
+        old_baud = self._port.baudrate
+        if baud == old_baud:
+            return True
+        res = self.send_and_wait(self.CMD_SET_UART_PARAMS, clear_queue=False,
+                                 baud=baud, autobaud=0, autocorrect=0,
+                                 flow=1 if self._port.rtscts else 0,
+                                 databits=8, parity=0, stopbits=1)
+        if res[0] != EzSerialPort.SUCCESS:
+            logging.warning(
+                f'[{self._port.name}] Baud rate {baud} rejected: {res}')
+            return False
+        # The module switches after sending the response
+        self.set_baudrate(baud)
+        if self.ping(self.UART_BAUD_PING_ATTEMPTS, self.UART_BAUD_PING_TIMEOUT_SECS):
+            logging.info(f'[{self._port.name}] Baud rate {baud}')
+            return True
+        logging.warning(
+            f'[{self._port.name}] No response at {baud}, fall back to {old_baud}')
+        self.set_baudrate(old_baud)
+        if not self.ping(self.UART_BAUD_PING_ATTEMPTS, self.UART_BAUD_PING_TIMEOUT_SECS):
+            logging.error(
+                f'[{self._port.name}] No response at {baud} or {old_baud}')
+        return False
+
+    def detect_baud(self, rates: list, attempts: int = AUTOBAUD_PING_ATTEMPTS,
+                    rxtimeout: float = AUTOBAUD_PING_TIMEOUT_SECS) -> int | None:
+        """Find the baud rate of the module without reopening the port.
+        Each rate is tried with a ping (in the given order, so put the most likely rate first).
+        The host stays at the rate that was answered.
+
+        Args:
+            rates (list): Baud rates to try
+            attempts (int, optional): Pings per rate. The first one can be lost to bytes the
+              module received at a wrong rate. Defaults to 2.
+            rxtimeout (float, optional): Time to wait for each response in seconds.
+              Defaults to 0.05.
+
+        Returns:
+            int | None: The baud rate of the module, None if no rate was answered
+              (the host goes back to the rate it was at)
+        """
+        old_baud = self._port.baudrate
+        for baud in rates:
+            if baud != self._port.baudrate:
+                self.set_baudrate(baud)
+            if self.ping(attempts, rxtimeout):
+                logging.info(f'[{self._port.name}] Detected baud rate {baud}')
+                return baud
+            logging.debug(f'[{self._port.name}] No response at {baud}')
+        self.set_baudrate(old_baud)
+        return None
 
     def send_and_wait(self, command: str, apiformat: int = None, rxtimeout: int = 1, clear_queue: bool = True, **kwargs) -> tuple:
         """Send command and wait for a response
@@ -354,32 +598,286 @@ class EzSerialPort(SerialPort, SystemCommands, BluetoothCommands,
         Args:
             command (str): Command to send
             apiformat (int, optional): API format to use 0=text, 1=binary. Defaults to None.
-            rxtimeout (int, optional): Time to wait for response (in seconds). Defaults to False (Receive immediately).
-            clear_queue (bool, optional): Clear the RX queue before sending. Defaults to True.
+            rxtimeout (int, optional): Time to wait for response (in seconds). Defaults to 1.
+            clear_queue (bool, optional): Discard queued events before sending. Discarded events
+              remain in the event history. Defaults to True.
 
         Returns:
             tuple: (err code - 0 for success else error, Packet object)
         """
-        self.pause_queue_monitor()
         if clear_queue:
-            self.clear_rx_queue()
-        res = self.ez.sendAndWait(
-            command=command, apiformat=apiformat, rxtimeout=rxtimeout, **kwargs)
-        if res[0] == None:
-            self.resume_queue_monitor()
-            return (EzSerialPort.ERROR_NO_RESPONSE, None)
-        else:
-            error = res[0].payload.get('error', None)
-            result = res[0].payload.get('result', None)
-            if error:
-                self.resume_queue_monitor()
-                return (EzSerialPort.ERROR_RESPONSE, None)
-            elif result:
-                self.resume_queue_monitor()
-                return (result, res[0])
-            else:
-                self.resume_queue_monitor()
-                return (EzSerialPort.SUCCESS, res[0])
+            self.clear_events()
+        future = self.send_async(command, apiformat, rxtimeout, **kwargs)
+        return self.wait_result(future, rxtimeout)
+
+    def send_async(self, command: str, apiformat: int = None, rxtimeout: int = 1, **kwargs) -> Future:
+        """Send command without waiting for its response.
+        If the command window is full, wait for an outstanding command to complete first.
+        The oldest outstanding command is given up on if none complete within rxtimeout.
+
+        Args:
+            command (str): Command to send
+            apiformat (int, optional): API format to use 0=text, 1=binary. Defaults to None.
+            rxtimeout (int, optional): Time to wait for room in the command window (in seconds).
+              Defaults to 1.
+
+        Returns:
+            Future: Resolves to the send_and_wait result tuple (err code, Packet object)
+        """
+        entry = ez_serial.Protocol.getCommandByName(command)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._packet_lock:
+            if not self._packet_lock.wait_for(
+                    lambda: len(self._pending) < self._command_window, rxtimeout):
+                logging.warning(
+                    f'[{self._port.name}] No response to {self._pending[0][0]["name"]}')
+                self.__expire_pending(self._pending[0][1])
+            self._pending.append((entry, future))
+        try:
+            self.send_cmd(command, apiformat, **kwargs)
+        except Exception:
+            with self._packet_lock:
+                self._pending.remove((entry, future))
+            raise
+        return future
+
+    def wait_result(self, future: Future, rxtimeout: int = 1) -> tuple:
+        """Wait for the response of a command sent with send_async.
+        If no response is received the command is no longer outstanding.
+
+        Args:
+            future (Future): Future returned by send_async
+            rxtimeout (int, optional): Time to wait for response (in seconds). Defaults to 1.
+
+        Returns:
+            tuple: (err code - 0 for success else error, Packet object)
+        """
+        with self._packet_lock:
+            if not self._packet_lock.wait_for(future.done, rxtimeout):
+                self.__expire_pending(future)
+        return future.result()
+
+    def send_pipelined(self, commands: list, apiformat: int = None, rxtimeout: int = 1) -> list:
+        """Send a sequence of commands keeping up to the command window outstanding.
+
+        Args:
+            commands (list): (command, kwargs dict) tuples
+            apiformat (int, optional): API format to use 0=text, 1=binary. Defaults to None.
+            rxtimeout (int, optional): Time to wait for each response (in seconds). Defaults to 1.
+
+        Returns:
+            list: send_and_wait result tuples in the same order as commands
+        """
+        futures = []
+        for command, kwargs in commands:
+            futures.append(self.send_async(
+                command, apiformat, rxtimeout, **kwargs))
+        return [self.wait_result(f, rxtimeout) for f in futures]
+
+    def set_command_window(self, window: int):
+        """Set the maximum number of commands that can be outstanding at once
+
+        Args:
+            window (int): Number of commands (1 sends strictly one at a time)
+        """
+        if window < 1:
+            raise ValueError('Command window must be at least 1')
+        with self._packet_lock:
+            self._command_window = window
+            self._packet_lock.notify_all()
+
+    @staticmethod
+    def max_length(command: str, argument: str) -> int:
+        """
+        Args:
+            command (str): Command name
+            argument (str): Array argument of the command, or the argument that gives the
+              length of returned data (i.e. length of read_user_data)
+
+        Returns:
+            int: Maximum length (or value) of the argument the protocol allows
+        """
+        entry = ez_serial.Protocol.getCommandByName(command)
+        param = next(p for p in entry['parameters'] if p['name'] == argument)
+        return param['maxlength'] if 'maxlength' in param else param['maximum']
+
+    def send_windowed(self, commands, rxtimeout: float = 1, window: int = None,
+                      max_retries: int = BLOB_MAX_RETRIES,
+                      backoff: float = BLOB_RETRY_BACKOFF_SECS, on_failure=None) -> int:
+        """Send commands keeping up to window of them outstanding. A command the module
+        rejects (i.e. out of buffers) is sent again after a backoff, so the commands must not
+        depend on their order.
+
+        Args:
+            commands: (command, kwargs dict) tuples. An iterator is consumed as the window
+              allows, so payloads can be built (i.e. timestamped) right before they are sent.
+            rxtimeout (float, optional): Time to wait for each response in seconds. Defaults to 1.
+            window (int, optional): Maximum outstanding commands. Defaults to the command window.
+            max_retries (int, optional): Retries allowed for all commands together.
+              Defaults to 100.
+            backoff (float, optional): Time to wait before sending a command again in seconds.
+              Defaults to 0.005.
+            on_failure (function, optional): Called with (command, kwargs, result) for a command
+              that got no response or is out of retries. Defaults to None (raise an exception).
+
+        Returns:
+            int: Number of commands sent again
+        """
+        if window is None:
+            window = self._command_window
+        outstanding = deque()
+        retries = 0
+
+        def send(command, kwargs):
+            outstanding.append((command, kwargs, self.send_async(
+                command, rxtimeout=rxtimeout, **kwargs)))
+
+        def complete_oldest():
+            nonlocal retries
+            (command, kwargs, future) = outstanding.popleft()
+            res = self.wait_result(future, rxtimeout)
+            if res[0] == EzSerialPort.SUCCESS:
+                return
+            if res[0] == EzSerialPort.ERROR_NO_RESPONSE or retries >= max_retries:
+                if on_failure is None:
+                    raise Exception(f'{command} failed: {res[0]} {res[1]}')
+                on_failure(command, kwargs, res)
+                return
+            retries += 1
+            time.sleep(backoff)
+            send(command, kwargs)
+
+        for command, kwargs in commands:
+            while len(outstanding) >= window:
+                complete_oldest()
+            send(command, kwargs)
+        while len(outstanding) > 0:
+            complete_oldest()
+        return retries
+
+    def read_user_data_blob(self, offset: int, length: int, rxtimeout: float = 1) -> bytes:
+        """Read user data in pipelined chunks of the maximum length
+
+        Args:
+            offset (int): Start offset
+            length (int): Number of bytes
+            rxtimeout (float, optional): Time to wait for each response in seconds. Defaults to 1.
+
+        Returns:
+            bytes: The data
+        """
+        chunk = EzSerialPort.max_length(self.CMD_READ_USER_DATA, 'length')
+        commands = [(self.CMD_READ_USER_DATA,
+                     {'offset': o, 'length': min(chunk, offset + length - o)})
+                    for o in range(offset, offset + length, chunk)]
+        results = self.send_pipelined(commands, rxtimeout=rxtimeout)
+        data = bytearray()
+        for (command, kwargs), res in zip(commands, results):
+            if res[0] != EzSerialPort.SUCCESS:
+                raise Exception(f'{command} at {kwargs["offset"]} failed: {res}')
+            data.extend(res[1].payload['data'])
+        return bytes(data)
+
+    def write_user_data_blob(self, data: bytes, offset: int = 0, verify: bool = True,
+                             rxtimeout: float = 1) -> dict:
+        """Write user data in chunks of the maximum length, keeping the command window full.
+        The data is read back and compared by CRC-32.
+
+        Args:
+            data (bytes): The data
+            offset (int, optional): Start offset. Defaults to 0.
+            verify (bool, optional): Read the data back. Defaults to True.
+            rxtimeout (float, optional): Time to wait for each response in seconds. Defaults to 1.
+
+        Returns:
+            dict: bytes, chunks, retries, seconds, bytes_per_sec (of the write), crc32 and verified
+        """
+        chunk = EzSerialPort.max_length(self.CMD_WRITE_USER_DATA, 'data')
+        start = time.perf_counter()
+        commands = [(self.CMD_WRITE_USER_DATA,
+                     {'offset': offset + i, 'data': data[i:i + chunk]})
+                    for i in range(0, len(data), chunk)]
+        retries = self.send_windowed(commands, rxtimeout)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        crc = zlib.crc32(data)
+        verified = None
+        if verify:
+            verified = zlib.crc32(self.read_user_data_blob(offset, len(data), rxtimeout)) == crc
+        return {'bytes': len(data), 'chunks': len(commands), 'retries': retries,
+                'seconds': round(elapsed, 4), 'bytes_per_sec': round(len(data) / elapsed, 1),
+                'crc32': crc, 'verified': verified}
+
+    def write_gatt_blob(self, conn_handle: int, attr_handle: int, data: bytes,
+                        chunk_size: int = None, write_type: int = 0,
+                        receiver: 'EzSerialPort' = None, rx_attr_handle: int = None,
+                        rxtimeout: float = 1) -> dict:
+        """Stream data to a remote characteristic as a sequence of gattc_write_handle commands,
+        keeping the command window full. Each chunk starts with its offset (uint32) so the
+        receiver can reassemble chunks that were sent again.
+
+        Args:
+            conn_handle (int): Connection handle
+            attr_handle (int): Remote characteristic value handle
+            data (bytes): The data
+            chunk_size (int, optional): Bytes per write including the 4 byte offset. Must fit the
+              write type (i.e. MTU - 3 for writes without response).
+              Defaults to the protocol maximum.
+            write_type (int, optional): gattc_write_handle type. Defaults to 0.
+            receiver (EzSerialPort, optional): Port of the peer module. Its gatts_data_written
+              events are reassembled and compared by CRC-32. Defaults to None.
+            rx_attr_handle (int, optional): Handle the receiver reports writes on.
+              Defaults to attr_handle.
+            rxtimeout (float, optional): Time to wait for each response and for the receiver
+              in seconds. Defaults to 1.
+
+        Returns:
+            dict: bytes, chunks, retries, seconds, bytes_per_sec, crc32 and verified
+              (None without a receiver)
+        """
+        if chunk_size is None:
+            chunk_size = EzSerialPort.max_length(self.CMD_GATTC_WRITE_HANDLE, 'data')
+        payload_size = chunk_size - self.BLOB_CHUNK_HEADER.size
+        if payload_size < 1:
+            raise ValueError(f'Chunk size must be more than {self.BLOB_CHUNK_HEADER.size} bytes')
+        if rx_attr_handle is None:
+            rx_attr_handle = attr_handle
+        received = bytearray(len(data))
+        missing = set(range(0, len(data), payload_size))
+        done = threading.Condition()
+
+        def on_written(packet):
+            if packet.payload['attr_handle'] != rx_attr_handle:
+                return
+            chunk = bytes(packet.payload['data'])
+            (offset,) = self.BLOB_CHUNK_HEADER.unpack_from(chunk)
+            body = chunk[self.BLOB_CHUNK_HEADER.size:]
+            with done:
+                received[offset:offset + len(body)] = body
+                missing.discard(offset)
+                done.notify_all()
+
+        commands = [(self.CMD_GATTC_WRITE_HANDLE,
+                     {'conn_handle': conn_handle, 'attr_handle': attr_handle, 'type': write_type,
+                      'data': self.BLOB_CHUNK_HEADER.pack(i) + data[i:i + payload_size]})
+                    for i in range(0, len(data), payload_size)]
+        if receiver:
+            receiver.add_event_listener(receiver.EVENT_GATTS_DATA_WRITTEN, on_written)
+        try:
+            start = time.perf_counter()
+            retries = self.send_windowed(commands, rxtimeout)
+            verified = None
+            if receiver:
+                with done:
+                    done.wait_for(lambda: len(missing) == 0, rxtimeout)
+                    verified = len(missing) == 0 and zlib.crc32(received) == zlib.crc32(data)
+            elapsed = max(time.perf_counter() - start, 1e-9)
+        finally:
+            if receiver:
+                receiver.remove_event_listener(receiver.EVENT_GATTS_DATA_WRITTEN, on_written)
+        return {'bytes': len(data), 'chunks': len(commands), 'retries': retries,
+                'seconds': round(elapsed, 4), 'bytes_per_sec': round(len(data) / elapsed, 1),
+                'crc32': zlib.crc32(data), 'verified': verified}
 
     def send_cmd(self, command: str, apiformat: int = None, **kwargs):
         """Send command and don't wait for a response
@@ -391,26 +889,176 @@ class EzSerialPort(SerialPort, SystemCommands, BluetoothCommands,
         Returns:
             none
             """
-        self.ez.sendCommand(command=command, apiformat=apiformat, **kwargs)
+        memscope = kwargs.pop('memscope', None)
+        if memscope is None:
+            memscope = self.ez.defaults.memscope
+        if apiformat is None:
+            apiformat = self.ez.defaults.apiformat
+        packet = ez_serial.Packet(command, memscope, **kwargs)
+        if apiformat == ez_serial.Packet.EZS_API_FORMAT_TEXT and self.ez.defaults.consumeecho:
+            with self._packet_lock:
+                self._expected_echo.extend(
+                    bytearray(packet.textString, 'utf-8'))
+        self.ez.sendPacket(packet, apiformat)
 
     def wait_event(self, event: str, rxtimeout: int = 1) -> tuple:
-        """Wait for an event to be received
+        """Wait for an event to be received.
+        Events that were received before this call are returned immediately (oldest first).
 
         Args:
             event (str): The event to wait for
-            rxtimeout (int, optional): Time to wait for the event. Defaults to False (Don't wait).
+            rxtimeout (int, optional): Time to wait for the event in seconds. None waits forever,
+              0 doesn't wait. Defaults to 1.
 
         Returns:
             tuple: (err code - 0 for success else error, Packet object)
         """
-        self.pause_queue_monitor()
-        res = self.ez.waitEvent(event, rxtimeout)
-        if res[0] == None:
-            self.resume_queue_monitor()
-            return (-1, None)
-        else:
-            self.resume_queue_monitor()
-            return (0, res[0])
+        key = self.__event_key(event)
+        with self._packet_lock:
+            if key not in self._event_queues:
+                self._event_queues[key] = deque(maxlen=self.EVENT_QUEUE_DEPTH)
+                self._event_history[key] = deque(
+                    maxlen=self.EVENT_HISTORY_DEPTH)
+            q = self._event_queues[key]
+            if not self._packet_lock.wait_for(lambda: len(q) > 0, rxtimeout):
+                return (-1, None)
+            return (0, q.popleft())
+
+    def wait_event_matching(self, events: list, match, rxtimeout: float = 1) -> tuple:
+        """Wait for the oldest event of several types that matches a condition (i.e. the
+        conn_handle of one link). Other queued events are left for their own waiters.
+
+        Args:
+            events (list): Event names
+            match (function): Called with a Packet, True to take it
+            rxtimeout (float, optional): Time to wait in seconds. None waits forever,
+              0 doesn't wait. Defaults to 1.
+
+        Returns:
+            tuple: (err code - 0 for success else error, event name, Packet object)
+        """
+        keys = [self.__event_key(event) for event in events]
+        found = []
+
+        def take():
+            for event, key in zip(events, keys):
+                q = self._event_queues.get(key, [])
+                packet = next((p for p in q if match(p)), None)
+                if packet is not None:
+                    q.remove(packet)
+                    found.append((event, packet))
+                    return True
+            return False
+
+        with self._packet_lock:
+            for key in keys:
+                if key not in self._event_queues:
+                    self._event_queues[key] = deque(maxlen=self.EVENT_QUEUE_DEPTH)
+                    self._event_history[key] = deque(maxlen=self.EVENT_HISTORY_DEPTH)
+            if not self._packet_lock.wait_for(take, rxtimeout):
+                return (-1, None, None)
+            return (0,) + found[0]
+
+    def clear_events(self, event: str = None):
+        """Discard queued events that have not been consumed by wait_event.
+        The event history is not affected.
+
+        Args:
+            event (str, optional): Event to clear. Defaults to None (clear all events).
+        """
+        with self._packet_lock:
+            if event is None:
+                for q in self._event_queues.values():
+                    q.clear()
+            else:
+                q = self._event_queues.get(self.__event_key(event))
+                if q is not None:
+                    q.clear()
+
+    def get_event_history(self, event: str) -> list:
+        """Get the most recently received events of a type, whether or not they were consumed.
+
+        Args:
+            event (str): The event name
+
+        Returns:
+            list: Packet objects, oldest first
+        """
+        with self._packet_lock:
+            return list(self._event_history.get(self.__event_key(event), []))
+
+    def add_event_listener(self, event: str, listener):
+        """Call a function for every received event of a type.
+        Events that have a listener are not queued for wait_event (they are kept in the history).
+        Listeners run on the packet pump thread and must not wait for responses or events.
+
+        Args:
+            event (str): The event name
+            listener (function): Called with the Packet object
+        """
+        key = self.__event_key(event)
+        with self._packet_lock:
+            # Copy on write so the pump can iterate the list outside the lock
+            self._event_listeners[key] = self._event_listeners.get(
+                key, []) + [listener]
+
+    def remove_event_listener(self, event: str, listener):
+        """Stop calling a function added with add_event_listener
+
+        Args:
+            event (str): The event name
+            listener (function): The function to remove
+        """
+        key = self.__event_key(event)
+        with self._packet_lock:
+            listeners = [l for l in self._event_listeners.get(key, [])
+                         if l != listener]
+            if len(listeners) > 0:
+                self._event_listeners[key] = listeners
+            else:
+                self._event_listeners.pop(key, None)
+
+    def set_raw_data_handler(self, handler):
+        """Hand received bytes to a function instead of decoding EZ-Serial packets.
+        Use while the module is in CYSPP data mode.
+
+        Args:
+            handler (function): Called with the received bytes on the packet pump thread.
+              None resumes decoding packets.
+        """
+        self._raw_data_handler = handler
+        if handler is None and self.ez:
+            self.ez.reset()
+
+    @property
+    def scan_table(self) -> ScanTable:
+        """Scan results aggregated since the last start_scan_aggregation. The table is kept
+        after stop_scan_aggregation. None if aggregation was never started."""
+        return self._scan_table
+
+    def start_scan_aggregation(self, rssi_window: int = ScanTable.RSSI_WINDOW_DEFAULT) -> ScanTable:
+        """Aggregate gap_scan_result events in the background instead of queuing them.
+
+        Args:
+            rssi_window (int, optional): Number of recent RSSI values kept per advertiser.
+              Defaults to 10.
+
+        Returns:
+            ScanTable: Table of advertisers keyed by address
+        """
+        self.stop_scan_aggregation()
+        self._scan_table = ScanTable(rssi_window)
+        self.add_event_listener(
+            self.EVENT_GAP_SCAN_RESULT, self._scan_table.update)
+        return self._scan_table
+
+    def stop_scan_aggregation(self):
+        """Stop aggregating scan results. gap_scan_result events are queued for wait_event again.
+        The last scan_table stays available.
+        """
+        if self._scan_table:
+            self.remove_event_listener(
+                self.EVENT_GAP_SCAN_RESULT, self._scan_table.update)
 
     def set_api_format(self, api: int):
         """Set API format to use for sending commands
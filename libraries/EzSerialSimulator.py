@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import random
+import select
+import termios
+import threading
+import time
+import tty
+import ezserial_host_api.ezslib as ez_serial
+from lc_util import logger_setup
+
+
+class EzSerialSimulator():
+    """Simulated EZ-Serial device attached to a pseudo terminal (Linux/macOS only).
+
+    Commands are decoded in binary or text format using the ezslib protocol table and
+    answered in the same format with plausible responses. Events can be emitted on demand
+    or as floods. Open port_name with EzSerialPort to talk to the simulator.
+    Data is dropped while the host baud rate does not match the simulated UART baud rate
+    or the rate is above max_link_baud.
+    A peer simulator (or the simulator itself for loopback) receives GATT notifications and
+    CYSPP data as if the two were connected. Peers also see each other's advertising when
+    scanning and both get connection events when one connects to the other.
+    """
+
+    VAR_LEN_TYPES = ['uint8a', 'longuint8a', 'string', 'longstring']
+    PING_FRACTION_PER_SEC = 32768
+    USER_DATA_SIZE = 256 + 32
+    FIRMWARE_APP_VERSION = 0x01040000
+    FIRMWARE_STACK_VERSION = 0x03000000
+    PROTOCOL_VERSION = 0x0103
+    READ_TIMEOUT_SECS = 0.1
+    SMP_RESULT_KEY_MISSING = 0x0306
+    SMP_RESULT_UNSPECIFIED = 0x0308
+    GATTC_DATA_SOURCE_READ = 0
+    GATTC_DATA_SOURCE_NOTIFICATION = 1
+    GATTC_WRITE_TYPE_REQUEST = 0
+    DEFAULT_BAUD = 115200
+    TERMIOS_BAUD_RATES = dict((getattr(termios, f'B{b}'), b) for b in
+                              [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600,
+                               1000000, 2000000, 3000000] if hasattr(termios, f'B{b}'))
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, echo: bool = True):
+        """
+        Args:
+            latency (float, optional): Delay in seconds before answering each command. Defaults to 0.0.
+            jitter (float, optional): Random extra delay in seconds (0 to jitter) added to latency.
+              Defaults to 0.0.
+            echo (bool, optional): Echo text mode commands. Defaults to True.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.echo = echo
+        self.apiformat = ez_serial.Packet.EZS_API_FORMAT_BINARY
+        self.address = [random.randrange(256) for _ in range(5)] + [0xC0]
+        self.user_data = bytearray(self.USER_DATA_SIZE)
+        self.settings = {}
+        self.handlers = {}
+        self.responses = {}
+        self.commands_received = 0
+        self._master = None
+        self._slave = None
+        self._port_name = None
+        self._stop_threads = False
+        self._write_lock = threading.Lock()
+        self._start_time = time.perf_counter()
+        self._next_attr_handle = 0x20
+        self._next_conn_handle = 1
+        self._rx_thread = None
+        self._peer = None
+        self._peers = []
+        self._cyspp_data_mode = False
+        self._advertising = False
+        # Remote (simulator, conn_handle) by local conn_handle
+        self._links = {}
+        self.attr_values = {}
+        # gatts_create_attr arguments by handle
+        self.attributes = {}
+        self.baud = self.DEFAULT_BAUD
+        self.max_link_baud = None
+        # Over the air time of GATT client procedures, does not block other commands
+        self.procedure_latency = 0.0
+        # Time of a pairing exchange (encrypting with an existing bond takes procedure_latency)
+        self.pairing_latency = 0.0
+        # Bonded addresses with their address type
+        self.bonds = []
+
+    @property
+    def port_name(self):
+        """Device name of the simulated serial port"""
+        return self._port_name
+
+    def start(self) -> str:
+        """Create the pseudo terminal and start answering commands
+
+        Returns:
+            str: Port name to open with EzSerialPort
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self._port_name = os.ttyname(self._slave)
+        self._stop_threads = False
+        self._rx_thread = threading.Thread(
+            target=self.__rx_thread, daemon=True)
+        self._rx_thread.start()
+        logging.debug(f'EZ-Serial simulator on {self._port_name}')
+        return self._port_name
+
+    def stop(self):
+        """Stop the simulator and close the pseudo terminal
+        """
+        self._stop_threads = True
+        if self._rx_thread:
+            self._rx_thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def set_handler(self, command: str, handler):
+        """Replace the behaviour of a command.
+
+        Args:
+            command (str): Command name (i.e. system_ping)
+            handler (function): Called with (simulator, command name, payload dict).
+              Returns the response values dict (result and returns) or None to not respond.
+        """
+        self.handlers[command] = handler
+
+    def set_peer(self, peer: 'EzSerialSimulator'):
+        """Connect to another simulator. Notifications sent with gatts_notify_handle are
+        received by the peer as gattc_data_received events and CYSPP data is written to the
+        peer's port.
+
+        Args:
+            peer (EzSerialSimulator): The remote device. Use the simulator itself for loopback.
+        """
+        self._peer = peer
+        self.add_peer(peer)
+
+    def add_peer(self, peer: 'EzSerialSimulator'):
+        """Add a device that can be scanned and connected to (by address), i.e. one of several
+        peripherals of a central.
+
+        Args:
+            peer (EzSerialSimulator): The remote device
+        """
+        if peer not in self._peers and peer is not self:
+            self._peers.append(peer)
+
+    def set_cyspp_data_mode(self, enabled: bool):
+        """Enter or leave CYSPP data mode. In data mode all received bytes are sent to the peer
+        instead of being decoded as commands.
+
+        Args:
+            enabled (bool): True to enter data mode
+        """
+        self._cyspp_data_mode = enabled
+
+    def receive_data(self, data: bytes):
+        """Pass bytes received over the air to the host, as in CYSPP data mode
+        (i.e. from a BT900Simulator peer)
+
+        Args:
+            data (bytes): The data
+        """
+        self.__write(data)
+
+    def set_response(self, command: str, result: int = 0, **kwargs):
+        """Set fixed response values for a command
+
+        Args:
+            command (str): Command name (i.e. system_ping)
+            result (int, optional): Result code. Defaults to 0.
+        """
+        self.responses[command] = dict(kwargs, result=result)
+
+    def send_event(self, event: str, apiformat: int = None, **kwargs):
+        """Emit an event. Arguments that are not specified are zero or empty.
+
+        Args:
+            event (str): Event name (i.e. gap_scan_result)
+            apiformat (int, optional): 0=text, 1=binary. Defaults to the format of the last command.
+        """
+        entry = ez_serial.Protocol.getEventByName(event)
+        self.__write_packet(0x80, entry, 'parameters', kwargs, apiformat)
+
+    def boot(self):
+        """Restart the runtime clock and emit the system boot event
+        """
+        self._start_time = time.perf_counter()
+        self.send_event('system_boot', app=self.FIRMWARE_APP_VERSION,
+                        stack=self.FIRMWARE_STACK_VERSION, protocol=self.PROTOCOL_VERSION,
+                        address=self.address, FW='EZ-Serial simulator')
+
+    def flood_events(self, event: str, count: int, interval: float = 0.0, **kwargs) -> threading.Thread:
+        """Emit many events from a background thread.
+
+        Args:
+            event (str): Event name (i.e. gap_scan_result)
+            count (int): Number of events
+            interval (float, optional): Delay in seconds between events. Defaults to 0.0.
+            kwargs: Event arguments. A callable value is called with the event index.
+
+        Returns:
+            threading.Thread: The (started) thread sending the events
+        """
+        def flood():
+            for i in range(count):
+                if self._stop_threads:
+                    break
+                self.send_event(event, **dict([(k, v(i) if callable(v) else v)
+                                               for k, v in kwargs.items()]))
+                if interval > 0:
+                    time.sleep(interval)
+
+        thread = threading.Thread(target=flood, daemon=True)
+        thread.start()
+        return thread
+
+    def runtime(self) -> tuple:
+        """Simulated module runtime
+
+        Returns:
+            tuple: (seconds, fraction in 1/32768 seconds)
+        """
+        elapsed = time.perf_counter() - self._start_time
+        return (int(elapsed), int((elapsed % 1) * self.PING_FRACTION_PER_SEC))
+
+    def __link_ok(self) -> bool:
+        """Bytes get through when both sides use the same baud rate"""
+        if self.max_link_baud and self.baud > self.max_link_baud:
+            return False
+        host_baud = self.TERMIOS_BAUD_RATES.get(
+            termios.tcgetattr(self._slave)[5])
+        return host_baud is None or host_baud == self.baud
+
+    def __write(self, data: bytes):
+        with self._write_lock:
+            if self.__link_ok():
+                os.write(self._master, data)
+
+    def __write_packet(self, sof: int, entry: dict, key: str, values: dict, apiformat: int = None):
+        fixed = []
+        suffix = b''
+        for arg in ez_serial.Protocol.getArgList(entry, key):
+            value = values.get(arg['name'], None)
+            if arg['type'] in self.VAR_LEN_TYPES:
+                if value is None:
+                    value = b''
+                elif isinstance(value, str):
+                    value = value.encode('utf-8')
+                suffix = bytes(value)
+                fixed.append(len(suffix))
+            elif arg['type'] == 'macaddr':
+                fixed.append(bytes(value if value is not None else 6))
+            else:
+                fixed.append(value if value is not None else 0)
+        payload = ez_serial.Protocol.getArgStruct(
+            entry, key).pack(*fixed) + suffix
+        packet = bytearray([sof | (len(payload) >> 8), len(payload) & 0xFF,
+                            entry['group'], entry['method']]) + payload
+        packet.append((ez_serial.API.EZS_BINARY_CHECKSUM_INITIAL_VALUE + sum(packet)) % 256)
+
+        if apiformat is None:
+            apiformat = self.apiformat
+        if apiformat == ez_serial.Packet.EZS_API_FORMAT_TEXT:
+            text = ez_serial.Packet()
+            text.buildIncomingFromBinaryBuffer(packet)
+            self.__write(bytes(text.textString, 'utf-8'))
+        else:
+            self.__write(bytes(packet))
+
+    def __decode_binary_command(self, packet: bytes) -> tuple:
+        entry = ez_serial.Protocol.getCommandByIds(packet[2], packet[3])
+        codec = ez_serial.Protocol.getArgStruct(entry, 'parameters')
+        values = codec.unpack_from(packet, 4)
+        payload = {}
+        for arg, value in zip(entry['parameters'], values):
+            if arg['type'] in self.VAR_LEN_TYPES:
+                value = bytes(packet[4 + codec.size:4 + codec.size + value])
+                if arg['type'] in ['string', 'longstring']:
+                    value = value.decode('utf-8', 'ignore')
+            elif arg['type'] == 'macaddr':
+                value = list(value)
+            payload[arg['name']] = value
+        scope = ez_serial.Packet.EZS_MEMORY_SCOPE_FLASH if packet[0] & 0x10 else \
+            ez_serial.Packet.EZS_MEMORY_SCOPE_RAM
+        return (entry, scope, payload)
+
+    def __rx_thread(self):
+        buf = bytearray()
+        while not self._stop_threads:
+            ready, _, _ = select.select(
+                [self._master], [], [], self.READ_TIMEOUT_SECS)
+            if not ready:
+                continue
+            try:
+                buf.extend(os.read(self._master, 4096))
+            except OSError:
+                continue
+            if not self.__link_ok():
+                logging.debug(f'Simulator: dropped {len(buf)} bytes at {self.baud}')
+                buf.clear()
+                continue
+            if self._cyspp_data_mode:
+                if self._peer:
+                    self._peer.__write(bytes(buf))
+                buf.clear()
+                continue
+            while len(buf) > 0:
+                if buf[0] & ez_serial.API.EZS_BINARY_SOF_MASK:
+                    if len(buf) < 2:
+                        break
+                    length = ((buf[0] & 0x7) << 8) + buf[1] + 5
+                    if len(buf) < length:
+                        break
+                    packet = bytes(buf[:length])
+                    del buf[:length]
+                    if (ez_serial.API.EZS_BINARY_CHECKSUM_INITIAL_VALUE + sum(packet[:-1])) % 256 != packet[-1]:
+                        logging.warning(f'Simulator: bad checksum {packet.hex()}')
+                        continue
+                    try:
+                        (entry, scope, payload) = self.__decode_binary_command(
+                            packet)
+                    except Exception as e:
+                        logging.warning(f'Simulator: {e}')
+                        continue
+                    self.__process_command(
+                        entry, scope, payload, ez_serial.Packet.EZS_API_FORMAT_BINARY)
+                else:
+                    end = buf.find(b'\n')
+                    if end < 0:
+                        break
+                    line = bytes(buf[:end + 1])
+                    del buf[:end + 1]
+                    if self.echo:
+                        self.__write(line)
+                    if line.strip() == b'':
+                        continue
+                    try:
+                        packet = ez_serial.Packet()
+                        packet.buildOutgoingFromTextBuffer(line)
+                    except Exception as e:
+                        logging.warning(f'Simulator: {e}')
+                        self.send_event('system_error', ez_serial.Packet.EZS_API_FORMAT_TEXT,
+                                        error=0x0205)
+                        continue
+                    self.__process_command(packet.entry, packet.scope, dict(packet.payload),
+                                           ez_serial.Packet.EZS_API_FORMAT_TEXT)
+
+    def __process_command(self, entry: dict, scope: int, payload: dict, apiformat: int):
+        self.commands_received += 1
+        self.apiformat = apiformat
+        name = ez_serial.Protocol.commands[entry['group']]['name'] + \
+            '_' + entry['name']
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if name in self.handlers:
+            values = self.handlers[name](self, name, payload)
+        elif name in self.responses:
+            values = self.responses[name]
+        else:
+            values = self.__default_response(name, payload)
+        if values is None:
+            return
+        sof = 0xD0 if scope == ez_serial.Packet.EZS_MEMORY_SCOPE_FLASH else 0xC0
+        self.__write_packet(sof, entry, 'response', values)
+        if values.get('result', 0) == 0:
+            self.__after_response(name, payload)
+
+    def __default_response(self, name: str, payload: dict) -> dict:
+        """Plausible response values for a command"""
+        if name == 'system_ping':
+            (runtime, fraction) = self.runtime()
+            return {'runtime': runtime, 'fraction': fraction}
+        elif name == 'system_query_firmware_version':
+            return {'app': self.FIRMWARE_APP_VERSION, 'stack': self.FIRMWARE_STACK_VERSION,
+                    'protocol': self.PROTOCOL_VERSION}
+        elif name == 'system_query_unique_id':
+            return {'id': bytes(self.address) + bytes(2)}
+        elif name == 'system_query_random_number':
+            return {'data': bytes(random.randrange(256) for _ in range(8))}
+        elif name == 'system_get_bluetooth_address':
+            return {'address': self.address}
+        elif name == 'system_set_bluetooth_address':
+            self.address = list(payload['address'])
+        elif name == 'system_write_user_data':
+            offset = payload['offset']
+            self.user_data[offset:offset + len(payload['data'])] = payload['data']
+        elif name == 'system_read_user_data':
+            offset = payload['offset']
+            return {'data': bytes(self.user_data[offset:offset + payload['length']])}
+        elif name == 'gatts_read_handle':
+            return {'data': self.attr_values.get(payload['attr_handle'], b'')}
+        elif name == 'gatts_create_attr':
+            handle = self._next_attr_handle
+            self._next_attr_handle += 1
+            self.attributes[handle] = dict(payload, data=bytes(payload['data']))
+            return {'handle': handle, 'valid': 1}
+        elif name == 'gatts_delete_attr':
+            # Deleting an attribute also deletes the attributes created after it
+            count = max(0, self._next_attr_handle - payload['attr_handle'])
+            self._next_attr_handle -= count
+            for handle in [h for h in self.attributes if h >= self._next_attr_handle]:
+                del self.attributes[handle]
+            return {'count': count, 'next_handle': self._next_attr_handle, 'valid': 1}
+        elif name == 'gap_connect':
+            return {'conn_handle': self._next_conn_handle}
+        elif name == 'smp_query_bonds':
+            return {'count': len(self.bonds)}
+        elif name == 'smp_delete_bond':
+            # An all zero address deletes all bonds
+            if any(payload['address']):
+                self.bonds = [b for b in self.bonds if b[0] != list(payload['address'])]
+            else:
+                self.bonds = []
+            return {'count': len(self.bonds)}
+        elif name == 'system_get_uart_parameters':
+            return {'baud': self.baud, 'databits': 8, 'parity': 0, 'stopbits': 1}
+        elif '_get_' in name:
+            # getters return the values of the matching setter
+            return self.settings.get(name.replace('_get_', '_set_'), {})
+        elif '_set_' in name:
+            self.settings[name] = payload
+        return {}
+
+    def discover_attributes(self, kind: str) -> list:
+        """GATT client discovery results of the created attributes
+
+        Args:
+            kind (str): services, characteristics or descriptors
+
+        Returns:
+            list: gattc_discover_result arguments
+        """
+        handles = sorted(self.attributes)
+        services = [h for h in handles if self.attributes[h]['type'] == 0 and
+                    self.attributes[h]['data'][:2] == b'\x00\x28']
+        results = []
+        for i, h in enumerate(handles):
+            data = self.attributes[h]['data']
+            structure = self.attributes[h]['type'] == 0
+            if kind == 'services' and h in services:
+                end = next((s - 1 for s in services if s > h), handles[-1])
+                results.append({'attr_handle': h, 'attr_handle_rel': end, 'type': 0,
+                                'properties': 0, 'uuid': data[2:]})
+            elif kind == 'characteristics' and structure and data[:2] == b'\x03\x28':
+                results.append({'attr_handle': h, 'attr_handle_rel': h + 1, 'type': 1,
+                                'properties': data[2], 'uuid': data[5:]})
+            elif kind == 'descriptors' and h not in services and \
+                    not (structure and data[:2] == b'\x03\x28') and \
+                    not (i > 0 and self.attributes[handles[i - 1]]['data'][:2] == b'\x03\x28'):
+                results.append({'attr_handle': h, 'attr_handle_rel': 0, 'type': 2,
+                                'properties': 0, 'uuid': data[:2] if structure else data})
+        return results
+
+    def __pair(self, payload: dict):
+        """Encrypt with an existing bond if both sides have one, else run a pairing exchange"""
+        conn_handle = payload['conn_handle']
+        (peer, peer_conn_handle) = self._links.get(conn_handle, (None, None))
+        if peer is None:
+            self.send_event('smp_pairing_result', conn_handle=conn_handle,
+                            result=self.SMP_RESULT_UNSPECIFIED)
+            return
+        bonded = any(b[0] == peer.address for b in self.bonds)
+        peer_bonded = any(b[0] == self.address for b in peer.bonds)
+        if bonded and peer_bonded:
+            def encrypt():
+                for (device, handle) in [(self, conn_handle), (peer, peer_conn_handle)]:
+                    device.send_event('smp_encryption_status', conn_handle=handle, status=0)
+            self.__remote_procedure(encrypt)
+        elif bonded:
+            # The peer lost its keys
+            self.__remote_procedure(lambda: self.send_event(
+                'smp_pairing_result', conn_handle=conn_handle, result=self.SMP_RESULT_KEY_MISSING))
+        else:
+            def paired():
+                for (device, handle, other) in [(self, conn_handle, peer),
+                                                (peer, peer_conn_handle, self)]:
+                    if payload['bonding']:
+                        device.bonds = [b for b in device.bonds if b[0] != other.address]
+                        device.bonds.append((other.address, 0))
+                    device.send_event('smp_pairing_result', conn_handle=handle, result=0)
+                    device.send_event('smp_encryption_status', conn_handle=handle, status=0)
+            peer.send_event('smp_pairing_requested', conn_handle=peer_conn_handle,
+                            mode=payload['mode'], bonding=payload['bonding'],
+                            keysize=payload['keysize'], pairprop=payload['pairprop'])
+            timer = threading.Timer(self.pairing_latency, paired)
+            timer.daemon = True
+            timer.start()
+
+    def __remote_procedure(self, complete):
+        """Finish a GATT client procedure after procedure_latency"""
+        if self.procedure_latency > 0:
+            timer = threading.Timer(self.procedure_latency, complete)
+            timer.daemon = True
+            timer.start()
+        else:
+            complete()
+
+    def __after_response(self, name: str, payload: dict):
+        """Events that follow the response of a command"""
+        if name in ['system_reboot', 'system_factory_reset']:
+            self.baud = self.DEFAULT_BAUD
+            self.boot()
+        elif name == 'system_set_uart_parameters':
+            self.baud = payload['baud']
+        elif name == 'gap_start_adv':
+            self._advertising = True
+            self.send_event('gap_adv_state_changed', state=1)
+        elif name == 'gap_stop_adv':
+            self._advertising = False
+            self.send_event('gap_adv_state_changed', state=0, reason=0)
+        elif name == 'gap_start_scan':
+            self.send_event('gap_scan_state_changed', state=1)
+            for peer in self._peers:
+                if peer._advertising:
+                    self.send_event('gap_scan_result', address=peer.address, rssi=-50,
+                                    data=bytes([2, 1, 6]))
+        elif name == 'gap_stop_scan':
+            self.send_event('gap_scan_state_changed', state=0)
+        elif name == 'gap_connect':
+            conn = dict((k, payload[k]) for k in
+                        ['interval', 'slave_latency', 'supervision_timeout'])
+            self.send_event('gap_connected', conn_handle=self._next_conn_handle,
+                            address=payload['address'], type=payload['type'], **conn)
+            peer = next((p for p in self._peers if p.address == list(payload['address'])),
+                        self._peer)
+            if peer and peer is not self:
+                self._links[self._next_conn_handle] = (peer, peer._next_conn_handle)
+                peer._links[peer._next_conn_handle] = (self, self._next_conn_handle)
+                if peer._advertising:
+                    peer._advertising = False
+                    peer.send_event('gap_adv_state_changed', state=0, reason=0)
+                peer.send_event('gap_connected', conn_handle=peer._next_conn_handle,
+                                address=self.address, type=0, **conn)
+                peer._next_conn_handle += 1
+            self._next_conn_handle += 1
+        elif name.startswith('gattc_discover_'):
+            def discover():
+                (peer, _) = self._links.get(payload['conn_handle'], (self, None))
+                for result in peer.discover_attributes(name[len('gattc_discover_'):]):
+                    self.send_event('gattc_discover_result',
+                                    conn_handle=payload['conn_handle'], **result)
+                self.send_event('gattc_remote_procedure_complete',
+                                conn_handle=payload['conn_handle'], result=0)
+            self.__remote_procedure(discover)
+        elif name == 'gatts_notify_handle' and self._peer:
+            (peer, peer_conn_handle) = self._links.get(
+                payload['conn_handle'], (self._peer, payload['conn_handle']))
+            peer.send_event('gattc_data_received', conn_handle=peer_conn_handle,
+                            attr_handle=payload['attr_handle'],
+                            source=self.GATTC_DATA_SOURCE_NOTIFICATION, data=payload['data'])
+        elif name == 'gatts_write_handle':
+            self.attr_values[payload['attr_handle']] = bytes(payload['data'])
+        elif name == 'gattc_read_handle':
+            def read():
+                (peer, _) = self._links.get(payload['conn_handle'], (self, None))
+                self.send_event('gattc_data_received', conn_handle=payload['conn_handle'],
+                                attr_handle=payload['attr_handle'],
+                                source=self.GATTC_DATA_SOURCE_READ,
+                                data=peer.attr_values.get(payload['attr_handle'], b''))
+                self.send_event('gattc_remote_procedure_complete',
+                                conn_handle=payload['conn_handle'], result=0)
+            self.__remote_procedure(read)
+        elif name == 'gattc_write_handle':
+            def write():
+                (peer, peer_conn_handle) = self._links.get(payload['conn_handle'], (self, None))
+                peer.attr_values[payload['attr_handle']] = bytes(payload['data'])
+                if peer_conn_handle is not None:
+                    peer.send_event('gatts_data_written', conn_handle=peer_conn_handle,
+                                    attr_handle=payload['attr_handle'], type=payload['type'],
+                                    data=payload['data'])
+                # Only acknowledged writes (write requests) are answered by the peer
+                if payload['type'] == self.GATTC_WRITE_TYPE_REQUEST:
+                    self.send_event('gattc_write_response', conn_handle=payload['conn_handle'],
+                                    attr_handle=payload['attr_handle'], result=0)
+                    self.send_event('gattc_remote_procedure_complete',
+                                    conn_handle=payload['conn_handle'], result=0)
+            self.__remote_procedure(write)
+        elif name == 'smp_query_bonds':
+            for handle, (address, address_type) in enumerate(self.bonds):
+                self.send_event('smp_bond_entry', handle=handle, address=address,
+                                type=address_type)
+        elif name == 'smp_pair':
+            self.__pair(payload)
+        elif name == 'gap_disconnect':
+            self.send_event('gap_disconnected',
+                            conn_handle=payload['conn_handle'], reason=0x16)
+            (peer, peer_conn_handle) = self._links.pop(payload['conn_handle'], (None, None))
+            if peer is not None:
+                peer._links.pop(peer_conn_handle, None)
+                peer.send_event('gap_disconnected',
+                                conn_handle=peer_conn_handle, reason=0x13)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Simulate an EZ-Serial device on a pseudo terminal')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Command response latency in seconds")
+    parser.add_argument('-j', '--jitter', type=float, default=0.0,
+                        help="Maximum random extra response latency in seconds")
+    parser.add_argument('-s', '--scan_results', type=int, default=0,
+                        help="Number of scan result events to emit after boot")
+    parser.add_argument('-i', '--interval', type=float, default=0.01,
+                        help="Interval in seconds between flooded events")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    sim = EzSerialSimulator(args.latency, args.jitter)
+    logger.info(f'EZ-Serial simulator port: {sim.start()}')
+    sim.boot()
+    if args.scan_results:
+        sim.flood_events('gap_scan_result', args.scan_results, args.interval,
+                         address=lambda i: [i & 0xFF, i >> 8, 0, 0, 0, 0xC0],
+                         rssi=lambda i: -40 - (i % 40), data=bytes([2, 1, 6]))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,245 @@
+import logging
+import struct
+import threading
+import time
+from EzSerialPort import EzSerialPort
+from lc_util import latency_stats
+
+
+class StreamVerifier():
+    """Build sequenced payloads and verify them on the receiving side.
+
+    Each payload starts with a sequence number and the host send time, followed by a
+    pattern that depends on the sequence number so corrupted data is detected.
+    A payload built again for a retry keeps the time it was first sent.
+    """
+
+    HEADER = struct.Struct('<Id')
+    PATTERN = bytes(range(256)) * 3
+
+    def __init__(self, payload_size: int):
+        """
+        Args:
+            payload_size (int): Size of each payload in bytes (at least 12)
+        """
+        if payload_size < self.HEADER.size:
+            raise ValueError(
+                f'Payload size must be at least {self.HEADER.size} bytes')
+        if payload_size - self.HEADER.size > len(self.PATTERN) - 256:
+            raise ValueError(f'Payload size {payload_size} is too large')
+        self.payload_size = payload_size
+        self._lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """Forget all received payloads
+        """
+        with self._lock:
+            self.next_seq = 0
+            self.received = 0
+            self.received_bytes = 0
+            self.out_of_order = 0
+            self.duplicates = 0
+            self.corrupt = 0
+            self.latencies = []
+            self.first_rx_time = None
+            self.last_rx_time = None
+            self._seen = set()
+            self._tx_times = {}
+
+    def __pattern(self, seq: int) -> bytes:
+        offset = seq & 0xFF
+        return self.PATTERN[offset:offset + self.payload_size - self.HEADER.size]
+
+    def make_payload(self, seq: int) -> bytes:
+        """
+        Args:
+            seq (int): Sequence number
+
+        Returns:
+            bytes: The payload, stamped with the time it was first built
+        """
+        with self._lock:
+            tx_time = self._tx_times.setdefault(seq, time.perf_counter())
+        return self.HEADER.pack(seq, tx_time) + self.__pattern(seq)
+
+    def receive(self, data: bytes, rx_time: float = None):
+        """Verify a received payload
+
+        Args:
+            data (bytes): The payload
+            rx_time (float, optional): time.perf_counter() when the data was received.
+              Defaults to now.
+        """
+        if rx_time is None:
+            rx_time = time.perf_counter()
+        with self._lock:
+            if len(data) != self.payload_size:
+                self.corrupt += 1
+                return
+            (seq, tx_time) = self.HEADER.unpack_from(data)
+            if data[self.HEADER.size:] != self.__pattern(seq):
+                self.corrupt += 1
+                return
+            if seq in self._seen:
+                self.duplicates += 1
+                return
+            self._seen.add(seq)
+            if seq != self.next_seq:
+                self.out_of_order += 1
+            self.next_seq = max(self.next_seq, seq + 1)
+            self.received += 1
+            self.received_bytes += len(data)
+            self.latencies.append(rx_time - tx_time)
+            if self.first_rx_time is None:
+                self.first_rx_time = rx_time
+            self.last_rx_time = rx_time
+            self._lock.notify_all()
+
+    def wait_received(self, count: int, timeout: float) -> bool:
+        """Wait for payloads to be received
+
+        Args:
+            count (int): Number of unique payloads
+            timeout (float): Time to wait in seconds since the last payload was received
+
+        Returns:
+            bool: True if count payloads were received
+        """
+        with self._lock:
+            while self.received < count:
+                received = self.received
+                if not self._lock.wait_for(lambda: self.received != received, timeout):
+                    return False
+            return True
+
+    def results(self, sent: int, start_time: float) -> dict:
+        """
+        Args:
+            sent (int): Number of payloads sent
+            start_time (float): time.perf_counter() when the first payload was sent
+
+        Returns:
+            dict: Throughput, latency and loss statistics
+        """
+        with self._lock:
+            end_time = self.last_rx_time if self.last_rx_time else time.perf_counter()
+            elapsed = max(end_time - start_time, 1e-9)
+            return {'payload_size': self.payload_size,
+                    'sent': sent,
+                    'received': self.received,
+                    'lost': sent - self.received,
+                    'out_of_order': self.out_of_order,
+                    'duplicates': self.duplicates,
+                    'corrupt': self.corrupt,
+                    'seconds': round(elapsed, 4),
+                    'bytes_per_sec': round(self.received_bytes / elapsed, 1),
+                    'latency': latency_stats(self.latencies)}
+
+
+class EzThroughput():
+    """Measure GATT notification and CYSPP throughput between two EZ-Serial modules.
+
+    The sender streams sequenced payloads and the receiver verifies ordering and content.
+    Sender and receiver can be the same port when the remote side loops data back.
+    """
+
+    NOTIFY_BUSY_BACKOFF_SECS = 0.005
+    NOTIFY_MAX_RETRIES = 100
+
+    def __init__(self, sender: EzSerialPort, receiver: EzSerialPort = None):
+        """
+        Args:
+            sender (EzSerialPort): Port of the module that sends data
+            receiver (EzSerialPort, optional): Port of the module that receives data.
+              Defaults to the sender.
+        """
+        self.sender = sender
+        self.receiver = receiver if receiver else sender
+
+    def gatt_notify(self, conn_handle: int, attr_handle: int, count: int, payload_size: int = 20,
+                    window: int = 4, timeout: float = 2, rx_attr_handle: int = None) -> dict:
+        """Send notifications and receive them as gattc_data_received events.
+        Up to window notifications are outstanding. A notification the module rejects
+        (i.e. no free transmit buffers) is sent again after a short backoff.
+
+        Args:
+            conn_handle (int): Connection handle on the sender (GATT server)
+            attr_handle (int): Characteristic value handle to notify
+            count (int): Number of notifications
+            payload_size (int, optional): Bytes per notification (at most MTU - 3). Defaults to 20.
+            window (int, optional): Maximum outstanding notify commands. Defaults to 4.
+            timeout (float, optional): Time to wait for a response or data in seconds. Defaults to 2.
+            rx_attr_handle (int, optional): Handle the receiver reports data on.
+              Defaults to attr_handle.
+
+        Returns:
+            dict: Throughput results. retries is the number of rejected notifications.
+        """
+        verifier = StreamVerifier(payload_size)
+        if rx_attr_handle is None:
+            rx_attr_handle = attr_handle
+
+        def on_data(packet):
+            if packet.payload['attr_handle'] == rx_attr_handle:
+                verifier.receive(packet.payload['data'], packet.rx_time)
+
+        failed = 0
+
+        def on_failure(command, kwargs, res):
+            nonlocal failed
+            (seq, _) = StreamVerifier.HEADER.unpack_from(kwargs['data'])
+            logging.warning(f'Notification {seq} failed: {res[0]}')
+            failed += 1
+
+        self.receiver.add_event_listener(
+            self.receiver.EVENT_GATTC_DATA_RECEIVED, on_data)
+        try:
+            start_time = time.perf_counter()
+            # Payloads are built (and timestamped) when the window allows sending them
+            commands = ((self.sender.CMD_GATTS_NOTIFY_HANDLE,
+                         {'conn_handle': conn_handle, 'attr_handle': attr_handle,
+                          'data': verifier.make_payload(seq)}) for seq in range(count))
+            retries = self.sender.send_windowed(commands, timeout, window, self.NOTIFY_MAX_RETRIES,
+                                                self.NOTIFY_BUSY_BACKOFF_SECS, on_failure)
+            verifier.wait_received(count - failed, timeout)
+        finally:
+            self.receiver.remove_event_listener(
+                self.receiver.EVENT_GATTC_DATA_RECEIVED, on_data)
+        results = verifier.results(count, start_time)
+        results['retries'] = retries
+        results['failed'] = failed
+        return results
+
+    def cyspp(self, count: int, payload_size: int = 128, timeout: float = 2) -> dict:
+        """Stream data over a CYSPP connection. Both modules must already be in CYSPP data mode.
+        Pacing is left to the UART flow control (open the ports with ctsrts=True).
+        The receiver splits the byte stream back into payloads.
+
+        Args:
+            count (int): Number of payloads
+            payload_size (int, optional): Bytes per payload. Defaults to 128.
+            timeout (float, optional): Time to wait for data in seconds. Defaults to 2.
+
+        Returns:
+            dict: Throughput results
+        """
+        verifier = StreamVerifier(payload_size)
+        rx_buffer = bytearray()
+
+        def on_data(data):
+            rx_time = time.perf_counter()
+            rx_buffer.extend(data)
+            while len(rx_buffer) >= payload_size:
+                verifier.receive(bytes(rx_buffer[:payload_size]), rx_time)
+                del rx_buffer[:payload_size]
+
+        self.receiver.set_raw_data_handler(on_data)
+        try:
+            start_time = time.perf_counter()
+            for seq in range(count):
+                self.sender.send(verifier.make_payload(seq))
+            verifier.wait_received(count, timeout)
+        finally:
+            self.receiver.set_raw_data_handler(None)
+        return verifier.results(count, start_time)
@@ -0,0 +1,213 @@
+import hashlib
+import struct
+import uuid
+from EzSerialPort import GattAttrType, GattAttrPermission, GattAttrCharProps
+
+UUID_PRIMARY_SERVICE = 0x2800
+UUID_CHARACTERISTIC = 0x2803
+UUID_CCCD = 0x2902
+
+
+def uuid_bytes(value) -> bytes:
+    """Convert a UUID to the little endian bytes used in attribute data
+
+    Args:
+        value (int | str): 16-bit UUID or 128-bit UUID string
+
+    Returns:
+        bytes: 2 or 16 bytes
+    """
+    if isinstance(value, int):
+        return struct.pack('<H', value)
+    return uuid.UUID(value).bytes[::-1]
+
+
+def flags_value(flags, enum) -> int:
+    """Combine flags given as an int, an enum member, names or a list of those"""
+    if isinstance(flags, int):
+        return flags
+    if isinstance(flags, enum):
+        return flags.value
+    if isinstance(flags, str):
+        return enum[flags.upper()].value
+    value = 0
+    for flag in flags:
+        value |= flags_value(flag, enum)
+    return value
+
+
+class GattDescriptor():
+    def __init__(self, name: str, uuid, perm=GattAttrPermission.READ, length: int = 0,
+                 value: bytes = None):
+        """
+        Args:
+            name (str): Name used to look up the handle
+            uuid (int | str): Descriptor UUID
+            perm (optional): GattAttrPermission flags. Defaults to READ.
+            length (int, optional): Maximum value length. Defaults to 0.
+            value (bytes, optional): Fixed value, stored as a structure attribute. Defaults to None.
+        """
+        self.name = name
+        self.uuid = uuid
+        self.perm = flags_value(perm, GattAttrPermission)
+        self.length = length
+        self.value = value
+
+
+class GattCharacteristic():
+    def __init__(self, name: str, uuid, props, perm=None, length: int = 20,
+                 descriptors: list = None):
+        """
+        Args:
+            name (str): Name used to look up the handles
+            uuid (int | str): Characteristic UUID
+            props: GattAttrCharProps flags
+            perm (optional): GattAttrPermission flags of the value. Defaults to flags
+              matching props.
+            length (int, optional): Maximum value length. Defaults to 20.
+            descriptors (list, optional): GattDescriptor objects. A CCCD is added for
+              characteristics that notify or indicate. Defaults to None.
+        """
+        self.name = name
+        self.uuid = uuid
+        self.props = flags_value(props, GattAttrCharProps)
+        if perm is None:
+            perm = GattAttrPermission.VAR_LEN.value
+            if self.props & GattAttrCharProps.READ.value:
+                perm |= GattAttrPermission.READ.value
+            if self.props & GattAttrCharProps.WRITE_NO_RESP.value:
+                perm |= GattAttrPermission.WRITE_NO_ACK.value
+            if self.props & GattAttrCharProps.WRITE.value:
+                perm |= GattAttrPermission.WRITE_ACK.value
+        self.perm = flags_value(perm, GattAttrPermission)
+        self.length = length
+        self.descriptors = list(descriptors) if descriptors else []
+        notify = GattAttrCharProps.NOTIFY.value | GattAttrCharProps.INDICATE.value
+        if self.props & notify and not any(d.uuid == UUID_CCCD for d in self.descriptors):
+            self.descriptors.insert(0, GattDescriptor(
+                'cccd', UUID_CCCD,
+                GattAttrPermission.READ.value | GattAttrPermission.WRITE_ACK.value, 2))
+
+
+class GattService():
+    def __init__(self, name: str, uuid, characteristics: list):
+        """
+        Args:
+            name (str): Name used to look up the handles
+            uuid (int | str): Service UUID
+            characteristics (list): GattCharacteristic objects
+        """
+        self.name = name
+        self.uuid = uuid
+        self.characteristics = list(characteristics)
+
+
+class GattDatabase():
+    """Declarative description of a custom GATT database.
+
+    compile() turns the services into the gatts_create_attr argument sequence.
+    Handles are allocated by the module in creation order, so attribute handles are
+    the first created handle plus the attribute index (see handles()). Characteristic
+    declarations hold the value handle, so the first handle must be known to compile them.
+    """
+
+    def __init__(self, services: list):
+        """
+        Args:
+            services (list): GattService objects
+        """
+        self.services = list(services)
+
+    @staticmethod
+    def from_dict(description: dict) -> 'GattDatabase':
+        """Build a database from plain data (i.e. loaded from JSON or a Robot variable file).
+
+        Example:
+            {'services': [{'name': 'vsp', 'uuid': '569a1101-b87f-490c-92cb-11ba5ea5167c',
+              'characteristics': [{'name': 'rx', 'uuid': '569a2001-b87f-490c-92cb-11ba5ea5167c',
+                                   'props': ['WRITE', 'WRITE_NO_RESP'], 'length': 244}]}]}
+
+        Args:
+            description (dict): Services, characteristics and descriptors
+
+        Returns:
+            GattDatabase: The database
+        """
+        services = []
+        for s in description['services']:
+            characteristics = []
+            for c in s.get('characteristics', []):
+                descriptors = [GattDescriptor(d['name'], d['uuid'], d.get('perm', 'READ'),
+                                              d.get('length', 0),
+                                              bytes(d['value']) if 'value' in d else None)
+                               for d in c.get('descriptors', [])]
+                characteristics.append(GattCharacteristic(
+                    c['name'], c['uuid'], c['props'], c.get('perm'), c.get('length', 20),
+                    descriptors))
+            services.append(GattService(s['name'], s['uuid'], characteristics))
+        return GattDatabase(services)
+
+    def __attributes(self, first_handle: int = 0) -> list:
+        """(name, create_attr kwargs) in creation order"""
+        attrs = []
+
+        def structure(name, attr_type, value, perm=GattAttrPermission.READ.value):
+            data = uuid_bytes(attr_type) + value
+            attrs.append((name, {'type': GattAttrType.STRUCTURE.value, 'perm': perm,
+                                 'length': len(data), 'data': data}))
+
+        def value(name, attr_uuid, perm, length):
+            attrs.append((name, {'type': GattAttrType.VALUE.value, 'perm': perm,
+                                 'length': length, 'data': uuid_bytes(attr_uuid)}))
+
+        for s in self.services:
+            structure(s.name, UUID_PRIMARY_SERVICE, uuid_bytes(s.uuid))
+            for c in s.characteristics:
+                # The value attribute follows its declaration
+                value_handle = first_handle + len(attrs) + 1
+                structure(f'{s.name}.{c.name}.declaration', UUID_CHARACTERISTIC,
+                          struct.pack('<BH', c.props, value_handle) + uuid_bytes(c.uuid))
+                value(f'{s.name}.{c.name}', c.uuid, c.perm, c.length)
+                for d in c.descriptors:
+                    name = f'{s.name}.{c.name}.{d.name}'
+                    if d.value is not None:
+                        structure(name, d.uuid, d.value, d.perm)
+                    else:
+                        value(name, d.uuid, d.perm, d.length)
+        return attrs
+
+    def compile(self, first_handle: int) -> list:
+        """
+        Args:
+            first_handle (int): Handle the first attribute is created at
+
+        Returns:
+            list: gatts_create_attr kwargs dicts in creation order
+        """
+        return [kwargs for _, kwargs in self.__attributes(first_handle)]
+
+    def handles(self, first_handle: int) -> dict:
+        """
+        Args:
+            first_handle (int): Handle of the first created attribute
+
+        Returns:
+            dict: Attribute handle by name. Characteristic values are 'service.characteristic',
+              descriptors 'service.characteristic.descriptor'.
+        """
+        return dict((name, first_handle + i)
+                    for i, (name, _) in enumerate(self.__attributes()))
+
+    def digest(self) -> bytes:
+        """
+        Returns:
+            bytes: 16 byte hash of the compiled attributes. It is compiled with handles
+              relative to the first attribute, so it doesn't depend on where the database
+              is created.
+        """
+        h = hashlib.sha256()
+        for kwargs in self.compile(0):
+            h.update(struct.pack('<BBH', kwargs['type'],
+                     kwargs['perm'], kwargs['length']))
+            h.update(struct.pack('<B', len(kwargs['data'])) + kwargs['data'])
+        return h.digest()[:16]
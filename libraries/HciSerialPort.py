@@ -3,6 +3,7 @@ import serial
 import threading
 import queue
 import io
+from collections import deque
 import zlib
 import hci
 import hci.command
@@ -10,6 +11,91 @@ import hci.event
 import logging
 
 
+class HciFramer():
+    """Cut complete HCI packets (UART transport) out of received bytes.
+
+    Bytes are appended to a buffer and scanned from a cursor with the packet indicator and
+    the length field of each packet type, so every byte is looked at once. Only complete
+    packets are decoded. A partial packet stays in the buffer until the rest is received.
+    """
+
+    # Packet indicator: (offset of the length field, size of the length field)
+    HEADERS = {hci.HciPacket.PacketType.COMMAND: (3, 1),
+               hci.HciPacket.PacketType.ASYNCHRONOUS_DATA: (3, 2),
+               hci.HciPacket.PacketType.SYNCHRONOUS_DATA: (3, 1),
+               hci.HciPacket.PacketType.EVENT: (2, 1)}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buf = bytearray()
+        self.packets = 0
+        self.dropped = 0
+
+    def reset(self):
+        """Discard the bytes of a partial packet
+        """
+        with self._lock:
+            self._buf.clear()
+
+    def __decode(self, data: bytes, packets: list):
+        """Decode complete command and event packets in one pass"""
+        if len(data) == 0:
+            return
+        try:
+            packets.extend(hci.from_binary(data)[0])
+        except Exception as e:
+            logging.debug(f'Unhandled HCI packets: {data.hex(",")} ({e})')
+            self.dropped += len(data)
+
+    def feed(self, data: bytes) -> list:
+        """Add received bytes
+
+        Args:
+            data (bytes): Received bytes
+
+        Returns:
+            list: Packets completed by these bytes
+        """
+        packets = []
+        with self._lock:
+            buf = self._buf
+            buf.extend(data)
+            cursor = 0
+            # Start of the command and event packets that are decoded together
+            run = 0
+            while cursor < len(buf):
+                pkt_type = buf[cursor]
+                header = self.HEADERS.get(pkt_type)
+                if header is None:
+                    self.__decode(bytes(buf[run:cursor]), packets)
+                    logging.debug(f'Unhandled HCI byte: {pkt_type:02x}')
+                    self.dropped += 1
+                    cursor += 1
+                    run = cursor
+                    continue
+                (length_offset, length_size) = header
+                end = cursor + length_offset + length_size
+                if end > len(buf):
+                    break
+                if length_size == 1:
+                    end += buf[end - 1]
+                else:
+                    end += buf[end - 2] | (buf[end - 1] << 8)
+                if end > len(buf):
+                    break
+                if pkt_type != hci.HciPacket.PacketType.COMMAND and \
+                        pkt_type != hci.HciPacket.PacketType.EVENT:
+                    # The hci package doesn't frame data packets, they are not cast
+                    self.__decode(bytes(buf[run:cursor]), packets)
+                    packets.append(hci.HciPacket(pkt_type, bytes(buf[cursor + 1:end])))
+                    run = end
+                cursor = end
+            self.__decode(bytes(buf[run:cursor]), packets)
+            del buf[:cursor]
+            self.packets += len(packets)
+        return packets
+
+
 class HciSerialPort():
     """Serial port implementation to communicate with Infineon Bluetooth HCI devices
     """
@@ -17,6 +103,9 @@ class HciSerialPort():
 
     CLEAR_QUEUE_TIMEOUT = 0.1
     WRITE_RAM_MAX_SIZE = 240
+    WRITE_RAM_MAX_IN_FLIGHT = 8
+    WRITE_RAM_TIMEOUT_SECS = 1
+    WRITE_RAM_VERIFY_RETRIES = 2
 
     OPCODE_DOWNLOAD_MINIDRIVER = 0xFC2E
     OPCODE_WRITE_RAM = 0xFC4C
@@ -24,19 +113,26 @@ class HciSerialPort():
     OPCODE_UPDATE_BAUDRATE = 0xFC18
     OPCODE_CHIP_ERASE = 0xFFCE
     OPCODE_VERIFY_CRC = 0xFCCC
+    # Command Complete that only returns command credits
+    OPCODE_NO_OP = 0x0000
 
     ERASE_ALL_FLASH_MAGIC = 0xFCBEEEEF
     LITTLE_ENDIAN = 'little'
     LAUNCH_RAM_DELAY = 0.2
     FLASH_PAD = 0xFF
     RAM_PAD = 0x00
+    AUTOBAUD_RESET_TRIES = 2
+    AUTOBAUD_RESET_TIMEOUT_SECS = 0.05
 
     SERIAL_PORT_RX_TIMEOUT_SECS = 0.0006076 # Based on 7 bytes at 115200 baud (a full HCI command complete event)
     SERIAL_PORT_RX_SIZE_BYTES = 1024
 
     def __init__(self):
         self.port = None
-        self.rx_bytes = []
+        self.framer = HciFramer()
+        # Num_HCI_Command_Packets of the last Command Complete event
+        self.command_credits = 1
+        self.verify_crc_count = 0
         self.rx_queue = None
         self.stop_threads = False
         self.queue_monitor_event = threading.Event()
@@ -78,30 +174,19 @@ class HciSerialPort():
         self.queue_monitor_event.set()
 
     def __serial_port_rx_thread(self):
-        self.rx_bytes.clear()
+        self.framer.reset()
         if not self.rx_queue or not self.port:
             raise Exception('Null object')
         while True:
             if self.stop_threads:
                 break
             try:
-                self.rx_bytes.extend(self.port.read(
-                    self.SERIAL_PORT_RX_SIZE_BYTES))
-                packets, unprocessed = hci.from_binary(
-                    bytearray(self.rx_bytes))
-                if len(packets) > 0 and len(unprocessed) > 0:
-                    self.rx_bytes.clear()
-                    self.rx_bytes.extend(unprocessed)
-                for pkt in packets:
-                    logging.debug(f'RX {pkt.binary.hex(",")}')
+                for pkt in self.framer.feed(self.port.read(self.SERIAL_PORT_RX_SIZE_BYTES)):
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        logging.debug(f'RX {pkt.binary.hex(",")}')
                     self.rx_queue.put(pkt)
-                    self.rx_bytes.clear()
             except Exception as e:
                 # logging.warning(str(e))
-                if len(self.rx_bytes) > 0:
-                    logging.debug(
-                        f'Unhandled HCI bytes: {bytearray(self.rx_bytes).hex(",")}')
-                    self.rx_bytes.pop(0)
                 pass
 
     def send_command_wait_response(self, packet: hci.command.CommandPacket, timeout: float = 1, tries: int = 1) -> tuple:
@@ -117,6 +202,7 @@ class HciSerialPort():
             self.port.write(packet.binary)
             try:
                 resp_pkt = self.rx_queue.get(True, timeout)
+                self.command_credits = resp_pkt.packets
                 if resp_pkt.status != hci.event.HCI_CommandComplete.Status.HCI_SUCCESS \
                         or packet.opcode != resp_pkt.opcode:
                     success = False
@@ -150,6 +236,7 @@ class HciSerialPort():
         payload = []
         payload.extend(address.to_bytes(4, self.LITTLE_ENDIAN))
         payload.extend(length.to_bytes(4, self.LITTLE_ENDIAN))
+        self.verify_crc_count += 1
         (success, payload) = self.send_command_wait_response(hci.command.CommandPacket(
             self.OPCODE_VERIFY_CRC, bytearray(payload)))
         if not success:
@@ -193,7 +280,7 @@ class HciSerialPort():
             return
         with self.rx_queue.mutex:
             self.rx_queue.queue.clear()
-            self.rx_bytes.clear()
+            self.framer.reset()
 
     def send_hci_reset(self):
         """Send HCI reset and wait for response
@@ -216,60 +303,161 @@ class HciSerialPort():
         if not success:
             raise Exception('Failed download minidriver')
 
-    def write_ram(self, address: int, data: io.BytesIO, pad: int = FLASH_PAD, verify: bool = False):
+    def __write_ram_chunks(self, chunks: list, max_in_flight: int, timeout: float):
+        """Send WRITE_RAM commands without waiting for each response.
+        A command is sent while the controller has credits (Num_HCI_Command_Packets of the
+        last Command Complete event) and fewer than max_in_flight commands are unanswered.
+        After a Num_HCI_Command_Packets of 0, sending waits for an event that returns credits
+        (i.e. a No-op Command Complete).
+
+        Args:
+            chunks (list): (address, memoryview) to write
+            max_in_flight (int): Maximum number of unanswered commands
+            timeout (float): Time to wait for each response (or for credits) in seconds
+        """
+        if self.port == None or not self.port.is_open:
+            raise Exception('Port is not open')
+        in_flight = deque()
+        credits = self.command_credits
+        next_chunk = 0
+        self.__pause_queue_monitor()
+        self.clear_rx_queue()
+        try:
+            while next_chunk < len(chunks) or len(in_flight) > 0:
+                while next_chunk < len(chunks) and credits > 0 and len(in_flight) < max_in_flight:
+                    (addr, chunk) = chunks[next_chunk]
+                    packet = hci.command.CommandPacket(
+                        self.OPCODE_WRITE_RAM, addr.to_bytes(4, self.LITTLE_ENDIAN) + chunk)
+                    self.port.write(packet.binary)
+                    in_flight.append(addr)
+                    credits -= 1
+                    next_chunk += 1
+                try:
+                    resp_pkt = self.rx_queue.get(True, timeout)
+                except queue.Empty:
+                    if len(in_flight) == 0:
+                        raise Exception(f'No command credits for {timeout}s, writing to address '
+                                        f'{hex(chunks[next_chunk][0])}')
+                    raise Exception(f'No response writing to address {hex(in_flight[0])}')
+                if not isinstance(resp_pkt, hci.event.HCI_CommandComplete):
+                    continue
+                if resp_pkt.opcode != self.OPCODE_WRITE_RAM or len(in_flight) == 0:
+                    # A No-op may have been generated before the unanswered commands arrived,
+                    # their responses return the credits instead
+                    if len(in_flight) == 0:
+                        credits = resp_pkt.packets
+                    continue
+                addr = in_flight.popleft()
+                # A response frees the buffer of its command. Num_HCI_Command_Packets doesn't
+                # count commands sent after the event was generated, so it only caps the credits.
+                if len(in_flight) == 0:
+                    credits = resp_pkt.packets
+                else:
+                    credits = min(credits + 1, resp_pkt.packets)
+                if resp_pkt.status != hci.event.HCI_CommandComplete.Status.HCI_SUCCESS:
+                    raise Exception(f'Failed to write to address {hex(addr)}')
+                logging.debug(f'write_ram {hex(addr)} ({next_chunk - len(in_flight)}/{len(chunks)})')
+        finally:
+            self.command_credits = credits
+            self.__resume_queue_monitor()
+
+    @staticmethod
+    def __regions(chunks: list) -> list:
+        """Group chunks into runs of contiguous addresses"""
+        regions = []
+        for chunk in chunks:
+            if len(regions) > 0 and regions[-1][-1][0] + len(regions[-1][-1][1]) == chunk[0]:
+                regions[-1].append(chunk)
+            else:
+                regions.append([chunk])
+        return regions
+
+    def __find_bad_chunks(self, region: list, known_bad: bool = False) -> list:
+        """Find the chunks of a contiguous region that don't match the device.
+        The region is checked with one VERIFY_CRC and bisected if it doesn't match.
+
+        Args:
+            region (list): (address, memoryview) chunks at contiguous addresses
+            known_bad (bool, optional): The region is known not to match (don't check it).
+              Defaults to False.
+
+        Returns:
+            list: Chunks that don't match
+        """
+        if not known_bad:
+            data_crc = 0
+            for (_, write_data) in region:
+                data_crc = zlib.crc32(write_data, data_crc)
+            length = region[-1][0] + len(region[-1][1]) - region[0][0]
+            read_crc = self.__verify_crc(region[0][0], length)
+            if data_crc == read_crc:
+                return []
+            logging.debug(f'CRC mismatch {hex(region[0][0])}+{length}. '
+                          f'{hex(read_crc)} != {hex(data_crc)}')
+        if len(region) == 1:
+            return region
+        half = len(region) // 2
+        bad = self.__find_bad_chunks(region[:half])
+        # If the first half matches, the mismatch is in the second half
+        return bad + self.__find_bad_chunks(region[half:], len(bad) == 0)
+
+    def write_ram(self, address: int, data: io.BytesIO, pad: int = FLASH_PAD, verify: bool = False,
+                  max_in_flight: int = WRITE_RAM_MAX_IN_FLIGHT) -> dict:
         """Write RAM command (Infineon Vendor Specific HCI command)
 
+        Chunks are pipelined: up to max_in_flight WRITE_RAM commands are sent ahead of their
+        responses, as far as the controller's command credits allow.
+        Verification is done after the data is written, with one VERIFY_CRC per contiguous
+        region. A region that doesn't match is bisected to find the bad chunks, which are
+        written and verified again.
+
         Args:
             address (int): Address to write to
             data (io.BytesIO): All bytes to write
             pad (int, optional): Pad byte value. If a write buffer contains all pad bytes,
               it isn't written. Defaults to FLASH_PAD.
+            verify (bool, optional): Verify the CRC of the written data. Defaults to False.
+            max_in_flight (int, optional): Maximum number of unanswered WRITE_RAM commands.
+              1 is stop-and-wait. Defaults to 8.
 
         Raises:
-            Exception: raise exception if no response
-        """
-        all_data = list(data.getvalue())
-        total_bytes = bytes_left = len(all_data)
-        addr = address
-        write_len = self.WRITE_RAM_MAX_SIZE
-        bytes_written = 0
-        while bytes_left > 0:
-            if bytes_left > self.WRITE_RAM_MAX_SIZE:
-                write_len = self.WRITE_RAM_MAX_SIZE
-            else:
-                write_len = bytes_left
+            Exception: raise exception if no response or the data can't be verified
 
-            write_data = all_data[0:write_len]
+        Returns:
+            dict: chunks (written), crc_commands (VERIFY_CRC sent) and rewritten (chunks
+              written again)
+        """
+        all_data = memoryview(data.getvalue())
+        pad_data = bytes([pad]) * self.WRITE_RAM_MAX_SIZE
+        chunks = []
+        for offset in range(0, len(all_data), self.WRITE_RAM_MAX_SIZE):
+            write_data = all_data[offset:offset + self.WRITE_RAM_MAX_SIZE]
             # Check if all bytes are pad bytes, if they are, we dont need to write them
-            no_write = write_data.count(pad) == len(write_data)
-            success = False
-            if no_write:
-                success = True
-                logging.debug('Pad bytes, dont write')
-            else:
-                payload = bytearray(addr.to_bytes(4, self.LITTLE_ENDIAN))
-                payload.extend(write_data)
-                (success, _) = self.send_command_wait_response(
-                    hci.command.CommandPacket(self.OPCODE_WRITE_RAM, payload))
-            if success:
-                if not no_write and verify:
-                    # Verify CRC
-                    data_crc = zlib.crc32(bytearray(write_data))
-                    logging.debug(f'Data CRC: {hex(data_crc)}')
-                    read_crc = self.__verify_crc(addr, write_len)
-                    logging.debug(f'Read CRC: {hex(read_crc)}')
-                    if data_crc != read_crc:
-                        raise Exception(
-                            f'Write verification failed. {hex(read_crc)} != {hex(data_crc)}')
-
-                all_data = all_data[write_len:]
-                bytes_written += write_len
-                addr += write_len
-                bytes_left -= write_len
-                logging.debug(
-                    f'write_ram {bytes_written}/{total_bytes} ({round(bytes_written/total_bytes*100, 1)}%)')
-            else:
-                raise Exception(f'Failed to write to address {hex(addr)}')
+            if write_data != pad_data[:len(write_data)]:
+                chunks.append((address + offset, write_data))
+        logging.debug(f'write_ram {hex(address)}: {len(chunks)} chunks, '
+                      f'{len(all_data) - sum(len(c) for _, c in chunks)} pad bytes not written')
+        self.__write_ram_chunks(chunks, max_in_flight, self.WRITE_RAM_TIMEOUT_SECS)
+
+        crc_count = self.verify_crc_count
+        rewritten = 0
+        if verify:
+            check = chunks
+            for retry in range(self.WRITE_RAM_VERIFY_RETRIES + 1):
+                bad = []
+                for region in HciSerialPort.__regions(check):
+                    bad.extend(self.__find_bad_chunks(region))
+                if len(bad) == 0:
+                    break
+                bad_addresses = [hex(addr) for (addr, _) in bad]
+                if retry == self.WRITE_RAM_VERIFY_RETRIES:
+                    raise Exception(f'Write verification failed at {bad_addresses}')
+                logging.warning(f'Write verification failed at {bad_addresses}, writing again')
+                self.__write_ram_chunks(bad, max_in_flight, self.WRITE_RAM_TIMEOUT_SECS)
+                rewritten += len(bad)
+                check = bad
+        return {'chunks': len(chunks), 'crc_commands': self.verify_crc_count - crc_count,
+                'rewritten': rewritten}
 
     def send_launch_ram(self, address: int):
         """Launch RAM command (Infineon Vendor Specific HCI command)
@@ -315,6 +503,38 @@ class HciSerialPort():
             raise Exception('Failed to update baud rate')
         self.port.baudrate = baud
 
+    def detect_baud(self, rates: list, tries: int = AUTOBAUD_RESET_TRIES,
+                    timeout: float = AUTOBAUD_RESET_TIMEOUT_SECS) -> int | None:
+        """Find the baud rate of the device without reopening the port.
+        Each rate is tried with an HCI reset (in the given order, so put the most likely rate
+        first). The port stays at the rate that was answered.
+
+        Args:
+            rates (list): Baud rates to try
+            tries (int, optional): HCI resets per rate. The first one can be lost to bytes the
+              device received at a wrong rate. Defaults to 2.
+            timeout (float, optional): Time to wait for each response in seconds.
+              Defaults to 0.05.
+
+        Returns:
+            int | None: The baud rate of the device, None if no rate was answered
+              (the port goes back to the rate it was at)
+        """
+        if self.port == None or not self.port.is_open:
+            raise Exception('Port is not open')
+        old_baud = self.port.baudrate
+        for baud in rates:
+            self.port.flush()
+            self.port.baudrate = baud
+            (success, _) = self.send_command_wait_response(
+                hci.command.HCI_Reset(), timeout, tries)
+            if success:
+                logging.info(f'Detected HCI baud rate {baud}')
+                return baud
+            logging.debug(f'No HCI response at {baud}')
+        self.port.baudrate = old_baud
+        return None
+
     def close(self):
         """Close the serial port.
         """
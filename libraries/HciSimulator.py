@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import queue
+import random
+import select
+import termios
+import threading
+import time
+import tty
+import zlib
+import hci
+from HciSerialPort import HciFramer, HciSerialPort
+from lc_util import logger_setup
+
+
+class HciSimulator():
+    """Simulated Infineon HCI download mode controller attached to a pseudo terminal
+    (Linux/macOS only).
+
+    Answers HCI reset and the vendor specific download commands (download minidriver,
+    WRITE_RAM, VERIFY_CRC, LAUNCH_RAM, update baud rate and chip erase) with Command Complete
+    events. Their Num_HCI_Command_Packets is the number of the command_credits buffers that
+    are free. WRITE_RAM data is kept in a sparse memory that VERIFY_CRC reads back.
+    Open port_name with HciSerialPort to talk to the simulator.
+
+    The UART is modelled at the simulated baud rate: a command is processed once all of its
+    bytes would have arrived and a response is sent once its bytes would have been sent, so
+    download times are close to a real line. Commands that arrive while more than
+    command_credits are waiting are counted as credit_overruns.
+    Data is dropped while the host baud rate does not match the simulated baud rate.
+    WRITE_RAM data can be corrupted on purpose to test verification.
+    """
+
+    READ_TIMEOUT_SECS = 0.1
+    DEFAULT_BAUD = 115200
+    DEFAULT_COMMAND_CREDITS = 1
+    BITS_PER_BYTE = 10
+    PAGE_SIZE = 4096
+    FLASH_BASE = 0x500000
+    OPCODE_HCI_RESET = 0x0C03
+    NO_OP_DELAY_SECS = 0.01
+    STATUS_SUCCESS = 0x00
+    STATUS_UNKNOWN_COMMAND = 0x01
+    TERMIOS_BAUD_RATES = dict((getattr(termios, f'B{b}'), b) for b in
+                              [9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600,
+                               1000000, 2000000, 3000000] if hasattr(termios, f'B{b}'))
+
+    def __init__(self, latency: float = 0.0, command_credits: int = DEFAULT_COMMAND_CREDITS):
+        """
+        Args:
+            latency (float, optional): Processing time of each command in seconds.
+              Defaults to 0.0.
+            command_credits (int, optional): Number of command buffers of the controller.
+              Defaults to 1.
+        """
+        self.latency = latency
+        self.command_credits = command_credits
+        self.baud = self.DEFAULT_BAUD
+        # Bytes on the line are not delayed when False
+        self.model_line_rate = True
+        # Number of commands received by opcode
+        self.commands = {}
+        self.credit_overruns = 0
+        self.launch_address = None
+        # Fault injection: WRITE_RAM to these addresses stores corrupted data (once each)
+        self.corrupt_addresses = set()
+        # Fault injection: probability that a WRITE_RAM stores corrupted data
+        self.write_error_rate = 0.0
+        self.corrupted_writes = 0
+        # Credit starvation: the next responses report 0 credits, each followed by a
+        # No-op Command Complete that returns the free buffers after NO_OP_DELAY_SECS
+        self.zero_credit_responses = 0
+        self._pages = {}
+        self._framer = HciFramer()
+        self._commands = queue.Queue()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._master = None
+        self._slave = None
+        self._port_name = None
+        self._stop_threads = False
+        self._threads = []
+
+    @property
+    def port_name(self):
+        """Device name of the simulated serial port"""
+        return self._port_name
+
+    def start(self) -> str:
+        """Create the pseudo terminal and start answering commands
+
+        Returns:
+            str: Port name to open with HciSerialPort
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self._port_name = os.ttyname(self._slave)
+        self._stop_threads = False
+        self._threads = [threading.Thread(target=self.__rx_thread, daemon=True),
+                         threading.Thread(target=self.__command_thread, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        logging.debug(f'HCI simulator on {self._port_name}')
+        return self._port_name
+
+    def stop(self):
+        """Stop the simulator and close the pseudo terminal
+        """
+        self._stop_threads = True
+        for thread in self._threads:
+            thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __fill(self, address: int) -> int:
+        return HciSerialPort.FLASH_PAD if address >= self.FLASH_BASE else HciSerialPort.RAM_PAD
+
+    def read_memory(self, address: int, length: int) -> bytes:
+        """
+        Args:
+            address (int): Start address
+            length (int): Number of bytes
+
+        Returns:
+            bytes: Memory contents (unwritten flash reads as FLASH_PAD, RAM as RAM_PAD)
+        """
+        data = bytearray()
+        while length > 0:
+            offset = address % self.PAGE_SIZE
+            n = min(length, self.PAGE_SIZE - offset)
+            page = self._pages.get(address // self.PAGE_SIZE)
+            if page is None:
+                data += bytes([self.__fill(address)]) * n
+            else:
+                data += page[offset:offset + n]
+            address += n
+            length -= n
+        return bytes(data)
+
+    def write_memory(self, address: int, data: bytes):
+        """
+        Args:
+            address (int): Start address
+            data (bytes): Bytes to write
+        """
+        data = memoryview(data)
+        while len(data) > 0:
+            offset = address % self.PAGE_SIZE
+            n = min(len(data), self.PAGE_SIZE - offset)
+            page = self._pages.setdefault(address // self.PAGE_SIZE,
+                                          bytearray([self.__fill(address)]) * self.PAGE_SIZE)
+            page[offset:offset + n] = data[:n]
+            address += n
+            data = data[n:]
+
+    def __link_ok(self) -> bool:
+        host_baud = self.TERMIOS_BAUD_RATES.get(termios.tcgetattr(self._slave)[5])
+        return host_baud is None or host_baud == self.baud
+
+    def __line_time(self, length: int) -> float:
+        if not self.model_line_rate:
+            return 0.0
+        return length * self.BITS_PER_BYTE / self.baud
+
+    def __rx_thread(self):
+        while not self._stop_threads:
+            ready, _, _ = select.select([self._master], [], [], self.READ_TIMEOUT_SECS)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+            rx_time = time.perf_counter()
+            if not self.__link_ok():
+                logging.debug(f'HCI simulator: dropped {len(data)} bytes at {self.baud}')
+                self._framer.reset()
+                continue
+            for pkt in self._framer.feed(data):
+                if pkt.packet_type != hci.HciPacket.PacketType.COMMAND:
+                    continue
+                with self._lock:
+                    self._waiting += 1
+                    if self._waiting > self.command_credits:
+                        self.credit_overruns += 1
+                self._commands.put((pkt, rx_time))
+
+    def __command_thread(self):
+        # Times at which the host to controller and controller to host lines are free
+        rx_line = tx_line = time.perf_counter()
+        while not self._stop_threads:
+            try:
+                (pkt, rx_time) = self._commands.get(True, self.READ_TIMEOUT_SECS)
+            except queue.Empty:
+                continue
+            rx_line = max(rx_line, rx_time) + self.__line_time(len(pkt.binary))
+            done = max(rx_line, time.perf_counter()) + self.latency
+            (status, payload, after) = self.__process(pkt.opcode, bytes(pkt.binary[4:]))
+            tx_line = max(tx_line, done) + self.__line_time(len(payload) + 7)
+            delay = tx_line - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                self._waiting -= 1
+                # Free command buffers
+                credits = max(0, self.command_credits - self._waiting)
+                if self.zero_credit_responses > 0:
+                    self.zero_credit_responses -= 1
+                    credits = 0
+                    threading.Timer(self.NO_OP_DELAY_SECS, self.__send_no_op).start()
+            params = bytes([credits]) + pkt.opcode.to_bytes(2, 'little') + \
+                bytes([status]) + payload
+            event = bytes([hci.HciPacket.PacketType.EVENT, 0x0E, len(params)]) + params
+            if self.__link_ok():
+                os.write(self._master, event)
+            if after:
+                after()
+
+    def __send_no_op(self):
+        if self._stop_threads:
+            return
+        with self._lock:
+            credits = max(0, self.command_credits - self._waiting)
+        params = bytes([credits]) + HciSerialPort.OPCODE_NO_OP.to_bytes(2, 'little')
+        if self.__link_ok():
+            os.write(self._master, bytes([hci.HciPacket.PacketType.EVENT, 0x0E, len(params)]) +
+                     params)
+
+    def __process(self, opcode: int, params: bytes) -> tuple:
+        """
+        Returns:
+            tuple: (status, return parameters, function to call after the response is sent)
+        """
+        self.commands[opcode] = self.commands.get(opcode, 0) + 1
+        address = int.from_bytes(params[0:4], HciSerialPort.LITTLE_ENDIAN)
+        if opcode == HciSerialPort.OPCODE_WRITE_RAM:
+            data = params[4:]
+            if address in self.corrupt_addresses or random.random() < self.write_error_rate:
+                self.corrupt_addresses.discard(address)
+                self.corrupted_writes += 1
+                data = bytes([data[0] ^ 0xFF]) + data[1:]
+            self.write_memory(address, data)
+        elif opcode == HciSerialPort.OPCODE_VERIFY_CRC:
+            length = int.from_bytes(params[4:8], HciSerialPort.LITTLE_ENDIAN)
+            crc = zlib.crc32(self.read_memory(address, length))
+            return (self.STATUS_SUCCESS, crc.to_bytes(4, HciSerialPort.LITTLE_ENDIAN), None)
+        elif opcode == HciSerialPort.OPCODE_LAUNCH_RAM:
+            self.launch_address = address
+        elif opcode == HciSerialPort.OPCODE_UPDATE_BAUDRATE:
+            baud = int.from_bytes(params[2:6], HciSerialPort.LITTLE_ENDIAN)
+            # The controller switches after sending the response
+            return (self.STATUS_SUCCESS, b'', lambda: setattr(self, 'baud', baud))
+        elif opcode == HciSerialPort.OPCODE_CHIP_ERASE:
+            self._pages = dict((k, p) for k, p in self._pages.items()
+                               if k * self.PAGE_SIZE < self.FLASH_BASE)
+        elif opcode not in [self.OPCODE_HCI_RESET, HciSerialPort.OPCODE_DOWNLOAD_MINIDRIVER]:
+            return (self.STATUS_UNKNOWN_COMMAND, b'', None)
+        return (self.STATUS_SUCCESS, b'', None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Simulate an HCI download mode controller on a pseudo terminal')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Command processing time in seconds")
+    parser.add_argument('-c', '--credits', type=int, default=HciSimulator.DEFAULT_COMMAND_CREDITS,
+                        help="Number of command buffers of the controller")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    sim = HciSimulator(args.latency, args.credits)
+    logger.info(f'HCI simulator port: {sim.start()}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -4,6 +4,14 @@ from dvk_probe import DvkProbe
 from HciSerialPort import HciSerialPort
 from HciProgrammer import HciProgrammer
 from EzSerialPort import EzSerialPort
+from EzThroughput import EzThroughput
+from EzConnectionProfiler import ConnectionProfiler
+from EzConfig import ConfigReconciler
+from EzConnectionManager import ConnectionManager
+from EzDiscoveryCache import DiscoveryCache
+from EzBondManager import BondManager
+from EzClockSync import ClockSync
+from GattDatabase import GattDatabase
 from SerialPort import SerialPort
 
 ERR_OK = 0
@@ -19,6 +27,14 @@ class If820Board(DvkProbe):
     LP_MODE = DvkProbe.GPIO_20
     CONNECTION = DvkProbe.GPIO_21
     BOOT_DELAY = 1
+    GATT_DB_MARKER = b'GDB\x01'
+    GATT_DB_USER_DATA_OFFSET = 224
+    PUART_BAUD_RATES = [2000000, 1000000, 921600, 460800, 230400, 115200]
+    HCI_BAUD_RATES = [3000000, 2000000, 1000000, 921600, 460800, 230400, 115200]
+    # Shared by all boards so a peer discovered by one board is cached for the others
+    DISCOVERY_CACHE = DiscoveryCache()
+    # Bond managers by probe ID, so the bonds of a board outlive its If820Board objects
+    BOND_MANAGERS = {}
 
     @staticmethod
     def get_board():
@@ -87,12 +103,15 @@ class If820Board(DvkProbe):
         str_mac = bytearray(response).hex()
         return str_mac
 
-    def open_and_init_board(self, wait_for_boot: bool = True) -> object | None:
+    def open_and_init_board(self, wait_for_boot: bool = True, auto_baud: bool = True) -> object | None:
         """Opens the IF820 PUART at the default baud rate,
         opens the DvkProbe, and resets the IF280 Module.
 
         Args:
             wait_for_boot (bool, optional): Wait for the boot event. Defaults to True.
+            auto_baud (bool, optional): If there is no boot event at the default baud rate
+              (i.e. a previous test stored another rate), detect the rate and reset again.
+              Defaults to True.
 
         Returns:
             object | None: Returns the boot event packet if wait_for_boot is True, else None
@@ -102,6 +121,7 @@ class If820Board(DvkProbe):
         logging.info(f'EZ-Serial Port: {self.puart_port_name}')
         self.p_uart.open(
             self.puart_port_name, self.p_uart.IF820_DEFAULT_BAUD)
+        self._puart_boot_baud = self.p_uart.IF820_DEFAULT_BAUD
 
         # open dvk probe
         logging.info(f"Opening Dvk Probe ID {self.probe.id}")
@@ -111,7 +131,14 @@ class If820Board(DvkProbe):
                 f"Unable to open Dvk Probe at {self.probe.id}")
 
         # reset dvk and module
-        res = self.reset_module(wait_for_boot)
+        try:
+            res = self.reset_module(wait_for_boot)
+        except Exception as e:
+            if not auto_baud:
+                raise
+            logging.warning(f'{e}, detecting the PUART baud rate')
+            self._puart_boot_baud = self.detect_puart_baud()['baud']
+            res = self.reset_module(wait_for_boot)
         time.sleep(If820Board.BOOT_DELAY)
         self._is_initialized = True
         return res[1]
@@ -122,6 +149,10 @@ class If820Board(DvkProbe):
         Args:
             reset_probe (bool, optional): Resetting the probe resets the IO and the module.. Defaults to True.
         """
+        if self._connections is not None:
+            self._connections.stop()
+        if self._clock is not None:
+            self._clock.stop()
         if self.hci_uart:
             self.hci_uart.close()
         if self.p_uart:
@@ -141,6 +172,10 @@ class If820Board(DvkProbe):
         self._puart_port_name = ""
         self._hci_uart = None
         self._p_uart = None
+        self._puart_boot_baud = EzSerialPort.IF820_DEFAULT_BAUD
+        self._connections = None
+        self._bonds = None
+        self._clock = None
         self._is_initialized = False
 
     @property
@@ -168,6 +203,41 @@ class If820Board(DvkProbe):
         """PUART Port Instance"""
         return self._p_uart
 
+    @property
+    def connections(self) -> ConnectionManager:
+        """Connection manager of the PUART. Routes GATT client events per connection so
+        several links can be used at the same time. It is not started: start() it (or use it
+        in a with statement) and stop() it before waiting for connection events again."""
+        if self._connections is None or self._connections.port is not self._p_uart:
+            if self._connections is not None:
+                self._connections.stop()
+            self._connections = ConnectionManager(self._p_uart, If820Board.DISCOVERY_CACHE)
+        return self._connections
+
+    @property
+    def clock(self) -> ClockSync:
+        """Module clock correlation of the PUART. Call sync() (or start()) before converting
+        module timestamps (i.e. gpio_interrupt runtime) with event_host_time()."""
+        if self._clock is None or self._clock.port is not self._p_uart:
+            if self._clock is not None:
+                self._clock.stop()
+            self._clock = ClockSync(self._p_uart)
+        return self._clock
+
+    @property
+    def bonds(self) -> BondManager:
+        """Bonds of the module, kept across tests and suites that use the same board (probe).
+        The manager is rebound to the current PUART port when the board is opened again."""
+        key = self.probe.id if self.probe else None
+        if key is not None:
+            self._bonds = If820Board.BOND_MANAGERS.get(key, self._bonds)
+        if self._bonds is None:
+            self._bonds = BondManager(self._p_uart)
+        self._bonds.port = self._p_uart
+        if key is not None:
+            If820Board.BOND_MANAGERS[key] = self._bonds
+        return self._bonds
+
     @property
     def is_initialized(self):
         return self._is_initialized
@@ -208,7 +278,19 @@ class If820Board(DvkProbe):
         res = self.enter_hci_download_mode()
         if res != ERR_OK:
             raise Exception("Failed to enter HCI download mode")
+        return self.program_hci_firmware(minidriver, firmware, chip_erase)
+
+    def program_hci_firmware(self, minidriver: str, firmware: str, chip_erase: bool = False) -> int:
+        """Program firmware through the HCI UART. The module must be in HCI download mode.
 
+        Args:
+            minidriver (str): Path to the minidriver hex file
+            firmware (str): Path to the firmware file (hex or hcd)
+            chip_erase (bool, optional): Erase the whole flash first. Defaults to False.
+
+        Returns:
+            int: 0 if successful
+        """
         self.hci_programmer = HciProgrammer(minidriver, self.hci_port_name,
                                             HciProgrammer.HCI_DEFAULT_BAUDRATE, chip_erase)
         self.hci_programmer.program_firmware(
@@ -227,6 +309,10 @@ class If820Board(DvkProbe):
         Returns:
             tuple: (err code - 0 for success else error, Packet object)
         """
+        self.p_uart.clear_events(self.p_uart.EVENT_SYSTEM_BOOT)
+        # Baud rates set by escalate_puart_baud are not stored, the module boots at the old rate
+        if self.p_uart.port.baudrate != self._puart_boot_baud:
+            self.p_uart.set_baudrate(self._puart_boot_baud)
         self.probe.reset_target()
         ez_rsp = (0, None)
         if wait_for_boot:
@@ -254,6 +340,168 @@ class If820Board(DvkProbe):
         If820Board.check_if820_response(cmd, res)
         return res[1]
 
+    def gatt_notify_throughput(self, peer: 'If820Board', conn_handle: int, attr_handle: int,
+                               count: int, payload_size: int = 20, window: int = 4) -> dict:
+        """Measure GATT notification throughput from this board (GATT server) to a peer.
+
+        Args:
+            peer (If820Board): Connected board that receives the notifications
+            conn_handle (int): Connection handle on this board
+            attr_handle (int): Characteristic value handle to notify
+            count (int): Number of notifications
+            payload_size (int, optional): Bytes per notification. Defaults to 20.
+            window (int, optional): Maximum outstanding notify commands. Defaults to 4.
+
+        Returns:
+            dict: bytes_per_sec, latency percentiles, lost, out_of_order...
+        """
+        return EzThroughput(self.p_uart, peer.p_uart).gatt_notify(
+            conn_handle, attr_handle, count, payload_size, window)
+
+    def cyspp_throughput(self, peer: 'If820Board', count: int, payload_size: int = 128) -> dict:
+        """Measure CYSPP throughput from this board to a peer.
+        Both boards must be connected and in CYSPP data mode.
+
+        Args:
+            peer (If820Board): Connected board that receives the data
+            count (int): Number of payloads
+            payload_size (int, optional): Bytes per payload. Defaults to 128.
+
+        Returns:
+            dict: bytes_per_sec, latency percentiles, lost, out_of_order...
+        """
+        return EzThroughput(self.p_uart, peer.p_uart).cyspp(count, payload_size)
+
+    def profile_connections(self, peripheral: 'If820Board', cycles: int,
+                            notify_handle: int = None) -> dict:
+        """Connect to a peripheral board repeatedly and time each phase of the connection.
+
+        Args:
+            peripheral (If820Board): Board that advertises
+            cycles (int): Number of connection cycles
+            notify_handle (int, optional): Peripheral characteristic value handle used to time
+              the first notification. Defaults to None.
+
+        Returns:
+            dict: cycles, failed and the latency statistics (ms) of each phase
+              (see ConnectionProfiler)
+        """
+        return ConnectionProfiler(self.p_uart, peripheral.p_uart, notify_handle).run(cycles)
+
+    def __read_gatt_db_marker(self) -> tuple:
+        """Read the first handle and digest of the provisioned GATT database from user data"""
+        size = len(If820Board.GATT_DB_MARKER) + 2 + 16
+        cmd = self.p_uart.CMD_READ_USER_DATA
+        res = self.p_uart.send_and_wait(
+            cmd, offset=If820Board.GATT_DB_USER_DATA_OFFSET, length=size)
+        If820Board.check_if820_response(cmd, res)
+        data = bytes(res[1].payload['data'])
+        if len(data) != size or not data.startswith(If820Board.GATT_DB_MARKER):
+            return (None, None)
+        offset = len(If820Board.GATT_DB_MARKER)
+        return (int.from_bytes(data[offset:offset + 2], 'little'), data[offset + 2:])
+
+    def __write_gatt_db_marker(self, first_handle: int = None, digest: bytes = None):
+        """Write (or clear when first_handle is None) the GATT database marker in user data"""
+        if first_handle is None:
+            data = bytes(len(If820Board.GATT_DB_MARKER) + 2 + 16)
+        else:
+            data = If820Board.GATT_DB_MARKER + \
+                first_handle.to_bytes(2, 'little') + digest
+        cmd = self.p_uart.CMD_WRITE_USER_DATA
+        If820Board.check_if820_response(cmd, self.p_uart.send_and_wait(
+            cmd, offset=If820Board.GATT_DB_USER_DATA_OFFSET, data=data))
+
+    def provision_gatt_db(self, db: GattDatabase, force: bool = False, reboot: bool = True) -> dict:
+        """Create a custom GATT database unless the module already holds the same one.
+        A hash of the database is kept in user data to detect changes.
+        A database provisioned previously by this function is deleted first.
+
+        Args:
+            db (GattDatabase): The database
+            force (bool, optional): Provision even if the hash matches. Defaults to False.
+            reboot (bool, optional): Reboot the module after storing the configuration.
+              Defaults to True.
+
+        Returns:
+            dict: Attribute handle by name (see GattDatabase.handles)
+        """
+        digest = db.digest()
+        (first_handle, stored_digest) = self.__read_gatt_db_marker()
+        if not force and stored_digest == digest:
+            logging.info('GATT database unchanged, skip provisioning')
+            return db.handles(first_handle)
+
+        # Clear the marker first so an interrupted provisioning is not trusted
+        self.__write_gatt_db_marker()
+        if first_handle is not None:
+            cmd = self.p_uart.CMD_GATTS_DELETE_ATTR
+            If820Board.check_if820_response(
+                cmd, self.p_uart.send_and_wait(cmd, attr_handle=first_handle))
+        cmd = self.p_uart.CMD_GATTS_CREATE_ATTR
+        # The first attribute (a service declaration) gives the handle the characteristic
+        # declarations need, the others are pipelined
+        attributes = db.compile(0)
+        res = self.p_uart.send_and_wait(cmd, **attributes[0])
+        If820Board.check_if820_response(cmd, res)
+        first_handle = res[1].payload['handle']
+        results = self.p_uart.send_pipelined(
+            [(cmd, kwargs) for kwargs in db.compile(first_handle)[1:]])
+        for res in results:
+            If820Board.check_if820_response(cmd, res)
+        created = [first_handle] + [res[1].payload['handle'] for res in results]
+        if created != list(range(created[0], created[0] + len(created))):
+            raise Exception(f'GATT database handles are not consecutive: {created}')
+        cmd = self.p_uart.CMD_STORE_CONFIG
+        If820Board.check_if820_response(cmd, self.p_uart.send_and_wait(cmd))
+        self.__write_gatt_db_marker(created[0], digest)
+        if reboot:
+            cmd = self.p_uart.CMD_REBOOT
+            If820Board.check_if820_response(cmd, self.p_uart.send_and_wait(cmd))
+            cmd = self.p_uart.EVENT_SYSTEM_BOOT
+            If820Board.check_if820_response(cmd, self.p_uart.wait_event(cmd))
+        return db.handles(created[0])
+
+    def secure_connection(self, conn_handle: int, address: list, peer: 'If820Board' = None) -> dict:
+        """Encrypt a connection. A bonded peer is encrypted with the stored keys and pairing
+        only runs when there is no usable bond.
+
+        Args:
+            conn_handle (int): Connection handle on this board
+            address (list): Peer address (as in gap_connected)
+            peer (If820Board, optional): The peer board, its bond list is updated too.
+              Defaults to None.
+
+        Returns:
+            dict: bonded, paired and seconds (see BondManager.secure)
+        """
+        result = self.bonds.secure(conn_handle, address)
+        if peer is not None and result['paired']:
+            peer.bonds.forget()
+        return result
+
+    def reconcile_config(self, desired: dict, store: bool = True) -> dict:
+        """Bring the module settings to a desired state. The current values are read in one
+        pipelined pass and only the settings that differ are written (see ConfigReconciler).
+
+        Example:
+            board.reconcile_config({'device_name': 'DUT',
+                                    'adv_parameters': {'high_interval': 48},
+                                    'conn_parameters': {'interval': 6}})
+
+        Args:
+            desired (dict): Set command arguments by setting
+            store (bool, optional): Store the configuration in flash if anything changed.
+              Defaults to True.
+
+        Returns:
+            dict: read, changes, stored and seconds
+        """
+        result = ConfigReconciler(self.p_uart).apply(desired, store)
+        if result['stored']:
+            self._puart_boot_baud = self.p_uart.port.baudrate
+        return result
+
     def reconfig_puart(self, baud: int):
         """Reconfigure the PUART baud rate.
 
@@ -263,6 +511,96 @@ class If820Board(DvkProbe):
         self.p_uart.close()
         self.p_uart.open(
             self.puart_port_name, baud)
+        self._puart_boot_baud = baud
+
+    def escalate_puart_baud(self, rates: list = None) -> int:
+        """Switch the PUART to the fastest baud rate that works, without reopening the port.
+        Each rate is confirmed with a ping. If the module can't be reached at a rate
+        and not at the previous rate either, the module is reset and the next rate is tried.
+
+        Args:
+            rates (list, optional): Baud rates to try. Defaults to PUART_BAUD_RATES.
+
+        Returns:
+            int: The baud rate in use
+        """
+        if rates is None:
+            rates = If820Board.PUART_BAUD_RATES
+        current = self.p_uart.port.baudrate
+        for baud in sorted(rates, reverse=True):
+            if baud <= current:
+                break
+            if self.p_uart.change_uart_baud(baud):
+                return baud
+            if not self.p_uart.ping(rxtimeout=EzSerialPort.UART_BAUD_PING_TIMEOUT_SECS):
+                self.reset_module()
+        return self.p_uart.port.baudrate
+
+    @staticmethod
+    def __likely_first(likely: list, rates: list) -> list:
+        """Candidate baud rates: the likely ones, then the others from fastest to slowest"""
+        return list(dict.fromkeys(likely + sorted(rates, reverse=True)))
+
+    def detect_puart_baud(self, rates: list = None) -> dict:
+        """Find the baud rate of the module (i.e. left at another rate by a previous test)
+        and switch the open PUART to it. Each rate is tried with a short ping: the current,
+        boot and default rates first, then the others from fastest to slowest.
+
+        Args:
+            rates (list, optional): Baud rates to try. Defaults to PUART_BAUD_RATES.
+
+        Returns:
+            dict: baud, flow (CTS/RTS), tried (number of rates tried),
+              parameters (system_get_uart_parameters) and seconds
+        """
+        start = time.perf_counter()
+        if rates is None:
+            rates = If820Board.PUART_BAUD_RATES
+        candidates = If820Board.__likely_first(
+            [self.p_uart.port.baudrate, self._puart_boot_baud, EzSerialPort.IF820_DEFAULT_BAUD],
+            rates)
+        baud = self.p_uart.detect_baud(candidates)
+        if baud is None:
+            raise Exception(f'No response from {self.puart_port_name} at {candidates}')
+        cmd = self.p_uart.CMD_GET_UART_PARAMS
+        res = self.p_uart.send_and_wait(cmd, clear_queue=False, uart_type=0)
+        If820Board.check_if820_response(cmd, res)
+        return {'baud': baud, 'flow': self.p_uart.port.rtscts,
+                'tried': candidates.index(baud) + 1,
+                'parameters': dict((k, v) for k, v in res[1].payload.items() if k != 'result'),
+                'seconds': round(time.perf_counter() - start, 4)}
+
+    def detect_hci_baud(self, rates: list = None) -> dict:
+        """Find the baud rate of the HCI UART (i.e. left at the programming rate) and switch
+        the HCI port to it. The port is opened at the default rate if it isn't open.
+        Each rate is tried with an HCI reset: the current, default and programming rates
+        first, then the others from fastest to slowest.
+
+        Args:
+            rates (list, optional): Baud rates to try. Defaults to HCI_BAUD_RATES.
+
+        Returns:
+            dict: baud, flow (CTS/RTS), tried (number of rates tried) and seconds
+        """
+        start = time.perf_counter()
+        if rates is None:
+            rates = If820Board.HCI_BAUD_RATES
+        is_open = self.hci_uart is not None and self.hci_uart.port is not None and \
+            self.hci_uart.port.is_open
+        if not isinstance(self.hci_uart, HciSerialPort) or not is_open:
+            if is_open:
+                self.hci_uart.close()
+            self._hci_uart = HciSerialPort()
+            self.hci_uart.open(self.hci_port_name, HciProgrammer.HCI_DEFAULT_BAUDRATE)
+        candidates = If820Board.__likely_first(
+            [self.hci_uart.port.baudrate, HciProgrammer.HCI_DEFAULT_BAUDRATE,
+             HciProgrammer.HCI_FLASH_FIRMWARE_BAUDRATE], rates)
+        baud = self.hci_uart.detect_baud(candidates)
+        if baud is None:
+            raise Exception(f'No HCI response from {self.hci_port_name} at {candidates}')
+        return {'baud': baud, 'flow': self.hci_uart.port.rtscts,
+                'tried': candidates.index(baud) + 1,
+                'seconds': round(time.perf_counter() - start, 4)}
 
     def open_hci_uart_raw(self, baud: int):
         """Open the HCI UART as a raw serial port.
@@ -167,6 +167,17 @@ class SerialPort():
         """Serial port object"""
         return self._port
 
+    def set_baudrate(self, baud: int):
+        """Change the baud rate without closing the port.
+        Pending TX bytes are sent first, bytes received but not yet processed are discarded.
+
+        Args:
+            baud (int): baud rate
+        """
+        self._port.flush()
+        self._port.baudrate = baud
+        self.clear_rx_queue()
+
     def read(self) -> bytes:
         """Read bytes from the serial port
 
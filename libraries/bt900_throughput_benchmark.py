@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+from BT900SerialPort import BT900SerialPort
+from BT900Simulator import BT900Simulator
+from BT900Throughput import BT900Throughput
+from EzSerialPort import EzSerialPort
+from EzSerialSimulator import EzSerialSimulator
+from lc_util import logger_setup, logger_get
+
+logger = logger_get(__name__)
+
+
+def bench_stream(count: int, payload_size: int, window: int, busy_every: int,
+                 latency: float) -> dict:
+    """Stream from a simulated BT900 in command mode to a simulated IF820 in data mode
+
+    Args:
+        count (int): Number of payloads per stream
+        payload_size (int): Bytes per payload before hex encoding
+        window (int): Maximum outstanding write commands
+        busy_every (int): The BT900 rejects every this many writes (0 = never)
+        latency (float): Simulated BT900 command processing time in seconds
+
+    Returns:
+        dict: spp and cyspp throughput results
+    """
+    ez_sim = EzSerialSimulator()
+    ez_sim.set_cyspp_data_mode(True)
+    bt900_sim = BT900Simulator(ez_sim, latency)
+    ez_port = EzSerialPort()
+    ez_port.open(ez_sim.start(), EzSerialPort.IF820_DEFAULT_BAUD)
+    bt900_port = BT900SerialPort()
+    bt900_port.open(bt900_sim.start())
+    results = {}
+    try:
+        bt900_port.enter_command_mode()
+        bt900_sim.busy_every = busy_every
+        throughput = BT900Throughput(bt900_port, ez_port)
+        results['spp'] = throughput.spp(count, payload_size, window)
+        results['cyspp'] = throughput.cyspp(count, payload_size, window)
+    finally:
+        bt900_port.close()
+        ez_port.close()
+        bt900_sim.stop()
+        ez_sim.stop()
+    return results
+
+
+def run_benchmarks(count: int = 200, payload_size: int = 64, latency: float = 0.0) -> dict:
+    """Stream with a window of 1 and 4 write commands, and with rejected writes
+
+    Args:
+        count (int, optional): Number of payloads per stream. Defaults to 200.
+        payload_size (int, optional): Bytes per payload before hex encoding. Defaults to 64.
+        latency (float, optional): Simulated BT900 command processing time in seconds.
+          Defaults to 0.0.
+
+    Returns:
+        dict: Benchmark results
+    """
+    return {'window_1': bench_stream(count, payload_size, 1, 0, latency),
+            'window_4': bench_stream(count, payload_size, 4, 0, latency),
+            'window_4_busy': bench_stream(count, payload_size, 4, 10, latency)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark BT900 to IF820 streaming against simulators')
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help="Number of payloads per stream")
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help="Bytes per payload before hex encoding")
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Simulated BT900 command processing time in seconds")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    results = run_benchmarks(args.count, args.size, args.latency)
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
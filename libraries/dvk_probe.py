@@ -29,6 +29,13 @@ MAX_SETTINGS_SIZE = 256
 PROBE_VENDOR_STRING_LC = 'Laird Connectivity'
 PROBE_VENDOR_STRING_EZ = 'Ezurio'
 PROBE_PRODUCT_STRING = 'DVK Probe CMSIS-DAP'
+DAP_INFO = 0x00
+DAP_INFO_PACKET_SIZE = 0xFF
+DAP_EXECUTE_COMMANDS = 0x7F
+DAP_VENDOR0 = 0x80
+DAP_DEFAULT_PACKET_SIZE = 64
+# Response data bytes (after the command ID) of the vendor commands used in batches
+VENDOR_RESPONSE_LENGTHS = {SET_IO_DIR_CMD: 1, SET_IO_CMD: 1, READ_IO_CMD: 1}
 
 
 class ProbeSettings(c.Structure):
@@ -68,6 +75,16 @@ class DvkProbe(Probe):
     GPIO_27 = 27
     GPIO_28 = 28
 
+    EDGE_RISING = 'rising'
+    EDGE_FALLING = 'falling'
+    EDGE_ANY = 'any'
+
+    GPIO_OP_INPUT = 'input'
+    GPIO_OP_OUTPUT = 'output'
+    GPIO_OP_HIGH = 'high'
+    GPIO_OP_LOW = 'low'
+    GPIO_OP_READ = 'read'
+
     def __init__(self,
                  id,
                  description: str = "",
@@ -76,6 +93,9 @@ class DvkProbe(Probe):
 
         super().__init__(id, description, ports, family)
         self.__probe_handle = None
+        # Unknown until probed before the first batch
+        self.__execute_commands_supported = None
+        self.__packet_size = DAP_DEFAULT_PACKET_SIZE
 
     @staticmethod
     def get_connected_probes(with_comports: bool = True) -> list['DvkProbe']:
@@ -156,6 +176,188 @@ class DvkProbe(Probe):
         res = self.__probe_handle.vendor(READ_IO_CMD, [gpio])
         return res[0]
 
+    def __gpio_sample(self, gpio: int) -> tuple:
+        """Read a GPIO and estimate when it was sampled (middle of the USB transaction)"""
+        start = time.perf_counter()
+        level = self.gpio_read(gpio)
+        return (level, (start + time.perf_counter()) / 2)
+
+    def gpio_wait_for_edge(self, gpio: int, edge: str = EDGE_ANY, timeout: float = 1,
+                           poll_interval: float = 0) -> float | None:
+        """Wait for a transition of a GPIO input.
+        The probe has no GPIO events, so the pin is read back to back (one vendor
+        command round trip per sample) unless poll_interval is set.
+
+        Args:
+            gpio (int): GPIO number
+            edge (str, optional): EDGE_RISING, EDGE_FALLING or EDGE_ANY. Defaults to EDGE_ANY.
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+            poll_interval (float, optional): Delay between samples in seconds. Defaults to 0.
+
+        Returns:
+            float | None: time.perf_counter() estimate of the transition (between the last sample
+              at the old level and the first at the new level), None on timeout
+        """
+        deadline = time.perf_counter() + timeout
+        (level, last_time) = self.__gpio_sample(gpio)
+        while last_time < deadline:
+            if poll_interval > 0:
+                time.sleep(poll_interval)
+            (new_level, sample_time) = self.__gpio_sample(gpio)
+            if new_level != level:
+                if edge == DvkProbe.EDGE_ANY or \
+                        (edge == DvkProbe.EDGE_RISING and new_level) or \
+                        (edge == DvkProbe.EDGE_FALLING and not new_level):
+                    return (last_time + sample_time) / 2
+                level = new_level
+            last_time = sample_time
+        return None
+
+    def gpio_wait_for_level(self, gpio: int, level: int, timeout: float = 1,
+                            poll_interval: float = 0) -> float | None:
+        """Wait for a GPIO input to be at a level
+
+        Args:
+            gpio (int): GPIO number
+            level (int): HIGH or LOW
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+            poll_interval (float, optional): Delay between samples in seconds. Defaults to 0.
+
+        Returns:
+            float | None: time.perf_counter() when the level was first read, None on timeout
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            (new_level, sample_time) = self.__gpio_sample(gpio)
+            if bool(new_level) == bool(level):
+                return sample_time
+            if sample_time >= deadline:
+                return None
+            if poll_interval > 0:
+                time.sleep(poll_interval)
+
+    @staticmethod
+    def __gpio_op_command(op: tuple) -> list:
+        """Vendor command bytes of a batch operation"""
+        (name, gpio) = op[:2]
+        option = op[2] if len(op) > 2 else 0
+        if name == DvkProbe.GPIO_OP_INPUT:
+            return [DAP_VENDOR0 + SET_IO_DIR_CMD, gpio, INPUT, option]
+        elif name == DvkProbe.GPIO_OP_OUTPUT:
+            return [DAP_VENDOR0 + SET_IO_DIR_CMD, gpio, OUTPUT, option]
+        elif name == DvkProbe.GPIO_OP_HIGH:
+            return [DAP_VENDOR0 + SET_IO_CMD, gpio, HIGH]
+        elif name == DvkProbe.GPIO_OP_LOW:
+            return [DAP_VENDOR0 + SET_IO_CMD, gpio, LOW]
+        elif name == DvkProbe.GPIO_OP_READ:
+            return [DAP_VENDOR0 + READ_IO_CMD, gpio]
+        raise ValueError(f'Unknown GPIO operation {name}')
+
+    @staticmethod
+    def __response_length(cmd: list, resp: list, i: int) -> int:
+        """Data bytes of the response to cmd that starts (after its command ID) at resp[i]"""
+        if cmd[0] == DAP_INFO:
+            return 1 + resp[i]
+        return VENDOR_RESPONSE_LENGTHS[cmd[0] - DAP_VENDOR0]
+
+    @staticmethod
+    def __parse_responses(commands: list, resp: list) -> list:
+        """Split a DAP_ExecuteCommands response (after its command ID) by command
+
+        Returns:
+            list: Response data of each command (without its command ID)
+        """
+        if len(resp) == 0 or resp[0] != len(commands):
+            raise Exception(f'DAP_ExecuteCommands answered {resp[0] if resp else 0} '
+                            f'of {len(commands)} commands')
+        results = []
+        i = 1
+        for cmd in commands:
+            if i >= len(resp) or resp[i] != cmd[0]:
+                raise Exception(f'Unexpected response to command 0x{cmd[0]:02X}')
+            i += 1
+            if i >= len(resp) or i + DvkProbe.__response_length(cmd, resp, i) > len(resp):
+                raise Exception(f'Truncated response to command 0x{cmd[0]:02X}')
+            length = DvkProbe.__response_length(cmd, resp, i)
+            results.append(list(resp[i:i + length]))
+            i += length
+        return results
+
+    def __execute_commands(self, commands: list) -> list:
+        """Send commands in one DAP_ExecuteCommands transaction.
+        pyocd's vendor() sends DAP_Vendor0 + index and checks the command ID of the
+        response, so DAP_ExecuteCommands (the ID below DAP_Vendor0) goes through it too.
+
+        Returns:
+            list: Response data of each command (without its command ID)
+        """
+        resp = self.__probe_handle.vendor(
+            DAP_EXECUTE_COMMANDS - DAP_VENDOR0,
+            [len(commands)] + [b for cmd in commands for b in cmd])
+        return DvkProbe.__parse_responses(commands, resp)
+
+    def __detect_execute_commands(self) -> bool:
+        """Check DAP_ExecuteCommands support with a DAP_Info request, which has no side
+        effects, and read the probe packet size with it"""
+        try:
+            (info,) = self.__execute_commands([[DAP_INFO, DAP_INFO_PACKET_SIZE]])
+        except Exception as e:
+            logger.debug(f'Probe {self.id} does not support DAP_ExecuteCommands: {e}')
+            return False
+        if info[0] == 2:
+            self.__packet_size = int.from_bytes(bytes(info[1:3]), 'little')
+        return True
+
+    def gpio_batch(self, operations: list) -> list:
+        """Run several GPIO operations with as few USB transactions as possible.
+        Operations are packed into DAP_ExecuteCommands transactions that fill a probe packet.
+        Probes that don't support DAP_ExecuteCommands (checked once before the first batch)
+        run them one by one.
+
+        Args:
+            operations (list): Tuples (operation, gpio) or (operation, gpio, option) where
+              operation is GPIO_OP_INPUT, GPIO_OP_OUTPUT, GPIO_OP_HIGH, GPIO_OP_LOW or GPIO_OP_READ.
+
+        Returns:
+            list: Result of each operation in order (the level for reads, else the status)
+        """
+        commands = [DvkProbe.__gpio_op_command(op) for op in operations]
+        if len(commands) == 0:
+            return []
+        if self.__execute_commands_supported is None:
+            self.__execute_commands_supported = self.__detect_execute_commands()
+        if not self.__execute_commands_supported:
+            return [self.__probe_handle.vendor(cmd[0] - DAP_VENDOR0, cmd[1:])[0]
+                    for cmd in commands]
+        results = []
+        batch = []
+        # Request and response sizes, including the DAP_ExecuteCommands header
+        request_len = response_len = 2
+        for cmd in commands + [None]:
+            if cmd is None or len(batch) == 255 or \
+                    request_len + len(cmd) > self.__packet_size or \
+                    response_len + 1 + VENDOR_RESPONSE_LENGTHS[cmd[0] - DAP_VENDOR0] > \
+                    self.__packet_size:
+                results.extend(r[0] for r in self.__execute_commands(batch))
+                batch = []
+                request_len = response_len = 2
+            if cmd is not None:
+                batch.append(cmd)
+                request_len += len(cmd)
+                response_len += 1 + VENDOR_RESPONSE_LENGTHS[cmd[0] - DAP_VENDOR0]
+        return results
+
+    def gpio_read_many(self, gpios: list) -> dict:
+        """Read several GPIOs at once
+
+        Args:
+            gpios (list): GPIO numbers
+
+        Returns:
+            dict: Level by GPIO number
+        """
+        return dict(zip(gpios, self.gpio_batch([(DvkProbe.GPIO_OP_READ, g) for g in gpios])))
+
     def gpio_to_input(self, gpio: int, option: int = 0):
         res = self.__probe_handle.vendor(SET_IO_DIR_CMD, [gpio, INPUT, option])
         return res[0]
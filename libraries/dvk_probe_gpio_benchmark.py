@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import threading
+import time
+from dvk_probe import DvkProbe, HIGH, LOW
+from lc_util import logger_setup, logger_get, latency_stats
+
+logger = logger_get(__name__)
+
+GPIOS = [DvkProbe.GPIO_16, DvkProbe.GPIO_17, DvkProbe.GPIO_18, DvkProbe.GPIO_19,
+         DvkProbe.GPIO_20, DvkProbe.GPIO_21, DvkProbe.GPIO_22, DvkProbe.GPIO_26,
+         DvkProbe.GPIO_27, DvkProbe.GPIO_28]
+
+
+def bench_gpio_read(probe: DvkProbe, gpio: int, count: int) -> dict:
+    """Round trip time of a single GPIO read"""
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        probe.gpio_read(gpio)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+
+def bench_read_many(probe: DvkProbe, gpios: list, count: int) -> dict:
+    """Snapshot of several GPIOs, one read per pin versus one batch"""
+    single = []
+    batch = []
+    for _ in range(count):
+        start = time.perf_counter()
+        for gpio in gpios:
+            probe.gpio_read(gpio)
+        single.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        probe.gpio_read_many(gpios)
+        batch.append(time.perf_counter() - start)
+    return {'gpios': len(gpios), 'single': latency_stats(single), 'batch': latency_stats(batch)}
+
+
+def bench_edge_detection(probe: DvkProbe, out_gpio: int, in_gpio: int, count: int,
+                         poll_interval: float = None) -> dict:
+    """Latency from driving out_gpio high to detecting the edge on in_gpio (jumpered to out_gpio).
+
+    Args:
+        poll_interval (float, optional): Measure a gpio_read + sleep polling loop instead of
+          gpio_wait_for_edge. Defaults to None.
+    """
+    probe.gpio_to_input(in_gpio)
+    probe.gpio_to_output(out_gpio)
+    samples = []
+    missed = 0
+    for _ in range(count):
+        probe.gpio_to_output_low(out_gpio)
+        probe.gpio_wait_for_level(in_gpio, LOW)
+        drive_time = []
+
+        def drive():
+            time.sleep(random.uniform(0.005, 0.02))
+            start = time.perf_counter()
+            probe.gpio_to_output_high(out_gpio)
+            drive_time.append((start + time.perf_counter()) / 2)
+
+        thread = threading.Thread(target=drive)
+        thread.start()
+        if poll_interval is None:
+            detected = probe.gpio_wait_for_edge(in_gpio, DvkProbe.EDGE_RISING)
+        else:
+            # How tests poll a line today
+            detected = None
+            deadline = time.perf_counter() + 1
+            while time.perf_counter() < deadline:
+                if probe.gpio_read(in_gpio) == HIGH:
+                    detected = time.perf_counter()
+                    break
+                time.sleep(poll_interval)
+        thread.join()
+        if detected is None:
+            missed += 1
+        else:
+            samples.append(detected - drive_time[0])
+    probe.gpio_to_input(out_gpio)
+    return dict(latency_stats(samples), missed=missed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark DVK probe GPIO reads and edge detection latency. '
+        'Edge detection needs out_gpio jumpered to in_gpio.')
+    parser.add_argument('-p', '--probe', default=None,
+                        help="Probe ID (default first probe found)")
+    parser.add_argument('-i', '--in_gpio', type=int, default=DvkProbe.GPIO_27,
+                        help="GPIO that is read")
+    parser.add_argument('-g', '--out_gpio', type=int, default=None,
+                        help="GPIO that drives in_gpio. Edge detection is skipped if not set.")
+    parser.add_argument('-n', '--count', type=int, default=100,
+                        help="Number of samples")
+    parser.add_argument('-s', '--poll_interval', type=float, default=0.01,
+                        help="Sleep of the polling loop that is compared against")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    probes = DvkProbe.get_connected_probes(with_comports=False)
+    if args.probe:
+        probes = [p for p in probes if p.id == args.probe]
+    if len(probes) == 0:
+        raise Exception('No probe found')
+    probe = probes[0]
+    probe.open()
+    results = {'gpio_read': bench_gpio_read(probe, args.in_gpio, args.count)}
+    results['gpio_read_many'] = bench_read_many(probe, GPIOS, args.count)
+    if args.out_gpio is not None:
+        results['wait_for_edge'] = bench_edge_detection(
+            probe, args.out_gpio, args.in_gpio, args.count)
+        results[f'poll_{args.poll_interval}s'] = bench_edge_detection(
+            probe, args.out_gpio, args.in_gpio, args.count, args.poll_interval)
+    probe.close()
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+from EzSerialPort import EzSerialPort
+from EzClockSync import ClockSync
+from EzSerialSimulator import EzSerialSimulator
+from EzThroughput import EzThroughput
+from lc_util import logger_setup, logger_get, latency_stats
+
+logger = logger_get(__name__)
+
+
+def bench_send_and_wait(port: EzSerialPort, count: int) -> dict:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        res = port.send_and_wait(port.CMD_PING)
+        samples.append(time.perf_counter() - start)
+        if res[0] != 0:
+            raise Exception(f'Ping failed: {res}')
+    return latency_stats(samples)
+
+
+def bench_pipelined(port: EzSerialPort, count: int, window: int) -> dict:
+    port.set_command_window(window)
+    commands = [(port.CMD_READ_USER_DATA, {'offset': i % 256, 'length': 16})
+                for i in range(count)]
+    start = time.perf_counter()
+    results = port.send_pipelined(commands)
+    elapsed = time.perf_counter() - start
+    port.set_command_window(EzSerialPort.COMMAND_WINDOW_DEFAULT)
+    failed = len([r for r in results if r[0] != 0])
+    return {'window': window, 'commands': count, 'failed': failed,
+            'seconds': round(elapsed, 4), 'commands_per_sec': round(count / elapsed, 1)}
+
+
+def bench_wait_event(port: EzSerialPort, sim: EzSerialSimulator, count: int) -> dict:
+    port.clear_events()
+    start = time.perf_counter()
+    sim.flood_events(port.EVENT_GAP_SCAN_RESULT, count,
+                     address=lambda i: [i & 0xFF, i >> 8, 0, 0, 0, 0xC0],
+                     rssi=-50, data=bytes([2, 1, 6]))
+    received = 0
+    while received < count:
+        if port.wait_event(port.EVENT_GAP_SCAN_RESULT)[0] != 0:
+            break
+        received += 1
+    elapsed = time.perf_counter() - start
+    return {'events': count, 'received': received, 'seconds': round(elapsed, 4),
+            'events_per_sec': round(received / elapsed, 1)}
+
+
+def bench_baud_rates(port: EzSerialPort, rates: list, count: int) -> dict:
+    """Bulk command throughput (pipelined 32 byte user data writes) at each baud rate.
+    The port is switched in place and returned to the starting rate afterwards.
+    A real module must be reset if it becomes unreachable at a rate.
+    """
+    start_baud = port.port.baudrate
+    results = {}
+    data = bytes(range(32))
+    commands = [(port.CMD_WRITE_USER_DATA, {'offset': 0, 'data': data})
+                for _ in range(count)]
+    for baud in rates:
+        if not port.change_uart_baud(baud):
+            results[baud] = {'error': 'no response'}
+            if not port.ping():
+                # The module switched but can't be reached, the remaining rates can't be tested
+                break
+            continue
+        start = time.perf_counter()
+        res = port.send_pipelined(commands)
+        elapsed = time.perf_counter() - start
+        results[baud] = {'commands': count, 'failed': len([r for r in res if r[0] != 0]),
+                         'commands_per_sec': round(count / elapsed, 1),
+                         'payload_bytes_per_sec': round(count * len(data) / elapsed, 1)}
+    port.change_uart_baud(start_baud)
+    return results
+
+
+def bench_user_data_blob(port: EzSerialPort, size: int = 256) -> dict:
+    """Write and verify a user data blob, one chunk at a time and with pipelining"""
+    data = bytes((i * 7) & 0xFF for i in range(size))
+    results = {}
+    for window in [1, EzSerialPort.COMMAND_WINDOW_DEFAULT, 8]:
+        port.set_command_window(window)
+        results[f'window_{window}'] = port.write_user_data_blob(data)
+    port.set_command_window(EzSerialPort.COMMAND_WINDOW_DEFAULT)
+    return results
+
+
+def bench_gatt_blob(size: int, latency: float, procedure_latency: float = 0.0075) -> dict:
+    """Stream a blob between two connected simulators with gattc_write_handle"""
+    sims = [EzSerialSimulator(latency), EzSerialSimulator(latency)]
+    ports = []
+    for sim in sims:
+        sim.procedure_latency = procedure_latency
+        port = EzSerialPort()
+        port.open(sim.start(), EzSerialPort.IF820_DEFAULT_BAUD)
+        ports.append(port)
+    sims[0].set_peer(sims[1])
+    sims[1].set_peer(sims[0])
+    data = bytes((i * 13) & 0xFF for i in range(size))
+    results = {}
+    try:
+        res = ports[0].send_and_wait(ports[0].CMD_GAP_CONNECT, address=sims[1].address, type=0,
+                                     interval=6, slave_latency=0, supervision_timeout=100,
+                                     scan_interval=64, scan_window=64, scan_timeout=0)
+        conn_handle = res[1].payload['conn_handle']
+        for window in [1, EzSerialPort.COMMAND_WINDOW_DEFAULT, 8]:
+            ports[0].set_command_window(window)
+            results[f'window_{window}'] = ports[0].write_gatt_blob(
+                conn_handle, 0x20, data, chunk_size=244, receiver=ports[1])
+    finally:
+        for port, sim in zip(ports, sims):
+            port.close()
+            sim.stop()
+    return results
+
+
+def bench_throughput(count: int, latency: float) -> dict:
+    """Stream GATT notifications and CYSPP data between two connected simulators"""
+    sims = [EzSerialSimulator(latency), EzSerialSimulator(latency)]
+    ports = []
+    for sim in sims:
+        port = EzSerialPort()
+        port.open(sim.start(), EzSerialPort.IF820_DEFAULT_BAUD)
+        ports.append(port)
+    sims[0].set_peer(sims[1])
+    sims[1].set_peer(sims[0])
+    results = {}
+    try:
+        res = ports[0].send_and_wait(ports[0].CMD_GAP_CONNECT, address=sims[1].address, type=0,
+                                     interval=6, slave_latency=0, supervision_timeout=100,
+                                     scan_interval=64, scan_window=64, scan_timeout=0)
+        conn_handle = res[1].payload['conn_handle']
+        throughput = EzThroughput(ports[0], ports[1])
+        for window in [1, 4, 8]:
+            results[f'gatt_notify_window_{window}'] = throughput.gatt_notify(
+                conn_handle, 0x20, count, payload_size=244, window=window)
+        for sim in sims:
+            sim.set_cyspp_data_mode(True)
+        results['cyspp'] = throughput.cyspp(count, payload_size=128)
+    finally:
+        for port, sim in zip(ports, sims):
+            port.close()
+            sim.stop()
+    return results
+
+
+def bench_clock_sync(latency: float, jitter: float, pings: int = 32) -> dict:
+    """Accuracy of ClockSync against the simulator, whose runtime starts at a known host
+    time, before and after a module reboot"""
+    sim = EzSerialSimulator(latency, jitter)
+    port = EzSerialPort()
+    port.open(sim.start(), EzSerialPort.IF820_DEFAULT_BAUD)
+    clock = ClockSync(port)
+    results = {}
+    try:
+        for phase in ['boot', 'reboot']:
+            if phase == 'reboot':
+                port.send_and_wait(port.CMD_REBOOT)
+                port.wait_event(port.EVENT_SYSTEM_BOOT)
+            status = clock.sync(pings)
+            # Module time 0 is sim._start_time on the host, the resolution is 1/32768 s
+            error = clock.module_to_host(0.0) - sim._start_time
+            results[phase] = dict(status, error_ms=round(error * 1000, 3),
+                                  within_uncertainty=abs(error) * 1000 <=
+                                  status['uncertainty'] + 1000 / ClockSync.PING_FRACTION_PER_SEC)
+    finally:
+        port.close()
+        sim.stop()
+    return results
+
+
+def run_benchmarks(count: int = 200, latency: float = 0.0, jitter: float = 0.0,
+                   port_name: str = None, baud: int = EzSerialPort.IF820_DEFAULT_BAUD,
+                   rates: list = None) -> dict:
+    """Run EzSerialPort benchmarks against the simulator (or a real module)
+
+    Args:
+        count (int, optional): Number of commands/events per benchmark. Defaults to 200.
+        latency (float, optional): Simulated response latency in seconds. Defaults to 0.0.
+        jitter (float, optional): Simulated response jitter in seconds. Defaults to 0.0.
+        port_name (str, optional): Use this port instead of starting a simulator. Defaults to None.
+        baud (int, optional): Baud rate for port_name. Defaults to 115200.
+        rates (list, optional): Also measure bulk command throughput at these baud rates.
+          Defaults to None.
+
+    Returns:
+        dict: Benchmark results
+    """
+    sim = None
+    if port_name is None:
+        sim = EzSerialSimulator(latency, jitter)
+        port_name = sim.start()
+    port = EzSerialPort()
+    port.open(port_name, baud)
+    results = {}
+    try:
+        for api_name, api in [('binary', 1), ('text', 0)]:
+            port.set_api_format(api)
+            results[f'send_and_wait_{api_name}'] = bench_send_and_wait(
+                port, count)
+            for window in [1, 4, 8]:
+                results[f'pipelined_{api_name}_window_{window}'] = bench_pipelined(
+                    port, count, window)
+        port.set_api_format(1)
+        if sim:
+            results['wait_event_flood'] = bench_wait_event(port, sim, count)
+        results['user_data_blob'] = bench_user_data_blob(port)
+        if sim:
+            results['gatt_blob'] = bench_gatt_blob(16384, latency)
+            results['throughput'] = bench_throughput(count, latency)
+            results['clock_sync'] = bench_clock_sync(latency, jitter)
+        if rates:
+            results['baud_rates'] = bench_baud_rates(port, rates, count)
+    finally:
+        port.close()
+        if sim:
+            sim.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark EzSerialPort against the EZ-Serial simulator')
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help="Number of commands/events per benchmark")
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Simulated response latency in seconds")
+    parser.add_argument('-j', '--jitter', type=float, default=0.0,
+                        help="Simulated response jitter in seconds")
+    parser.add_argument('-p', '--port', default=None,
+                        help="Benchmark a real module on this port instead of the simulator")
+    parser.add_argument('-b', '--baud', type=int, default=EzSerialPort.IF820_DEFAULT_BAUD,
+                        help="Baud rate of --port")
+    parser.add_argument('-r', '--rates', type=int, nargs='+', default=None,
+                        help="Measure bulk command throughput at these baud rates")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    results = run_benchmarks(args.count, args.latency,
+                             args.jitter, args.port, args.baud, args.rates)
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
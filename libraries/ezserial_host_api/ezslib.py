@@ -55,7 +55,6 @@
 import sys
 import re
 import struct
-import time
 import logging
 
 class dotdict(dict):
@@ -89,6 +88,14 @@ class PacketException(EZSerialException):
 class ParseException(EZSerialException):
     pass
 
+# precompiled text-mode grammar
+reTextCommandPacket = re.compile('^([a-zA-Z0-9\\$\\.\\/]+)([^\r\n]*)\r\n$')
+reTextCommandArgs = re.compile('([a-zA-Z])=([^,]*)')
+reTextIncomingPacket = re.compile(
+    '^@([RE]),([0-9A-F]{4}),([A-Z0-9\\$\\.\\/]+)([^\r\n]*)\r\n$')
+reTextResponsePayload = re.compile('^,([0-9A-F]{4}),*(.*)$')
+reTextIncomingArgs = re.compile('([A-Z])=([^,]*)')
+
 
 class Protocol():
 
@@ -394,6 +401,78 @@ class Protocol():
         },
     }
 
+    # text argument value to binary payload value conversion
+    dataTypeTextDecoder = {
+        "uint8": lambda text: int(text, 16),
+        "uint16": lambda text: int(text, 16),
+        "uint32": lambda text: int(text, 16),
+        "int8": lambda text: int(text, 16),
+        "int16": lambda text: int(text, 16),
+        "int32": lambda text: int(text, 16),
+        "macaddr": lambda text: list(reversed(bytearray.fromhex(text))),
+        "uint8a": lambda text: bytearray.fromhex(text),
+        "string": lambda text: text,
+        "longuint8a": lambda text: bytearray.fromhex(text),
+        "longstring": lambda text: text
+    }
+
+    # argument prepended to the returns of every response packet
+    resultArg = {"type": 'uint16', "name": 'result', "textname": '_'}
+
+    # name, text name and ID lookup tables, built on first use instead of at import
+    _index = None
+
+    @classmethod
+    def getIndex(cls):
+        if Protocol._index == None:
+            index = dotdict()
+            index.commandsByName = {}
+            index.commandsByTextName = {}
+            index.eventsByName = {}
+            index.eventsByTextName = {}
+            for (search, byName, byTextName) in [
+                    (Protocol.commands, index.commandsByName, index.commandsByTextName),
+                    (Protocol.events, index.eventsByName, index.eventsByTextName)]:
+                for group in search:
+                    for method in search[group]:
+                        if type(method) != int:
+                            continue
+                        entry = search[group][method]
+                        entry["group"] = group
+                        entry["method"] = method
+                        byName.setdefault(
+                            search[group]["name"] + "_" + entry["name"], entry)
+                        byTextName.setdefault(entry["textname"], entry)
+            Protocol._index = index
+        return Protocol._index
+
+    @classmethod
+    def getArgList(cls, entry, key):
+        # key is "parameters", "returns" or "response" (result followed by returns)
+        if key == "response":
+            if "_responseArgs" not in entry:
+                entry["_responseArgs"] = [Protocol.resultArg] + entry["returns"]
+            return entry["_responseArgs"]
+        return entry[key]
+
+    @classmethod
+    def getArgStruct(cls, entry, key):
+        # compiled codec for the fixed-size part of an argument list, built on first use
+        cacheKey = "_%sStruct" % key
+        if cacheKey not in entry:
+            entry[cacheKey] = struct.Struct('<%s' % ''.join(
+                [Protocol.dataTypeMap[z["type"]] for z in Protocol.getArgList(entry, key)]))
+        return entry[cacheKey]
+
+    @classmethod
+    def getTextDecoders(cls, entry, key):
+        # text name to (argument name, decoder) table for an argument list, built on first use
+        cacheKey = "_%sTextDecoders" % key
+        if cacheKey not in entry:
+            entry[cacheKey] = dict([(z["textname"], (z["name"], Protocol.dataTypeTextDecoder[z["type"]]))
+                                    for z in Protocol.getArgList(entry, key)])
+        return entry[cacheKey]
+
     @classmethod
     def getMethodByName(cls, name):
         parts = name.split('_', 2)
@@ -402,54 +481,39 @@ class Protocol():
                 "Invalid method name '%s' specified, format must be similar to 'cmd_system_ping'" % name)
 
         if parts[0] in ["cmd", "rsp"]:
-            search = Protocol.commands
+            search = Protocol.getIndex().commandsByName
         elif parts[0] == "evt":
-            search = Protocol.events
+            search = Protocol.getIndex().eventsByName
         else:
             raise ProtocolException(
                 "Invalid method type '%s' specified, must be 'cmd', 'rsp', or 'evt'" % parts[0])
 
-        # group is "p_cyspp" or "p_ibeacon" or similar, adjust name
-        if parts[1] == "p":
-            temp = parts[2].split('_', 1)
-            parts[1] += "_" + temp[0]
-            parts[2] = temp[1]
-
-        for group in search:
-            if type(group) != int:
-                continue
-            if search[group]["name"] == parts[1]:
-                for method in search[group]:
-                    if type(method) != int:
-                        continue
-                    if search[group][method]["name"] == parts[2]:
-                        search[group][method]["group"] = group
-                        search[group][method]["method"] = method
-                        return search[group][method]
+        entry = search.get(name[len(parts[0]) + 1:])
+        if entry != None:
+            return entry
 
         # not found in table
         raise ProtocolException("Method with name '%s' not found" % name)
 
     @classmethod
     def getCommandByName(cls, name):
+        entry = Protocol.getIndex().commandsByName.get(name)
+        if entry != None:
+            return entry
         return Protocol.getMethodByName("cmd_%s" % name)
 
     @classmethod
     def getEventByName(cls, name):
+        entry = Protocol.getIndex().eventsByName.get(name)
+        if entry != None:
+            return entry
         return Protocol.getMethodByName("evt_%s" % name)
 
     @classmethod
     def getCommandByTextName(cls, name):
-        for group in Protocol.commands:
-            if type(group) != int:
-                continue
-            for method in Protocol.commands[group]:
-                if type(method) != int:
-                    continue
-                if Protocol.commands[group][method]["textname"] == name.upper():
-                    Protocol.commands[group][method]["group"] = group
-                    Protocol.commands[group][method]["method"] = method
-                    return Protocol.commands[group][method]
+        entry = Protocol.getIndex().commandsByTextName.get(name.upper())
+        if entry != None:
+            return entry
 
         # not found in table
         raise ProtocolException(
@@ -457,16 +521,9 @@ class Protocol():
 
     @classmethod
     def getEventByTextName(cls, name):
-        for group in Protocol.events:
-            if type(group) != int:
-                continue
-            for method in Protocol.events[group]:
-                if type(method) != int:
-                    continue
-                if Protocol.events[group][method]["textname"] == name.upper():
-                    Protocol.events[group][method]["group"] = group
-                    Protocol.events[group][method]["method"] = method
-                    return Protocol.events[group][method]
+        entry = Protocol.getIndex().eventsByTextName.get(name.upper())
+        if entry != None:
+            return entry
 
         # not found in table
         raise ProtocolException(
@@ -626,10 +683,9 @@ class Packet():
     def buildOutgoingFromArgs(self, command, memscope=EZS_MEMORY_SCOPE_RAM, **kwargs):
         self.entry = Protocol.getCommandByName(command)
         argList = self.entry["parameters"]
-        packFormat = '<%s' % ''.join(
-            [Protocol.dataTypeMap[z["type"]] for z in argList])
+        codec = Protocol.getArgStruct(self.entry, "parameters")
         self.type = Packet.EZS_PACKET_TYPE_COMMAND
-        self.payloadLength = struct.calcsize(packFormat)
+        self.payloadLength = codec.size
         self.group = self.entry["group"]
         self.method = self.entry["method"]
         self.origin = Packet.EZS_ORIGIN_ASSEMBLY
@@ -698,7 +754,7 @@ class Packet():
 
         # assemble binary byte array
         self.binaryByteArray = byteList
-        self.binaryByteArray += bytearray(struct.pack(packFormat, *packValues))
+        self.binaryByteArray += bytearray(codec.pack(*packValues))
         if suffix != None:
             if type(suffix) is str:
                 if sys.version_info < (3, 0):
@@ -720,11 +776,10 @@ class Packet():
         if type(buf) == str:
             self.textString = buf
         else:
-            self.textString = "".join(map(chr, buf))
+            self.textString = bytes(buf).decode("latin-1")
         self.origin = Packet.EZS_ORIGIN_TEXT
         self.scope = Packet.EZS_MEMORY_SCOPE_RAM
-        rePacket = re.compile('^([a-zA-Z0-9\\$\\.\\/]+)([^\r\n]*)\r\n$')
-        reMatch = rePacket.match(self.textString)
+        reMatch = reTextCommandPacket.match(self.textString)
 
         if not reMatch:
             raise PacketException(
@@ -736,52 +791,37 @@ class Packet():
 
         # command packet
         self.type = self.EZS_PACKET_TYPE_COMMAND
-        rePayload = re.compile('^,*(.*)$')
-        payloadMatch = rePayload.match(reMatch.group(2))
-        if not payloadMatch:
-            raise PacketException(
-                "Malformed text command packet: '%s'" % self.textString, self)
-        argText = payloadMatch.group(1)
+        argText = reMatch.group(2).lstrip(',')
 
         # attempt to find this packet in the API definition
         self.entry = Protocol.getCommandByTextName(self.textName)
         self.group = self.entry["group"]
         self.method = self.entry["method"]
+        decoders = Protocol.getTextDecoders(self.entry, "parameters")
 
         # parse all text parameters from this packet
-        reArgs = re.compile('([a-zA-Z])=([^,]*)')
-        for argMatch in reArgs.finditer(argText):
+        for argMatch in reTextCommandArgs.finditer(argText):
             argName = argMatch.group(1).upper()
             if argName in self.textPayload:
                 raise PacketException(
                     "Text argument '%s' already encountered in payload '%s'" % (argName, argText), self)
-            if argName not in [x["textname"] for x in self.entry["parameters"]]:
+            if argName not in decoders:
                 raise PacketException(
                     "Text argument '%s' from payload '%s' not expected for this command" % (argName, argText), self)
-            self.textPayload[argMatch.group(1).upper()] = argMatch.group(2)
+            self.textPayload[argName] = argMatch.group(2)
 
         # convert to binary based on API definition
         missing = []
-        for x in self.entry["parameters"]:
-            if x["textname"] in self.textPayload:
-                if x["type"] in ["uint8a", "longuint8a"]:
-                    self.payload[x["name"]] = bytearray.fromhex(
-                        self.textPayload[x["textname"]])
-                elif x["type"] in ["string", "longstring"]:
-                    self.payload[x["name"]] = self.textPayload[x["textname"]]
-                elif x["type"] == "macaddr":
-                    self.payload[x["name"]] = list(
-                        reversed(bytearray.fromhex(self.textPayload[x["textname"]])))
-                else:
-                    self.payload[x["name"]] = int(
-                        self.textPayload[x["textname"]], 16)
+        for textName, (name, decode) in decoders.items():
+            if textName in self.textPayload:
+                self.payload[name] = decode(self.textPayload[textName])
             else:
                 # some argument is missing, can't safely convert from text to binary
-                missing.append(x)
+                missing.append("%s (%s)" % (name, textName))
 
         if len(missing) > 0:
-            raise PacketException("Missing text arguments: %s" % ", ".join(
-                ["%s (%s)" % (x["name"], x["textname"]) for x in missing]), self)
+            raise PacketException("Missing text arguments: %s" %
+                                  ", ".join(missing), self)
 
         # reuse other method to do the legwork of filling in the rest of the packet details
         self.buildOutgoingFromArgs(
@@ -825,10 +865,8 @@ class Packet():
             if self.scope == self.EZS_MEMORY_SCOPE_FLASH:
                 textSub = textSub + "$"
 
-            # copy (not directly assign!) parameter list definition to working argument list
-            argList = list(self.entry["returns"])
-            argList.insert(
-                0, {"type": 'uint16', "name": 'result', "textname": '_'})
+            argList = Protocol.getArgList(self.entry, "response")
+            codec = Protocol.getArgStruct(self.entry, "response")
 
         elif (buf[0] & 0xC0) == 0x80:
             # event packet has only first MSB set and second MSB clear (0x80)
@@ -841,8 +879,8 @@ class Packet():
             self.textString = "@E,"
             textSub = "," + self.entry["textname"]
 
-            # copy (not directly assign!) parameter list definition to working argument list
-            argList = list(self.entry["parameters"])
+            argList = self.entry["parameters"]
+            codec = Protocol.getArgStruct(self.entry, "parameters")
 
         else:
             # packet has neither of first two MSB's set, which is invalid
@@ -851,13 +889,10 @@ class Packet():
 
         # proceed if argument list is known
         if argList != None:
-            unpackFormat = '<%s' % ''.join(
-                [Protocol.dataTypeMap[z["type"]] for z in argList])
-            argValues = struct.unpack_from(
-                unpackFormat, self.binaryByteArray[4:])
+            argValues = codec.unpack_from(self.binaryByteArray, 4)
             for x in range(len(argList)):
                 if argList[x]["type"] in ["uint8a", "longuint8a", "string", "longstring"]:
-                    start = 4 + struct.calcsize(unpackFormat)
+                    start = 4 + codec.size
                     if start + argValues[x] != self.payloadLength + 4:
                         # variable-length array does not fit properly within header-specified payload length
                         raise PacketException("Variable-length argument '%s' claims %d bytes but actually has %d" % (
@@ -874,17 +909,14 @@ class Packet():
                                      ] = self.binaryByteArray[start:start+argValues[x]]
 
                         # byte to ASCII hex conversion for normal data blobs
-                        self.textPayload[argList[x]["textname"]] = ''.join(
-                            ['%02X' % b for b in self.binaryByteArray[start:start+argValues[x]]])
+                        self.textPayload[argList[x]["textname"]] = self.binaryByteArray[start:start+argValues[x]].hex().upper()
                 elif argList[x]["type"] == "macaddr":
-                    self.payload[argList[x]["name"]] = list(
-                        bytearray(argValues[x]))
-                    self.textPayload[argList[x]["textname"]] = ''.join(
-                        ['%02X' % b for b in reversed(bytearray(argValues[x]))])
+                    self.payload[argList[x]["name"]] = list(argValues[x])
+                    self.textPayload[argList[x]["textname"]] = argValues[x][::-1].hex().upper()
                 else:
                     self.payload[argList[x]["name"]] = argValues[x]
-                    self.textPayload[argList[x]["textname"]] = ('{:0%dX}' % (
-                        Protocol.dataTypeWidth[argList[x]["type"]] * 2)).format(argValues[x], "x")
+                    self.textPayload[argList[x]["textname"]] = '%0*X' % (
+                        Protocol.dataTypeWidth[argList[x]["type"]] * 2, argValues[x])
 
                 # append this argument to the text string
                 if argList[x]["textname"] == "_":
@@ -901,11 +933,9 @@ class Packet():
             ("%04X" % len(textSub)) + textSub + "\r\n"
 
     def buildIncomingFromTextBuffer(self, buf):
-        self.textString = "".join(map(chr, buf))
+        self.textString = bytes(buf).decode("latin-1")
         self.origin = Packet.EZS_ORIGIN_TEXT
-        rePacket = re.compile(
-            '^@([RE]),([0-9A-F]{4}),([A-Z0-9\\$\\.\\/]+)([^\r\n]*)\r\n$')
-        reMatch = rePacket.match(self.textString)
+        reMatch = reTextIncomingPacket.match(self.textString)
 
         if not reMatch:
             raise PacketException(
@@ -913,7 +943,6 @@ class Packet():
 
         self.textSublength = int(reMatch.group(2), 16)
         self.textName = reMatch.group(3)
-        argList = None
 
         if self.textSublength != (len(reMatch.group(3)) + len(reMatch.group(4)) + 1):
             raise PacketException("Text length specified %d payload bytes but %d found, detail: %s" %
@@ -922,8 +951,7 @@ class Packet():
         if reMatch.group(1) == "R":
             # response packet
             self.type = self.EZS_PACKET_TYPE_RESPONSE
-            rePayload = re.compile('^,([0-9A-F]{4}),*(.*)$')
-            payloadMatch = rePayload.match(reMatch.group(4))
+            payloadMatch = reTextResponsePayload.match(reMatch.group(4))
             if not payloadMatch:
                 raise PacketException(
                     "Malformed text response packet: '%s'" % self.textString, self)
@@ -940,39 +968,22 @@ class Packet():
 
             # attempt to get method details based on text name
             self.entry = Protocol.getCommandByTextName(self.textName)
-            self.group = self.entry["group"]
-            self.method = self.entry["method"]
-
-            # copy (not directly assign!) parameter list definition to working argument list
-            argList = list(self.entry["returns"])
-            argList.insert(
-                0, {"type": 'uint16', "name": 'result', "textname": '_'})
+            decoders = Protocol.getTextDecoders(self.entry, "response")
 
-        elif reMatch.group(1) == "E":
+        else:
             # event packet
             self.type = self.EZS_PACKET_TYPE_EVENT
-            rePayload = re.compile('^,*(.*)$')
-            payloadMatch = rePayload.match(reMatch.group(4))
-            if not payloadMatch:
-                raise PacketException(
-                    "Malformed text event packet: '%s'" % self.textString, self)
-            argText = payloadMatch.group(1)
+            argText = reMatch.group(4).lstrip(',')
 
             # attempt to find this packet in the API definition
             self.entry = Protocol.getEventByTextName(self.textName)
-            self.group = self.entry["group"]
-            self.method = self.entry["method"]
-
-            # copy (not directly assign!) parameter list definition to working argument list
-            argList = list(self.entry["parameters"])
+            decoders = Protocol.getTextDecoders(self.entry, "parameters")
 
-        else:
-            raise PacketException(
-                "Invalid incoming text packet type, SOF match='%s'" % reMatch.group(1), self)
+        self.group = self.entry["group"]
+        self.method = self.entry["method"]
 
         # parse all text parameters from this packet
-        reArgs = re.compile('([A-Z])=([^,]*)')
-        for argMatch in reArgs.finditer(argText):
+        for argMatch in reTextIncomingArgs.finditer(argText):
             if argMatch.group(1) in self.textPayload:
                 raise PacketException("Text argument '%s' already encountered in payload '%s'" % (
                     argMatch.group(1), argText), self)
@@ -980,21 +991,9 @@ class Packet():
                 self.textPayload[argMatch.group(1)] = argMatch.group(2)
 
         # convert to binary based on API definition
-        if argList != None:
-            for x in argList:
-                if x["textname"] in self.textPayload:
-                    if x["type"] in ["uint8a", "longuint8a"]:
-                        self.payload[x["name"]] = bytearray.fromhex(
-                            self.textPayload[x["textname"]])
-                    elif x["type"] in ["string", "longstring"]:
-                        self.payload[x["name"]
-                                     ] = self.textPayload[x["textname"]]
-                    elif x["type"] == "macaddr":
-                        self.payload[x["name"]] = list(
-                            reversed(bytearray.fromhex(self.textPayload[x["textname"]])))
-                    else:
-                        self.payload[x["name"]] = int(
-                            self.textPayload[x["textname"]], 16)
+        for textName, (name, decode) in decoders.items():
+            if textName in self.textPayload:
+                self.payload[name] = decode(self.textPayload[textName])
 
 
 class API():
@@ -1039,6 +1038,7 @@ class API():
         self.lastOutputResult = None
         self.lastInputResult = None
         self.lastParseResult = None
+        self.rxChunkIndex = 0
 
     def parse(self, b):
         if type(b) is str:
@@ -1117,6 +1117,37 @@ class API():
         self.lastParseResult = result
         return result
 
+    def parseBytes(self, data):
+        # parse a chunk of bytes, copying packet bodies by slice instead of byte by byte
+        # (on exception, rxChunkIndex is the offset of the byte that failed)
+        data = bytes(data)
+        i = 0
+        self.rxChunkIndex = 0
+        while i < len(data):
+            self.rxChunkIndex = i
+            if self.inBinaryPacket and len(self.rxPacketBuffer) >= 2:
+                # binary payload up to (not including) the checksum byte
+                remaining = self.rxPacketLengthExpected - 1 - len(self.rxPacketBuffer)
+                if remaining > 0:
+                    chunk = data[i:i + remaining]
+                    self.rxPacketBuffer.extend(chunk)
+                    self.rxPacketChecksum = (self.rxPacketChecksum + sum(chunk)) % 256
+                    i += len(chunk)
+                    continue
+            elif self.inTextPacket:
+                # text up to (not including) the end of line
+                end = data.find(b'\n', i)
+                if end < 0:
+                    end = len(data)
+                chunk = data[i:end]
+                if len(chunk) > 0 and max(chunk) < self.EZS_BINARY_SOF_MASK:
+                    self.rxPacketBuffer.extend(chunk)
+                    i = end
+                    continue
+            self.parse(data[i])
+            i += 1
+        self.rxChunkIndex = i
+
     def sendCommand(self, command, memscope=None, apiformat=None, **kwargs):
         if memscope == None:
             memscope = self.defaults.memscope
@@ -1153,6 +1184,8 @@ class API():
         read = 0
         readResult = self.EZS_INPUT_RESULT_NO_DATA
         readData = bytearray()
+        if type(data) is str:
+            data = bytearray(data, "utf-8")
         if rxtimeout is False:
             rxtimeout = self.defaults.rxtimeout
         while read < len(data):
@@ -1160,19 +1193,19 @@ class API():
             if b == None:
                 # no data available to read
                 raise ParseException("Incoming echo data after '%s' is not available as expected in '%s'" % (
-                    readData, bytearray(data, "utf-8")))
+                    readData, data))
             if type(b) is str:
                 # Python 2.x compatibility
                 b = ord(b)
             readData.append(b)
             self.lastInputResult = readResult
             if readResult == self.EZS_INPUT_RESULT_BYTE_READ:
-                if b == ord(data[read]):
+                if b == data[read]:
                     read = read + 1
                 else:
                     # incoming data doesn't match expected data
                     raise ParseException("Incoming echo data 0x%02X in '%s' does not match expected byte 0x%02X in '%s'" % (
-                        b, readData, ord(data[read]), bytearray(data, "utf-8")))
+                        b, readData, data[read], data))
 
         # send back the count of bytes actually read
         return read
@@ -1217,7 +1250,6 @@ class API():
             (packet, readResult, parseResult) = self.waitPacket(rxtimeout=rxtimeout)
             if packet != None and not packet.entry is entry and not packet.entry['name'] == 'error':
                 packet = False
-            time.sleep(0.01)
 
         # send back results
         return (packet, readResult, parseResult)
@@ -1234,7 +1266,6 @@ class API():
             (packet, readResult, parseResult) = self.waitPacket(rxtimeout=rxtimeout)
             if packet != None and not packet.entry is entry:
                 packet = False
-            time.sleep(0.01)
 
         return (packet, readResult, parseResult)
 
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import timeit
+import ezserial_host_api.ezslib as ez_serial
+from lc_util import logger_setup, logger_get
+
+logger = logger_get(__name__)
+
+BINARY_EVENT_SOF = 0x80
+BINARY_RESPONSE_SOF = 0xC0
+VAR_LEN_TYPES = ['uint8a', 'longuint8a', 'string', 'longstring']
+
+# Representative commands (arguments) of the IF820 tests
+COMMANDS = {'system_ping': {},
+            'gap_connect': {'address': [1, 2, 3, 4, 5, 6], 'type': 0, 'interval': 6,
+                            'slave_latency': 0, 'supervision_timeout': 100,
+                            'scan_interval': 0x100, 'scan_window': 0x100, 'scan_timeout': 0},
+            'gatts_write_handle': {'attr_handle': 3, 'data': bytes(range(20))},
+            'system_write_user_data': {'offset': 0, 'data': bytes(range(32))}}
+# Representative responses (result and returns)
+RESPONSES = {'system_ping': {'runtime': 1234, 'fraction': 5678},
+             'system_read_user_data': {'data': bytes(range(32))},
+             'gap_connect': {'conn_handle': 4}}
+# Representative events
+EVENTS = {'gap_scan_result': {'result_type': 0, 'address': [1, 2, 3, 4, 5, 6],
+                              'address_type': 0, 'rssi': -60, 'bond': 0xFF,
+                              'data': bytes(range(31))},
+          'gatts_data_written': {'conn_handle': 4, 'attr_handle': 3, 'type': 0,
+                                 'offset': 0, 'data': bytes(range(20))},
+          'system_boot': {}}
+
+
+def frame(sof: int, entry: dict, key: str, values: dict) -> bytes:
+    """Build an incoming binary packet the way the module sends it
+
+    Args:
+        sof (int): BINARY_EVENT_SOF or BINARY_RESPONSE_SOF
+        entry (dict): Protocol entry
+        key (str): "parameters" (event) or "response"
+        values (dict): Argument values, missing arguments are 0
+
+    Returns:
+        bytes: Binary packet
+    """
+    fixed = []
+    suffix = b''
+    for arg in ez_serial.Protocol.getArgList(entry, key):
+        value = values.get(arg['name'], None)
+        if arg['type'] in VAR_LEN_TYPES:
+            suffix = bytes(value if value is not None else b'')
+            fixed.append(len(suffix))
+        elif arg['type'] == 'macaddr':
+            fixed.append(bytes(value if value is not None else 6))
+        else:
+            fixed.append(value if value is not None else 0)
+    payload = ez_serial.Protocol.getArgStruct(entry, key).pack(*fixed) + suffix
+    packet = bytearray([sof | (len(payload) >> 8), len(payload) & 0xFF,
+                        entry['group'], entry['method']]) + payload
+    packet.append((ez_serial.API.EZS_BINARY_CHECKSUM_INITIAL_VALUE + sum(packet)) % 256)
+    return bytes(packet)
+
+
+def to_text(packet: bytes) -> bytes:
+    """
+    Args:
+        packet (bytes): Binary packet
+
+    Returns:
+        bytes: The same packet in the text format
+    """
+    p = ez_serial.Packet()
+    p.buildIncomingFromBinaryBuffer(packet)
+    return p.textString.encode('latin-1')
+
+
+def incoming_packets() -> list:
+    """
+    Returns:
+        list: (name, binary packet) of the representative responses and events
+    """
+    packets = []
+    for name, values in RESPONSES.items():
+        entry = ez_serial.Protocol.getCommandByName(name)
+        packets.append((f'rsp_{name}', frame(BINARY_RESPONSE_SOF, entry, 'response',
+                                             dict(values, result=0))))
+    for name, values in EVENTS.items():
+        entry = ez_serial.Protocol.getEventByName(name)
+        packets.append((f'evt_{name}', frame(BINARY_EVENT_SOF, entry, 'parameters', values)))
+    return packets
+
+
+def measure(func, ops: int, number: int, repeat: int) -> dict:
+    """Time a benchmark case
+
+    Args:
+        func: Case to run, performs ops operations per call
+        ops (int): Operations per call of func
+        number (int): Calls per sample
+        repeat (int): Number of samples
+
+    Returns:
+        dict: ops, best and mean microseconds per operation and operations per second
+    """
+    samples = [t / (number * ops) for t in timeit.Timer(func).repeat(repeat, number)]
+    best = min(samples)
+    return {'ops': number * ops * repeat,
+            'best_us': round(best * 1e6, 3),
+            'mean_us': round(sum(samples) / len(samples) * 1e6, 3),
+            'ops_per_sec': round(1 / best, 1)}
+
+
+def bench_encode(number: int, repeat: int) -> dict:
+    results = {}
+    for name, values in COMMANDS.items():
+        results[f'encode_{name}'] = measure(
+            lambda: ez_serial.Packet(name, **values), 1, number, repeat)
+    return results
+
+
+def bench_decode(number: int, repeat: int) -> dict:
+    results = {}
+    for name, packet in incoming_packets():
+        text = to_text(packet)
+        results[f'decode_binary_{name}'] = measure(
+            lambda: ez_serial.Packet().buildIncomingFromBinaryBuffer(packet), 1, number, repeat)
+        results[f'decode_text_{name}'] = measure(
+            lambda: ez_serial.Packet().buildIncomingFromTextBuffer(text), 1, number, repeat)
+    return results
+
+
+def bench_framing(number: int, repeat: int, chunk_size: int = 64) -> dict:
+    """Frame streams of all incoming packets, per byte (parse) and in chunks (parseBytes)"""
+    packets = [p for _, p in incoming_packets()]
+    streams = {'binary': b''.join(packets),
+               'text': b''.join(to_text(p) for p in packets),
+               # Alternate formats, as after a format switch with events in flight
+               'mixed': b''.join(to_text(p) if i % 2 else p for i, p in enumerate(packets))}
+    results = {}
+    for stream_name, stream in streams.items():
+        api = ez_serial.API()
+        chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+        def parse():
+            for b in stream:
+                api.parse(b)
+
+        def parse_bytes():
+            for chunk in chunks:
+                api.parseBytes(chunk)
+
+        for case, func in [('parse', parse), ('parse_bytes', parse_bytes)]:
+            api.reset()
+            result = measure(func, len(packets), number, repeat)
+            result['bytes'] = len(stream)
+            results[f'framing_{stream_name}_{case}'] = result
+    return results
+
+
+def bench_lookups(number: int, repeat: int) -> dict:
+    index = ez_serial.Protocol.getIndex()
+    command_names = list(index.commandsByName)
+    event_names = list(index.eventsByName)
+    text_names = [e['textname'] for e in index.commandsByName.values()]
+    event_ids = [(e['group'], e['method']) for e in index.eventsByName.values()]
+    command_ids = [(e['group'], e['method']) for e in index.commandsByName.values()]
+    entries = list(index.commandsByName.values())
+
+    def by_name():
+        for name in command_names:
+            ez_serial.Protocol.getCommandByName(name)
+        for name in event_names:
+            ez_serial.Protocol.getEventByName(name)
+
+    def by_method_name():
+        for name in command_names:
+            ez_serial.Protocol.getMethodByName(f'cmd_{name}')
+
+    def by_text_name():
+        for name in text_names:
+            ez_serial.Protocol.getCommandByTextName(name)
+
+    def by_ids():
+        for ids in command_ids:
+            ez_serial.Protocol.getCommandByIds(*ids)
+        for ids in event_ids:
+            ez_serial.Protocol.getEventByIds(*ids)
+
+    def codecs():
+        for entry in entries:
+            ez_serial.Protocol.getArgStruct(entry, 'parameters')
+            ez_serial.Protocol.getArgStruct(entry, 'response')
+            ez_serial.Protocol.getTextDecoders(entry, 'response')
+
+    return {'lookup_by_name': measure(by_name, len(command_names) + len(event_names),
+                                      number, repeat),
+            'lookup_by_method_name': measure(by_method_name, len(command_names), number, repeat),
+            'lookup_by_text_name': measure(by_text_name, len(text_names), number, repeat),
+            'lookup_by_ids': measure(by_ids, len(command_ids) + len(event_ids), number, repeat),
+            'lookup_codecs': measure(codecs, len(entries), number, repeat)}
+
+
+def run_benchmarks(number: int = 1000, repeat: int = 5) -> dict:
+    """Run the ezslib codec, framing and lookup benchmarks
+
+    Args:
+        number (int, optional): Calls of each case per sample. Defaults to 1000.
+        repeat (int, optional): Samples of each case. Defaults to 5.
+
+    Returns:
+        dict: Benchmark results by case
+    """
+    results = {}
+    results.update(bench_encode(number, repeat))
+    results.update(bench_decode(number, repeat))
+    results.update(bench_framing(max(1, number // 10), repeat))
+    results.update(bench_lookups(max(1, number // 10), repeat))
+    return results
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Compare results with a saved run
+
+    Args:
+        results (dict): Results of run_benchmarks
+        baseline (dict): Results of an earlier run
+
+    Returns:
+        dict: Ratio of best time per operation (below 1 is faster) by case
+    """
+    return dict((name, round(result['best_us'] / baseline[name]['best_us'], 3))
+                for name, result in results.items()
+                if name in baseline and baseline[name].get('best_us'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark ezslib packet encoding, decoding, framing and lookups')
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help="Calls of each case per sample")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Samples of each case")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-c', '--compare', default=None,
+                        help="Compare with the JSON results of an earlier run")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    results = run_benchmarks(args.number, args.repeat)
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.compare:
+        with open(args.compare) as f:
+            ratios = compare(results, json.load(f))
+        for name, ratio in ratios.items():
+            logger.info(f'{name}: {ratio}x' + (' (slower)' if ratio > 1.1 else ''))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import statistics
+import time
+import hci
+from HciSerialPort import HciFramer, HciSerialPort
+from lc_util import logger_setup, logger_get
+
+logger = logger_get(__name__)
+
+
+def command_complete(opcode: int, payload: bytes = b'') -> bytes:
+    """
+    Args:
+        opcode (int): Opcode of the command
+        payload (bytes, optional): Return parameters after the status. Defaults to b''.
+
+    Returns:
+        bytes: HCI Command Complete event (UART transport)
+    """
+    params = bytes([1]) + opcode.to_bytes(2, 'little') + bytes([0]) + payload
+    return bytes([hci.HciPacket.PacketType.EVENT, 0x0E, len(params)]) + params
+
+
+def expected_packets(count: int, vendor_event_size: int = 0) -> int:
+    """Number of packets in a stream made by synthetic_stream()"""
+    packets = count + count // 8
+    if vendor_event_size:
+        packets += count
+    return packets
+
+
+def synthetic_stream(count: int, vendor_event_size: int = 0, noise_every: int = 0) -> bytes:
+    """Responses of a WRITE_RAM stream with a VERIFY_CRC every 8 chunks
+
+    Args:
+        count (int): Number of WRITE_RAM responses
+        vendor_event_size (int, optional): Also send a vendor event of this size (max 255)
+          after every response, i.e. a chatty controller. Defaults to 0.
+        noise_every (int, optional): Insert a stray byte after every this many responses,
+          i.e. line noise around a baud rate change. Defaults to 0 (none).
+
+    Returns:
+        bytes: Received bytes
+    """
+    stream = bytearray()
+    for i in range(count):
+        stream += command_complete(HciSerialPort.OPCODE_WRITE_RAM)
+        if i % 8 == 7:
+            stream += command_complete(HciSerialPort.OPCODE_VERIFY_CRC, i.to_bytes(4, 'little'))
+        if vendor_event_size:
+            stream += bytes([hci.HciPacket.PacketType.EVENT, 0xFF, vendor_event_size]) + \
+                bytes(vendor_event_size)
+        if noise_every and i % noise_every == noise_every - 1:
+            stream += b'\x00'
+    return bytes(stream)
+
+
+def split_reads(stream: bytes, max_read: int, seed: int = 0) -> list:
+    """Cut a stream into reads of random size, as returned by the serial port"""
+    rng = random.Random(seed)
+    reads = []
+    i = 0
+    while i < len(stream):
+        n = rng.randint(1, max_read)
+        reads.append(stream[i:i + n])
+        i += n
+    return reads
+
+
+def parse_whole_buffer(reads: list) -> int:
+    """Decode the whole accumulated buffer after every read (as the RX thread did before),
+    keeping the partial packet that follows the complete ones. A byte that isn't a packet
+    indicator fails the whole decode and is dropped from the front."""
+    rx_bytes = []
+    count = 0
+    for data in reads:
+        rx_bytes.extend(data)
+        try:
+            packets, unprocessed = hci.from_binary(bytearray(rx_bytes))
+            if len(packets) > 0:
+                rx_bytes.clear()
+                rx_bytes.extend(unprocessed)
+            count += len(packets)
+        except Exception:
+            if len(rx_bytes) > 0:
+                rx_bytes.pop(0)
+    return count
+
+
+def parse_framer(reads: list) -> int:
+    framer = HciFramer()
+    count = 0
+    for data in reads:
+        count += len(framer.feed(data))
+    return count
+
+
+def bench_case(stream: bytes, expected: int, max_read: int, repeat: int) -> dict:
+    """Parse a stream with both approaches, repeating each to get the median time
+
+    Args:
+        stream (bytes): Received bytes
+        expected (int): Number of packets in the stream
+        max_read (int): Largest read returned by the serial port
+        repeat (int): Number of runs per approach
+
+    Returns:
+        dict: Packets found and median time per approach, and the median speedup
+    """
+    reads = split_reads(stream, max_read)
+    result = {'bytes': len(stream), 'reads': len(reads), 'expected_packets': expected}
+    for name, parse in [('whole_buffer', parse_whole_buffer), ('framer', parse_framer)]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            packets = parse(reads)
+            times.append(time.perf_counter() - start)
+        elapsed = statistics.median(times)
+        result[name] = {'packets': packets, 'median_seconds': round(elapsed, 4),
+                        'min_seconds': round(min(times), 4),
+                        'max_seconds': round(max(times), 4),
+                        'bytes_per_sec': round(len(stream) / elapsed, 1)}
+    result['median_speedup'] = round(result['whole_buffer']['median_seconds'] /
+                                     result['framer']['median_seconds'], 2)
+    return result
+
+
+def run_benchmarks(count: int = 2000, repeat: int = 5) -> dict:
+    """Compare the incremental framer with decoding the whole buffer after every read.
+
+    The framer is about as fast as the old decode; what it changes is correctness.
+    It keeps a partial packet that follows a complete one in the same read, and drops
+    a stray byte on its own, where the old decode lost every packet after line noise.
+    Compare the packets found with expected_packets rather than the speedup.
+
+    Args:
+        count (int, optional): Number of WRITE_RAM responses per stream. Defaults to 2000.
+        repeat (int, optional): Number of runs per case and approach. Defaults to 5.
+
+    Returns:
+        dict: Benchmark results
+    """
+    cases = {'write_ram_small_reads': (0, 0, 8),
+             'write_ram_backlog': (0, 0, 1024),
+             'vendor_events_small_reads': (255, 0, 8),
+             'vendor_events_backlog': (255, 0, 1024),
+             'noisy_backlog': (0, 50, 1024)}
+    results = {}
+    for name, (vendor_event_size, noise_every, max_read) in cases.items():
+        stream = synthetic_stream(count, vendor_event_size, noise_every)
+        results[name] = bench_case(stream, expected_packets(count, vendor_event_size),
+                                   max_read, repeat)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark HCI framing of a synthetic WRITE_RAM response stream')
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help="Number of WRITE_RAM responses per stream")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Number of runs per case, the median time is reported")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    results = run_benchmarks(args.count, args.repeat)
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
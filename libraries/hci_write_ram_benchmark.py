@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import time
+from HciSerialPort import HciSerialPort
+from HciSimulator import HciSimulator
+from lc_util import logger_setup, logger_get
+
+logger = logger_get(__name__)
+
+DS_ADDR = 0x501400
+
+
+def bench_write_ram(size: int, baud: int, latency: float, credits: int, max_in_flight: int) -> dict:
+    """Download a random image to the HCI simulator
+
+    Args:
+        size (int): Image size in bytes
+        baud (int): Simulated UART baud rate
+        latency (float): Simulated processing time of each command in seconds
+        credits (int): Number of command buffers of the simulator
+        max_in_flight (int): Maximum number of unanswered WRITE_RAM commands
+
+    Returns:
+        dict: Download time, its ratio to the time of the image bytes on the line and
+          credit overruns
+    """
+    sim = HciSimulator(latency, credits)
+    sim.baud = baud
+    port_name = sim.start()
+    port = HciSerialPort()
+    port.open(port_name, baud)
+    try:
+        port.send_hci_reset()
+        image = os.urandom(size)
+        start = time.perf_counter()
+        port.write_ram(DS_ADDR, io.BytesIO(image), max_in_flight=max_in_flight)
+        elapsed = time.perf_counter() - start
+        if sim.read_memory(DS_ADDR, size) != image:
+            raise Exception('Image not written')
+    finally:
+        port.close()
+        sim.stop()
+    line_secs = size * HciSimulator.BITS_PER_BYTE / baud
+    return {'credits': credits, 'max_in_flight': max_in_flight, 'seconds': round(elapsed, 4),
+            'bytes_per_sec': round(size / elapsed, 1),
+            'line_rate_ratio': round(line_secs / elapsed, 3),
+            'credit_overruns': sim.credit_overruns}
+
+
+def bench_verify(size: int, baud: int, latency: float, corrupt: int) -> dict:
+    """Download and verify a random image with corrupted chunks
+
+    Args:
+        size (int): Image size in bytes
+        baud (int): Simulated UART baud rate
+        latency (float): Simulated processing time of each command in seconds
+        corrupt (int): Number of chunks the simulator corrupts
+
+    Returns:
+        dict: write_ram result (chunks, crc_commands, rewritten) and seconds
+    """
+    sim = HciSimulator(latency, HciSerialPort.WRITE_RAM_MAX_IN_FLIGHT)
+    sim.baud = baud
+    chunks = size // HciSerialPort.WRITE_RAM_MAX_SIZE
+    sim.corrupt_addresses = set(DS_ADDR + HciSerialPort.WRITE_RAM_MAX_SIZE * (i * chunks // corrupt)
+                                for i in range(corrupt))
+    port_name = sim.start()
+    port = HciSerialPort()
+    port.open(port_name, baud)
+    try:
+        port.send_hci_reset()
+        image = os.urandom(size)
+        start = time.perf_counter()
+        result = port.write_ram(DS_ADDR, io.BytesIO(image), verify=True)
+        elapsed = time.perf_counter() - start
+        if sim.read_memory(DS_ADDR, size) != image:
+            raise Exception('Image not written')
+    finally:
+        port.close()
+        sim.stop()
+    return dict(result, seconds=round(elapsed, 4))
+
+
+def run_benchmarks(size: int = 64 * 1024, baud: int = 3000000, latency: float = 0.0002) -> dict:
+    """Compare stop-and-wait with pipelined WRITE_RAM downloads and measure verification
+    with corrupted chunks
+
+    Args:
+        size (int, optional): Image size in bytes. Defaults to 64 KiB.
+        baud (int, optional): Simulated UART baud rate. Defaults to 3000000.
+        latency (float, optional): Simulated processing time of each command in seconds.
+          Defaults to 0.0002.
+
+    Returns:
+        dict: Benchmark results
+    """
+    results = {}
+    for credits, max_in_flight in [(1, 1), (1, HciSerialPort.WRITE_RAM_MAX_IN_FLIGHT),
+                                   (4, HciSerialPort.WRITE_RAM_MAX_IN_FLIGHT),
+                                   (8, HciSerialPort.WRITE_RAM_MAX_IN_FLIGHT)]:
+        results[f'credits_{credits}_in_flight_{max_in_flight}'] = bench_write_ram(
+            size, baud, latency, credits, max_in_flight)
+    for corrupt in [0, 1, 8]:
+        results[f'verify_corrupt_{corrupt}'] = bench_verify(size, baud, latency, corrupt)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark WRITE_RAM downloads against the HCI simulator')
+    parser.add_argument('-s', '--size', type=int, default=64 * 1024,
+                        help="Image size in bytes")
+    parser.add_argument('-b', '--baud', type=int, default=3000000,
+                        help="Simulated UART baud rate")
+    parser.add_argument('-l', '--latency', type=float, default=0.0002,
+                        help="Simulated command processing time in seconds")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the results as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    results = run_benchmarks(args.size, args.baud, args.latency)
+    for name, result in results.items():
+        logger.info(f'{name}: {result}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from If820Board import If820Board, ERR_OK
+from lc_util import logger_setup, logger_get
+
+logger = logger_get(__name__)
+
+STATE_QUEUED = 'queued'
+STATE_FLASHING = 'flashing'
+STATE_RETRYING = 'retrying'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+class FlashReport():
+    """Progress and results of flashing several boards, shared by the workers"""
+
+    def __init__(self, boards: list):
+        self._lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.boards = dict((board.hci_port_name, {'probe': board.probe.id if board.probe else None,
+                                                  'state': STATE_QUEUED, 'attempts': 0,
+                                                  'seconds': None, 'errors': []})
+                           for board in boards)
+
+    def update(self, port: str, **kwargs):
+        with self._lock:
+            self.boards[port].update(kwargs)
+
+    def add_error(self, port: str, error: str):
+        with self._lock:
+            self.boards[port]['errors'].append(error)
+
+    def summary(self) -> str:
+        with self._lock:
+            states = [b['state'] for b in self.boards.values()]
+        return ', '.join(f'{s}: {states.count(s)}' for s in
+                         [STATE_QUEUED, STATE_FLASHING, STATE_RETRYING, STATE_DONE, STATE_FAILED]
+                         if states.count(s) > 0)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            boards = dict((port, dict(b, errors=list(b['errors'])))
+                          for port, b in self.boards.items())
+        times = [b['seconds'] for b in boards.values() if b['seconds'] is not None]
+        return {'boards': boards,
+                'ok': len([b for b in boards.values() if b['state'] == STATE_DONE]),
+                'failed': len([b for b in boards.values() if b['state'] == STATE_FAILED]),
+                'seconds': round(time.perf_counter() - self.start_time, 2),
+                'slowest_board_seconds': max(times) if times else None,
+                'serial_seconds': round(sum(times), 2)}
+
+
+def flash_board(board: If820Board, minidriver: str, firmware: str, chip_erase: bool,
+                retries: int, report: FlashReport, probe_lock: threading.Lock):
+    """Flash one board, retrying on failure. Errors are recorded in the report, not raised."""
+    port = board.hci_port_name
+    for attempt in range(1 + retries):
+        report.update(port, state=STATE_FLASHING if attempt == 0 else STATE_RETRYING,
+                      attempts=attempt + 1)
+        start = time.perf_counter()
+        try:
+            # Probe USB access is serialized, the HCI download itself runs in parallel
+            with probe_lock:
+                if board.enter_hci_download_mode() != ERR_OK:
+                    raise Exception('Failed to enter HCI download mode')
+            board.program_hci_firmware(minidriver, firmware, chip_erase)
+            report.update(port, state=STATE_DONE,
+                          seconds=round(time.perf_counter() - start, 2))
+            logger.info(f'{port} flashed in {time.perf_counter() - start:.1f}s')
+            return
+        except Exception as e:
+            logger.warning(f'{port} attempt {attempt + 1} failed: {e}')
+            report.add_error(port, str(e))
+            try:
+                board.hci_programmer.hci_port.close()
+            except Exception:
+                pass
+    report.update(port, state=STATE_FAILED)
+
+
+def flash_boards(boards: list, minidriver: str, firmware: str, chip_erase: bool = False,
+                 retries: int = 1, workers: int = None, progress_interval: float = 5) -> dict:
+    """Flash firmware to several IF820 boards at once, each through its own HCI UART.
+    A board that fails is retried without affecting the others.
+
+    Args:
+        boards (list): If820Board objects
+        minidriver (str): Path to the minidriver hex file
+        firmware (str): Path to the firmware file (hex or hcd)
+        chip_erase (bool, optional): Erase the whole flash first. Defaults to False.
+        retries (int, optional): Extra attempts per board. Defaults to 1.
+        workers (int, optional): Boards flashed at the same time. Defaults to all boards.
+        progress_interval (float, optional): Seconds between progress log messages. Defaults to 5.
+
+    Returns:
+        dict: Per board state, attempts, seconds and errors, plus totals
+    """
+    report = FlashReport(boards)
+    if len(boards) == 0:
+        return report.to_dict()
+    probe_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=workers if workers else len(boards)) as executor:
+        futures = [executor.submit(flash_board, board, minidriver, firmware, chip_erase,
+                                   retries, report, probe_lock) for board in boards]
+        while len(wait(futures, progress_interval).not_done) > 0:
+            logger.info(f'Flashing: {report.summary()}')
+    result = report.to_dict()
+    logger.info(f'Flashed {result["ok"]}/{len(boards)} boards in {result["seconds"]}s '
+                f'(serial {result["serial_seconds"]}s)')
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Flash firmware to all connected IF820 boards in parallel')
+    parser.add_argument('-m', '--minidriver', required=True,
+                        help="Minidriver hex file")
+    parser.add_argument('-f', '--firmware', required=True,
+                        help="Firmware file (hex or hcd)")
+    parser.add_argument('-e', '--chip_erase', action='store_true',
+                        help="Erase the whole flash before programming")
+    parser.add_argument('-r', '--retries', type=int, default=1,
+                        help="Extra attempts for a board that fails")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of boards flashed at the same time (default all)")
+    parser.add_argument('-p', '--ports', nargs='+', default=None,
+                        help="Only flash the boards with these HCI ports")
+    parser.add_argument('-o', '--output', default=None,
+                        help="Save the report as JSON to this file")
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logger = logger_setup(__file__, args.debug)
+
+    boards = If820Board.get_connected_boards()
+    if args.ports:
+        boards = [b for b in boards if b.hci_port_name in args.ports]
+    result = flash_boards(boards, args.minidriver, args.firmware, args.chip_erase,
+                          args.retries, args.workers)
+    for port, board in result['boards'].items():
+        logger.info(f'{port}: {board["state"]} after {board["attempts"]} attempt(s) '
+                    f'{board["errors"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
+    exit(0 if result['failed'] == 0 else 1)
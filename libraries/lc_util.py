@@ -1,6 +1,7 @@
 import argparse
 import logging
 import os
+import statistics
 
 
 class environment_default(argparse.Action):
@@ -53,3 +54,27 @@ def logger_get(script_name):
         Logger: Logger for the script.
     """
     return logging.getLogger(script_name)
+
+
+def latency_stats(samples: list) -> dict:
+    """
+    Summarize latency samples.
+
+    Args:
+        samples (list): Latencies in seconds.
+    Returns:
+        dict: count, mean, p50, p90, p99 and max in milliseconds.
+    """
+    if len(samples) == 0:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {'count': len(samples),
+            'mean': round(statistics.mean(samples) * 1000, 3),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': round(ordered[-1] * 1000, 3)}